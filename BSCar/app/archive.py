@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from flask import current_app
+
+from . import db
+from .models import (
+	Chat, Complaint, Listing, ListingCard, ListingImage, Message,
+	archived_chats, archived_complaints, archived_listing_images, archived_listings, archived_messages,
+)
+from .moderation import delete_listings
+from .transcripts import block_messages
+
+
+LISTING_STATUSES = {
+	'active': 'Активно',
+	'sold': 'Продано',
+	'expired': 'Истёк срок',
+	'archived': 'В архиве',
+	'draft': 'Черновик',
+}
+OWNER_STATUSES = ('active', 'sold', 'archived')
+DEFAULT_LISTING_TTL_DAYS = 60
+DEFAULT_ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 100
+
+
+class ArchiveResult(NamedTuple):
+	expired: int
+	archived: int
+
+
+class ArchivedChat(NamedTuple):
+	chat: object
+	messages: list
+
+
+def live_listings(query):
+	return query.where(Listing.status == 'active')
+
+
+def set_listing_status(listing: Listing, status: str) -> None:
+	if status not in OWNER_STATUSES:
+		raise ValueError(f'Unknown listing status: {status}')
+	listing.status = status
+	listing.updated_at = datetime.utcnow()
+
+
+def _settings() -> tuple[int, int]:
+	config = current_app.config
+	return (
+		config.get('LISTING_TTL_DAYS', DEFAULT_LISTING_TTL_DAYS),
+		config.get('ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS),
+	)
+
+
+def _copy(archive, model, condition, now: datetime) -> None:
+	columns = [column.name for column in model.__table__.columns]
+	db.session.execute(
+		db.insert(archive).from_select(
+			columns + ['archived_at'],
+			db.select(*[model.__table__.c[name] for name in columns], db.literal(now)).where(condition),
+		)
+	)
+
+
+def _copy_blocks(listing_ids: list[int], now: datetime) -> None:
+	chat_ids = db.session.execute(db.select(Chat.id).where(Chat.listing_id.in_(listing_ids))).scalars().all()
+	rows = [{**message._asdict(), 'archived_at': now} for message in block_messages(chat_ids)]
+	if rows:
+		db.session.execute(db.insert(archived_messages), rows)
+
+
+def move_to_archive(listing_ids: list[int], now: datetime) -> None:
+	chat_ids = db.select(Chat.id).where(Chat.listing_id.in_(listing_ids))
+	_copy(archived_listings, Listing, Listing.id.in_(listing_ids), now)
+	_copy(archived_listing_images, ListingImage, ListingImage.listing_id.in_(listing_ids), now)
+	_copy(archived_chats, Chat, Chat.listing_id.in_(listing_ids), now)
+	_copy(archived_messages, Message, Message.chat_id.in_(chat_ids), now)
+	_copy_blocks(listing_ids, now)
+	_copy(archived_complaints, Complaint, Complaint.listing_id.in_(listing_ids), now)
+	delete_listings(listing_ids)
+
+
+def _mark_stale(model, now: datetime, ttl_days: int, archive_after_days: int) -> int:
+	expired = db.session.execute(
+		db.update(model)
+		.where(model.status == 'active', model.updated_at < now - timedelta(days=ttl_days))
+		.values(status='expired', updated_at=now),
+		execution_options={'synchronize_session': False},
+	).rowcount
+	db.session.execute(
+		db.update(model)
+		.where(model.status.in_(('sold', 'expired')), model.updated_at < now - timedelta(days=archive_after_days))
+		.values(status='archived', updated_at=now),
+		execution_options={'synchronize_session': False},
+	)
+	return expired
+
+
+def archive_listings(now: datetime | None = None, batch_size: int = ARCHIVE_BATCH_SIZE) -> ArchiveResult:
+	"""Помечает устаревшие объявления и переносит архивные в archived_* пачками по batch_size."""
+	now = now or datetime.utcnow()
+	ttl_days, archive_after_days = _settings()
+
+	expired = _mark_stale(Listing, now, ttl_days, archive_after_days)
+	# Карточки хранят те же status и updated_at, поэтому для них повторяются те же массовые UPDATE
+	_mark_stale(ListingCard, now, ttl_days, archive_after_days)
+	db.session.commit()
+
+	archived = 0
+	last_id = 0
+	while True:
+		listing_ids = db.session.execute(
+			db.select(Listing.id)
+			.where(Listing.status == 'archived', Listing.id > last_id)
+			.order_by(Listing.id)
+			.limit(batch_size)
+		).scalars().all()
+		if not listing_ids:
+			break
+		move_to_archive(listing_ids, now)
+		db.session.commit()
+		archived += len(listing_ids)
+		last_id = listing_ids[-1]
+	return ArchiveResult(expired, archived)
+
+
+def archived_listing(listing_id: int):
+	return db.session.execute(
+		db.select(archived_listings).where(archived_listings.c.id == listing_id)
+	).first()
+
+
+def archived_images(listing_id: int) -> list:
+	return db.session.execute(
+		db.select(archived_listing_images)
+		.where(archived_listing_images.c.listing_id == listing_id)
+		.order_by(archived_listing_images.c.is_primary.desc(), archived_listing_images.c.id)
+	).all()
+
+
+def archived_listings_for(owner_id: int) -> list:
+	return db.session.execute(
+		db.select(archived_listings)
+		.where(archived_listings.c.owner_id == owner_id)
+		.order_by(archived_listings.c.archived_at.desc())
+	).all()
+
+
+def archived_chats_for(listing_id: int, user_id: int) -> list[ArchivedChat]:
+	chats = db.session.execute(
+		db.select(archived_chats).where(
+			archived_chats.c.listing_id == listing_id,
+			db.or_(archived_chats.c.buyer_id == user_id, archived_chats.c.seller_id == user_id),
+		)
+	).all()
+	if not chats:
+		return []
+	messages: dict[int, list] = {chat.id: [] for chat in chats}
+	for message in db.session.execute(
+		db.select(archived_messages)
+		.where(archived_messages.c.chat_id.in_(messages))
+		.order_by(archived_messages.c.created_at, archived_messages.c.id)
+	):
+		messages[message.chat_id].append(message)
+	return [ArchivedChat(chat, messages[chat.id]) for chat in chats]
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import time
+from typing import Callable, NamedTuple
+
+from flask import current_app
+
+from . import db
+from .models import BackfillCheckpoint
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_ROWS_PER_SECOND = 2000
+
+
+class Backfill(NamedTuple):
+	name: str
+	primary_key: object
+	process: Callable[[int, int], int]
+	batch_size: int
+	description: str
+
+
+class BackfillProgress(NamedTuple):
+	name: str
+	last_id: int
+	max_id: int
+	rows_done: int
+	rows_per_second: float
+	done: bool
+
+	@property
+	def percent(self) -> float:
+		return 100.0 if self.max_id <= 0 else min(100.0, 100.0 * max(self.last_id, 0) / self.max_id)
+
+	def __str__(self) -> str:
+		return (
+			f'{self.name}: id {self.last_id}/{self.max_id} ({self.percent:.1f}%), '
+			f'{self.rows_done} rows, {self.rows_per_second:.0f} rows/s'
+		)
+
+
+BACKFILLS: dict[str, Backfill] = {}
+
+
+def backfill(name: str, primary_key, batch_size: int = DEFAULT_BATCH_SIZE):
+	"""Регистрирует функцию process(start_id, end_id) -> rows, обрабатывающую строки с start_id < id <= end_id."""
+	def decorator(process):
+		BACKFILLS[name] = Backfill(name, primary_key, process, batch_size, (process.__doc__ or '').strip())
+		return process
+	return decorator
+
+
+def _start(job: Backfill, checkpoint: BackfillCheckpoint | None) -> BackfillCheckpoint:
+	low, high = db.session.execute(db.select(db.func.min(job.primary_key), db.func.max(job.primary_key))).one()
+	if checkpoint is None:
+		checkpoint = BackfillCheckpoint(name=job.name)
+		db.session.add(checkpoint)
+	checkpoint.last_id = (low or 1) - 1
+	checkpoint.max_id = high or 0
+	checkpoint.rows_done = 0
+	checkpoint.status = 'running'
+	db.session.commit()
+	return checkpoint
+
+
+def run_backfill(
+	name: str,
+	rows_per_second: float | None = None,
+	batch_size: int | None = None,
+	restart: bool = False,
+	max_seconds: float | None = None,
+	progress: Callable[[BackfillProgress], None] | None = None,
+	sleep: Callable[[float], None] = time.sleep,
+	clock: Callable[[], float] = time.monotonic,
+) -> BackfillProgress:
+	"""Выполняет backfill диапазонами первичного ключа с чекпоинтом после каждого пакета.
+
+	Граница max_id фиксируется при первом запуске: новые строки пишет уже обновлённый код.
+	Прерванный запуск продолжается с last_id, скорость ограничивается rows_per_second.
+	"""
+	job = BACKFILLS[name]
+	rows_per_second = rows_per_second or current_app.config.get('BACKFILL_ROWS_PER_SECOND', DEFAULT_ROWS_PER_SECOND)
+	batch_size = batch_size or job.batch_size
+
+	checkpoint = db.session.get(BackfillCheckpoint, name)
+	if checkpoint is None or restart:
+		checkpoint = _start(job, checkpoint)
+
+	started = clock()
+	processed = 0
+	while checkpoint.status != 'done' and checkpoint.last_id < checkpoint.max_id:
+		end_id = min(checkpoint.last_id + batch_size, checkpoint.max_id)
+		rows = job.process(checkpoint.last_id, end_id)
+		checkpoint.last_id = end_id
+		checkpoint.rows_done += rows
+		db.session.commit()
+		processed += rows
+
+		elapsed = clock() - started
+		if progress is not None:
+			progress(_progress(checkpoint, processed / elapsed if elapsed > 0 else 0.0))
+		if rows_per_second:
+			delay = processed / rows_per_second - elapsed
+			if delay > 0:
+				sleep(delay)
+		if max_seconds is not None and clock() - started >= max_seconds:
+			break
+
+	if checkpoint.last_id >= checkpoint.max_id and checkpoint.status != 'done':
+		checkpoint.status = 'done'
+		db.session.commit()
+	elapsed = clock() - started
+	return _progress(checkpoint, processed / elapsed if elapsed > 0 else 0.0)
+
+
+def _progress(checkpoint: BackfillCheckpoint, rate: float) -> BackfillProgress:
+	return BackfillProgress(
+		checkpoint.name, checkpoint.last_id, checkpoint.max_id, checkpoint.rows_done, rate, checkpoint.status == 'done'
+	)
+
+
+def backfill_status() -> list[tuple[Backfill, BackfillProgress | None]]:
+	checkpoints = {
+		checkpoint.name: checkpoint
+		for checkpoint in db.session.execute(db.select(BackfillCheckpoint)).scalars()
+	}
+	return [
+		(job, _progress(checkpoints[name], 0.0) if name in checkpoints else None)
+		for name, job in BACKFILLS.items()
+	]
+
+
+def run_pending_backfills(progress: Callable[[BackfillProgress], None] | None = None, **options) -> list[BackfillProgress]:
+	return [
+		run_backfill(job.name, progress=progress, **options)
+		for job, state in backfill_status()
+		if state is None or not state.done
+	]
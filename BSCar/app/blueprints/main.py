@@ -1,31 +1,42 @@
 from __future__ import annotations
 
-import os
-import uuid
+import zipfile
+from datetime import datetime
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app, send_from_directory
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, session, stream_with_context
 from .. import db
-from ..models import Listing, Favorite, Chat, User, Category, ListingImage, Message, Complaint, SupportTicket
+from ..models import Listing, ListingCard, Favorite, Chat, User, ListingImage, Message, Complaint, SupportTicket
+from ..archive import (
+    OWNER_STATUSES, archived_chats_for, archived_images, archived_listing, archived_listings_for,
+    set_listing_status,
+)
+from ..cards import card_query
+from ..categories import NEW_CATEGORY_NAME, USED_CATEGORY_NAME, get_category_tree, subtree_condition
+from ..duplicates import DUPLICATE_ACTIONS, duplicate_queue, review_duplicates
+from ..exports import EXPORT_FORMATS, EXPORTS, export_chunks, export_filename
+from ..geo import CITIES, RADIUS_CHOICES, parse_location, set_listing_location, within_radius
+from ..imports import feed_format, import_feed, open_photo_source
+from ..moderation import MODERATION_ACTIONS, apply_moderation, moderation_queue
+from ..pricing import price_badges
+from ..profiling import (
+    PROFILE_HEADER, PROFILE_MODES, clear_profiles, profile_file, profile_token, profiling_settings, recent_profiles,
+)
+from ..rankings import order_by_popularity
+from ..refcache import set_setting
+from ..rollups import dashboard, record_published_draft
+from ..searches import (
+    delete_search, inbox, mark_matches_seen, match_listing, save_search, saved_searches_for, unseen_match_count,
+)
+from ..similar import similar_listings
+from ..storage import AVATARS_PREFIX, LISTINGS_PREFIX, send_stored
+from ..suggest import MAX_SUGGESTIONS, suggest
+from ..support import TICKET_STATUSES, pending_ticket_count, reset_pending_count, ticket_counts, ticket_page
+from ..transcripts import chat_history
+from ..uploads import MAX_FILE_SIZE, UploadError, save_avatar, save_uploaded_file, start_upload, upload_state, write_chunk
+from ..viewcounts import record_view, view_counts
 
 
 bp = Blueprint('main', __name__)
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-MAX_FILE_SIZE = 5 * 1024 * 1024
-
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def save_uploaded_file(file, listing_id):
-    if file and allowed_file(file.filename):
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{listing_id}_{uuid.uuid4().hex}.{file_ext}"
-        upload_folder = os.path.join(current_app.static_folder, 'uploads', 'listings')
-        os.makedirs(upload_folder, exist_ok=True)
-        file_path = os.path.join(upload_folder, unique_filename)
-        file.save(file_path)
-        
-        return unique_filename
-    return None
 
 
 @bp.get('/')
@@ -34,65 +45,102 @@ def index():
         return redirect(url_for('main.login'))
     category_filter = request.args.get('category', 'all')
     search_query = request.args.get('search', '').strip()
-    query = db.select(Listing).options(db.joinedload(Listing.images))
+    sort = request.args.get('sort', 'new')
+    if sort not in ('new', 'popular', 'near'):
+        sort = 'new'
+    center = parse_location(request.args.get('city'), request.args.get('lat'), request.args.get('lon'))
+    radius = request.args.get('radius', type=int)
+    nearby = within_radius(center, radius) if center and radius in RADIUS_CHOICES else None
+    if sort == 'near' and not nearby:
+        sort = 'new'
+    tree = get_category_tree()
+    selected_category = tree.resolve_filter(category_filter)
+    query = card_query().where(ListingCard.status == 'active')
     if search_query:
-        query = query.where(Listing.title.ilike(f'%{search_query}%'))
-    if category_filter == 'new':
-        new_category = db.session.execute(db.select(Category).where(Category.name == 'Новые')).scalar_one_or_none()
-        if new_category:
-            query = query.where(Listing.category_id == new_category.id)
-    elif category_filter == 'used':
-        used_category = db.session.execute(db.select(Category).where(Category.name == 'Б/У')).scalar_one_or_none()
-        if used_category:
-            query = query.where(Listing.category_id == used_category.id)
+        query = query.where(ListingCard.title.ilike(f'%{search_query}%'))
+    if selected_category:
+        query = query.where(subtree_condition(selected_category, tree, ListingCard.category_id))
+    if nearby:
+        query = (
+            query.join(Listing, Listing.id == ListingCard.listing_id)
+            .where(nearby.condition())
+            .add_columns(nearby.distance().label('distance'))
+        )
+    min_price = request.args.get('min_price', type=int)
+    max_price = request.args.get('max_price', type=int)
+    if min_price is not None:
+        query = query.where(ListingCard.price >= min_price)
+    if max_price is not None:
+        query = query.where(ListingCard.price <= max_price)
+    
+    if sort == 'popular':
+        query = order_by_popularity(query, ListingCard.listing_id)
+    elif sort == 'near':
+        query = query.order_by(nearby.distance(), ListingCard.created_at.desc())
+    else:
+        query = query.order_by(ListingCard.created_at.desc())
     
-    listings = db.session.execute(
-        query.order_by(Listing.created_at.desc())
-    ).scalars().unique().all()
-    new_category = db.session.execute(db.select(Category).where(Category.name == 'Новые')).scalar_one_or_none()
-    used_category = db.session.execute(db.select(Category).where(Category.name == 'Б/У')).scalar_one_or_none()
+    listings = db.session.execute(query).all()
     
-    base_conditions = []
+    count_query = (
+        db.select(ListingCard.category_id, db.func.count(ListingCard.listing_id))
+        .where(ListingCard.status == 'active')
+        .group_by(ListingCard.category_id)
+    )
     if search_query:
-        base_conditions.append(Listing.title.ilike(f'%{search_query}%'))
-    
-    all_count_query = db.select(db.func.count(Listing.id))
-    if base_conditions:
-        all_count_query = all_count_query.where(*base_conditions)
-    
-    new_count_query = db.select(db.func.count(Listing.id))
-    if new_category:
-        new_conditions = [Listing.category_id == new_category.id]
-        if base_conditions:
-            new_conditions.extend(base_conditions)
-        new_count_query = new_count_query.where(*new_conditions)
-    else:
-        new_count_query = db.select(db.func.count(Listing.id)).where(False)
-    
-    used_count_query = db.select(db.func.count(Listing.id))
-    if used_category:
-        used_conditions = [Listing.category_id == used_category.id]
-        if base_conditions:
-            used_conditions.extend(base_conditions)
-        used_count_query = used_count_query.where(*used_conditions)
-    else:
-        used_count_query = db.select(db.func.count(Listing.id)).where(False)
+        count_query = count_query.where(ListingCard.title.ilike(f'%{search_query}%'))
+    if nearby:
+        count_query = count_query.where(nearby.condition(ListingCard.listing_id))
+    if min_price is not None:
+        count_query = count_query.where(ListingCard.price >= min_price)
+    if max_price is not None:
+        count_query = count_query.where(ListingCard.price <= max_price)
+    counts = dict(db.session.execute(count_query).all())
     
     stats = {
-        'all': db.session.execute(all_count_query).scalar() or 0,
-        'new': db.session.execute(new_count_query).scalar() or 0,
-        'used': db.session.execute(used_count_query).scalar() or 0
+        'all': sum(counts.values()),
+        'new': tree.count_under(tree.find(NEW_CATEGORY_NAME), counts),
+        'used': tree.count_under(tree.find(USED_CATEGORY_NAME), counts),
+        'selected': tree.count_under(selected_category, counts)
     }
     
     return render_template('index.html', 
                          title='BSCar', 
-                         mode='listings', 
                          listings=listings, 
+                         badges=price_badges(listings),
                          current_filter=category_filter, 
                          search_query=search_query,
+                         current_sort=sort,
+                         cities=CITIES,
+                         radius_choices=RADIUS_CHOICES,
+                         current_city=center.city if nearby else None,
+                         current_radius=radius if nearby else None,
+                         distances={item.id: item.distance for item in listings} if nearby else None,
+                         min_price=min_price,
+                         max_price=max_price,
+                         selected_category=selected_category,
+                         category_path=tree.ancestors(selected_category.id) if selected_category else [],
                          stats=stats)
 
 
+@bp.get('/suggest')
+def suggest_search():
+    if 'user_id' not in session:
+        return {'error': 'unauthorized'}, 401
+    
+    suggestions = [
+        {
+            'text': item.text,
+            'count': item.count,
+            'kind': 'category' if item.category_id else 'title',
+            'url': url_for('main.index', category=item.category_id) if item.category_id
+                   else url_for('main.index', search=item.text),
+        }
+        for item in suggest(request.args.get('q', ''), request.args.get('limit', MAX_SUGGESTIONS, type=int))
+    ]
+    return {'suggestions': suggestions}
+
+
 @bp.get('/favorites')
 def favorites():
     if 'user_id' not in session:
@@ -102,14 +150,58 @@ def favorites():
     if user_id:
         listings = (
             db.session.execute(
-                db.select(Listing)
-                .options(db.joinedload(Listing.images))
-                .join(Favorite, Favorite.listing_id == Listing.id)
+                card_query()
+                .join(Favorite, Favorite.listing_id == ListingCard.listing_id)
                 .where(Favorite.user_id == user_id)
-                .order_by(Listing.created_at.desc())
-            ).scalars().unique().all()
+                .order_by(ListingCard.created_at.desc())
+            ).all()
         )
-    return render_template('index.html', title='Избранное', mode='favorites', listings=listings)
+    return render_template('favorites.html', title='Избранное', listings=listings)
+
+
+@bp.get('/searches')
+def saved_searches():
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user_id = session['user_id']
+    matches = inbox(user_id)
+    unseen = {match.id for match in matches if match.seen_at is None}
+    mark_matches_seen(user_id)
+    return render_template('saved_searches.html',
+                         title='Сохранённые поиски',
+                         searches=saved_searches_for(user_id),
+                         matches=matches,
+                         unseen=unseen)
+
+
+@bp.post('/searches')
+def save_search_route():
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    
+    query = request.form.get('search', '').strip()
+    category = get_category_tree().resolve_filter(request.form.get('category'))
+    min_price = request.form.get('min_price', type=int)
+    max_price = request.form.get('max_price', type=int)
+    
+    try:
+        save_search(session['user_id'], query, category.id if category else None, min_price, max_price)
+    except ValueError as error:
+        flash(str(error))
+    else:
+        flash('Поиск сохранён: новые объявления появятся во входящих', 'success')
+    return redirect(url_for('main.saved_searches'))
+
+
+@bp.post('/searches/<int:search_id>/delete')
+def delete_search_route(search_id):
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    if delete_search(session['user_id'], search_id):
+        flash('Поиск удалён', 'success')
+    else:
+        flash('Поиск не найден')
+    return redirect(url_for('main.saved_searches'))
 
 
 @bp.get('/chats')
@@ -127,7 +219,7 @@ def chats():
                 .order_by(Chat.updated_at.desc())
             ).scalars().unique().all()
         )
-    return render_template('index.html', title='Чаты', mode='chats', chats=threads)
+    return render_template('chats.html', title='Чаты', chats=threads)
 
 
 @bp.get('/chats/<int:chat_id>')
@@ -144,7 +236,6 @@ def view_chat(chat_id):
             db.joinedload(Chat.listing),
             db.joinedload(Chat.buyer),
             db.joinedload(Chat.seller),
-            db.joinedload(Chat.messages).joinedload(Message.author)
         )
         .where(Chat.id == chat_id)
     ).scalars().unique().first()
@@ -162,10 +253,13 @@ def view_chat(chat_id):
     else:
         other_user = chat.buyer
     
-    return render_template('index.html', 
+    history = chat_history(chat.id, before=request.args.get('before', type=int))
+    
+    return render_template('chat_detail.html', 
                          title=f'Чат с {other_user.name or other_user.email}', 
-                         mode='chat_detail', 
                          chat=chat, 
+                         messages=history.messages,
+                         older_before=history.before,
                          other_user=other_user)
 
 
@@ -210,14 +304,14 @@ def account():
     if 'user_id' not in session:
         return redirect(url_for('main.login'))
     user = db.session.get(User, session['user_id'])
-    return render_template('account.html', title='Аккаунт', user=user)
+    return render_template('account.html', title='Аккаунт', user=user, unseen_matches=unseen_match_count(user.id))
 
 @bp.get('/account/edit')
 def edit_profile():
     if 'user_id' not in session:
         return redirect(url_for('main.login'))
     user = db.session.get(User, session['user_id'])
-    return render_template('index.html', title='Изменить профиль', mode='account_edit', user=user)
+    return render_template('account_edit.html', title='Изменить профиль', user=user)
 
 @bp.post('/account/edit')
 def edit_profile_post():
@@ -242,12 +336,7 @@ def edit_profile_post():
         user.email = email
 
     if avatar_file and avatar_file.filename:
-        upload_folder = os.path.join(current_app.static_folder, 'uploads', 'avatars')
-        os.makedirs(upload_folder, exist_ok=True)
-        ext = avatar_file.filename.rsplit('.', 1)[-1].lower()
-        filename = f"user_{user.id}_{uuid.uuid4().hex}.{ext}"
-        avatar_file.save(os.path.join(upload_folder, filename))
-        user.avatar_filename = filename
+        user.avatar_filename = save_avatar(avatar_file, user.id)
 
     db.session.commit()
     flash('Профиль обновлён', 'success')
@@ -265,7 +354,226 @@ def admin_panel():
     listings = db.session.execute(
         db.select(Listing).order_by(Listing.created_at.desc()).limit(20)
     ).scalars().all()
-    return render_template('index.html', title='Админ-панель', mode='admin', listings=listings)
+    reported_listings = db.session.execute(
+        db.select(db.func.count(db.distinct(Complaint.listing_id))).where(Complaint.status == 'pending')
+    ).scalar() or 0
+    return render_template('admin.html', title='Админ-панель', listings=listings, reported_listings=reported_listings,
+                         stats=dashboard())
+
+
+@bp.get('/admin/moderation')
+def moderation():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    page = request.args.get('page', 1, type=int)
+    queue = moderation_queue(page)
+    duplicates, duplicate_total = duplicate_queue()
+    return render_template('moderation.html', title='Модерация', queue=queue,
+                         duplicates=duplicates, duplicate_total=duplicate_total)
+
+
+@bp.post('/admin/moderation')
+def moderate_listings():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    page = request.form.get('page', 1, type=int)
+    action = request.form.get('action')
+    reason = request.form.get('reason', '').strip()
+    listing_ids = request.form.getlist('listing_ids', type=int)
+    
+    if action not in MODERATION_ACTIONS:
+        flash('Неизвестное действие')
+        return redirect(url_for('main.moderation', page=page))
+    
+    if not listing_ids:
+        flash('Выберите хотя бы одно объявление')
+        return redirect(url_for('main.moderation', page=page))
+    
+    count = apply_moderation(user.id, listing_ids, action, reason or None)
+    flash(f'Обработано объявлений: {count}', 'success')
+    return redirect(url_for('main.moderation', page=page))
+
+
+@bp.post('/admin/duplicates')
+def review_duplicate_images():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    action = request.form.get('action')
+    duplicate_ids = request.form.getlist('duplicate_ids', type=int)
+    if action not in DUPLICATE_ACTIONS:
+        flash('Неизвестное действие')
+        return redirect(url_for('main.moderation'))
+    if not duplicate_ids:
+        flash('Выберите хотя бы одну пару фото')
+        return redirect(url_for('main.moderation'))
+    
+    listing_ids = review_duplicates(duplicate_ids, action)
+    if listing_ids:
+        count = apply_moderation(user.id, listing_ids, 'delete', 'повтор чужих фото')
+        flash(f'Удалено объявлений: {count}', 'success')
+    else:
+        flash(f'Отмечено пар: {len(duplicate_ids)}', 'success')
+    return redirect(url_for('main.moderation'))
+
+
+@bp.get('/admin/export/<kind>')
+def export_data(kind):
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    fmt = request.args.get('format', 'csv')
+    gzip = request.args.get('gzip') == '1'
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS:
+        flash('Неизвестный формат выгрузки')
+        return redirect(url_for('main.admin_panel'))
+    
+    response = Response(
+        stream_with_context(export_chunks(kind, fmt, gzip)),
+        mimetype='application/gzip' if gzip else EXPORT_FORMATS[fmt],
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={export_filename(kind, fmt, gzip)}'
+    return response
+
+
+@bp.get('/admin/profiles')
+def profiles():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    return render_template('profiles.html',
+                         title='Профилирование',
+                         settings=profiling_settings(),
+                         modes=PROFILE_MODES,
+                         header=PROFILE_HEADER,
+                         profiles=recent_profiles())
+
+
+@bp.post('/admin/profiles')
+def update_profiling():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    action = request.form.get('action')
+    if action == 'settings':
+        rate = request.form.get('sample_rate', type=float)
+        mode = request.form.get('mode')
+        if rate is None or not 0 <= rate <= 1 or mode not in PROFILE_MODES:
+            flash('Доля запросов должна быть от 0 до 1')
+            return redirect(url_for('main.profiles'))
+        endpoints = ','.join(name.strip() for name in request.form.get('endpoints', '').split(',') if name.strip())
+        set_setting('profiling.sample_rate', str(rate) if rate else None)
+        set_setting('profiling.mode', mode)
+        set_setting('profiling.endpoints', endpoints or None)
+        flash('Профилирование включено' if rate else 'Выборочное профилирование выключено', 'success')
+    elif action == 'token':
+        flash(f'{PROFILE_HEADER}: {profile_token(user.id)}', 'success')
+    elif action == 'clear':
+        flash(f'Удалено профилей: {clear_profiles()}', 'success')
+    else:
+        flash('Неизвестное действие')
+    return redirect(url_for('main.profiles'))
+
+
+@bp.get('/admin/profiles/<int:profile_id>')
+def download_profile(profile_id):
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    found = profile_file(profile_id)
+    if found is None:
+        flash('Профиль не найден')
+        return redirect(url_for('main.profiles'))
+    filename, mimetype, data = found
+    response = Response(data, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
+@bp.get('/admin/import')
+def import_listings():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    return render_template('import_listings.html', title='Импорт объявлений', report=None)
+
+
+@bp.post('/admin/import')
+def import_listings_post():
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        flash('Доступ запрещен')
+        return redirect(url_for('main.index'))
+    
+    dealer_email = request.form.get('dealer_email', '').strip()
+    feed = request.files.get('feed')
+    if not feed or not feed.filename:
+        flash('Выберите файл с объявлениями')
+        return redirect(url_for('main.import_listings'))
+    
+    dealer = db.session.execute(db.select(User).where(User.email == dealer_email)).scalar_one_or_none()
+    if not dealer:
+        flash('Дилер с таким email не найден')
+        return redirect(url_for('main.import_listings'))
+    
+    try:
+        photos = open_photo_source(request.files.get('photos'))
+    except zipfile.BadZipFile:
+        flash('Архив с фотографиями повреждён')
+        return redirect(url_for('main.import_listings'))
+    
+    try:
+        report = import_feed(feed.stream, feed_format(feed.filename, request.form.get('format', 'csv')), dealer.id, photos)
+    finally:
+        if photos is not None:
+            photos.close()
+    
+    return render_template('import_listings.html', title='Импорт объявлений', report=report, dealer_email=dealer_email)
 
 
 @bp.get('/my-listings')
@@ -277,21 +585,24 @@ def my_listings():
     if user_id:
         listings = (
             db.session.execute(
-                db.select(Listing)
-                .options(db.joinedload(Listing.images))
-                .where(Listing.owner_id == user_id)
-                .order_by(Listing.created_at.desc())
-            ).scalars().unique().all()
+                card_query()
+                .where(ListingCard.owner_id == user_id)
+                .order_by(ListingCard.created_at.desc())
+            ).all()
         )
-    return render_template('index.html', title='Мои объявления', mode='my', listings=listings)
+    return render_template('my_listings.html', 
+                         title='Мои объявления', 
+                         listings=listings,
+                         views=view_counts(item.id for item in listings),
+                         archived=archived_listings_for(user_id))
 
 
 @bp.get('/listings/new')
 def new_listing():
     if 'user_id' not in session:
         return redirect(url_for('main.login'))
-    categories = db.session.execute(db.select(Category)).scalars().all()
-    return render_template('index.html', title='Создать объявление', mode='new', categories=categories)
+    categories = get_category_tree().walk()
+    return render_template('new_listing.html', title='Создать объявление', categories=categories, cities=CITIES)
 
 
 @bp.post('/listings/new')
@@ -314,20 +625,37 @@ def create_listing():
         flash('Неверный формат цены')
         return redirect(url_for('main.new_listing'))
     
-    listing = Listing(
-        title=title,
-        description=description,
-        price=price,
-        category_id=int(category_id) if category_id else None,
-        owner_id=session['user_id'],
-        status='active'
-    )
+    location = parse_location(request.form.get('city'), request.form.get('latitude'), request.form.get('longitude'))
+    
+    draft_id = request.form.get('draft_id', type=int)
+    listing = db.session.get(Listing, draft_id) if draft_id else None
+    if listing and listing.owner_id == session['user_id'] and listing.status == 'draft':
+        listing.title = title
+        listing.description = description
+        listing.price = price
+        listing.category_id = int(category_id) if category_id else None
+        listing.status = 'active'
+        listing.created_at = datetime.utcnow()
+        set_listing_location(listing, location)
+        record_published_draft(listing)
+    else:
+        listing = Listing(
+            title=title,
+            description=description,
+            price=price,
+            category_id=int(category_id) if category_id else None,
+            owner_id=session['user_id'],
+            status='active'
+        )
+        set_listing_location(listing, location)
+        db.session.add(listing)
     
-    db.session.add(listing)
     db.session.flush()
     
     uploaded_files = request.files.getlist('images')
-    primary_image_set = False
+    primary_image_set = db.session.execute(
+        db.select(ListingImage.id).where(ListingImage.listing_id == listing.id, ListingImage.is_primary)
+    ).first() is not None
     
     for i, file in enumerate(uploaded_files):
         if file and file.filename:
@@ -354,11 +682,61 @@ def create_listing():
                 db.session.add(image)
     
     db.session.commit()
+    match_listing(listing)
     
     flash('Объявление успешно создано!', 'success')
     return redirect(url_for('main.my_listings'))
 
 
+@bp.post('/uploads')
+def create_upload():
+    
+    if 'user_id' not in session:
+        return {'error': 'unauthorized'}, 401
+    
+    try:
+        state = start_upload(
+            session['user_id'],
+            request.form.get('filename', ''),
+            request.form.get('size', 0, type=int),
+            request.form.get('draft_id', type=int),
+        )
+    except UploadError as exc:
+        return {'error': str(exc)}, exc.status
+    return state, 201
+
+
+@bp.get('/uploads/<upload_id>')
+def upload_status(upload_id):
+    
+    if 'user_id' not in session:
+        return {'error': 'unauthorized'}, 401
+    
+    try:
+        return upload_state(session['user_id'], upload_id)
+    except UploadError as exc:
+        return {'error': str(exc)}, exc.status
+
+
+@bp.put('/uploads/<upload_id>')
+def upload_chunk(upload_id):
+    
+    if 'user_id' not in session:
+        return {'error': 'unauthorized'}, 401
+    
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return {'error': 'offset is required'}, 400
+    
+    try:
+        return write_chunk(session['user_id'], upload_id, offset, request.stream, request.content_length)
+    except UploadError as exc:
+        state = {'error': str(exc)}
+        if exc.status == 409:
+            state.update(upload_state(session['user_id'], upload_id))
+        return state, exc.status
+
+
 @bp.get('/login')
 def login():
     if 'user_id' in session:
@@ -401,13 +779,7 @@ def register_post():
     
     user = User(email=email, password_hash=password, name=name, role='user')
     if avatar_file and avatar_file.filename:
-        upload_folder = os.path.join(current_app.static_folder, 'uploads', 'avatars')
-        os.makedirs(upload_folder, exist_ok=True)
-        ext = avatar_file.filename.rsplit('.', 1)[-1].lower()
-        filename = f"user_{uuid.uuid4().hex}.{ext}"
-        avatar_path = os.path.join(upload_folder, filename)
-        avatar_file.save(avatar_path)
-        user.avatar_filename = filename
+        user.avatar_filename = save_avatar(avatar_file)
     db.session.add(user)
     db.session.commit()
     
@@ -438,6 +810,13 @@ def view_listing(listing_id):
     ).scalars().unique().first()
     
     if not listing:
+        archived = archived_listing(listing_id)
+        if archived:
+            return render_template('archived_listing.html',
+                                 title=archived.title,
+                                 listing=archived,
+                                 images=archived_images(listing_id),
+                                 chats=archived_chats_for(listing_id, session['user_id']))
         flash('Объявление не найдено')
         return redirect(url_for('main.index'))
     
@@ -452,11 +831,22 @@ def view_listing(listing_id):
         ).scalar_one_or_none()
         is_favorited = favorite is not None
     
-    return render_template('index.html', 
+    view_count = None
+    if listing.owner_id == user_id:
+        view_count = view_counts([listing.id])[listing.id]
+    else:
+        record_view(listing.id)
+        viewer = db.session.get(User, user_id)
+        if viewer and viewer.role == 'admin':
+            view_count = view_counts([listing.id])[listing.id]
+    
+    return render_template('listing_detail.html', 
                          title=listing.title, 
-                         mode='listing_detail', 
                          listing=listing, 
-                         is_favorited=is_favorited)
+                         is_favorited=is_favorited,
+                         view_count=view_count,
+                         fair_price=price_badges([listing]).get(listing.id),
+                         similar=similar_listings(listing.id))
 
 
 @bp.post('/listings/<int:listing_id>/favorite')
@@ -492,6 +882,28 @@ def toggle_favorite(listing_id):
     return redirect(url_for('main.view_listing', listing_id=listing_id))
 
 
+@bp.post('/listings/<int:listing_id>/status')
+def change_listing_status(listing_id):
+    
+    if 'user_id' not in session:
+        return redirect(url_for('main.login'))
+    
+    listing = db.session.get(Listing, listing_id)
+    if not listing or listing.owner_id != session['user_id'] or listing.status == 'draft':
+        flash('Объявление не найдено')
+        return redirect(url_for('main.my_listings'))
+    
+    status = request.form.get('status')
+    if status not in OWNER_STATUSES:
+        flash('Неизвестный статус')
+        return redirect(url_for('main.view_listing', listing_id=listing_id))
+    
+    set_listing_status(listing, status)
+    db.session.commit()
+    flash('Статус объявления обновлён', 'success')
+    return redirect(url_for('main.view_listing', listing_id=listing_id))
+
+
 @bp.post('/listings/<int:listing_id>/contact')
 def contact_seller(listing_id):
     
@@ -509,6 +921,10 @@ def contact_seller(listing_id):
         flash('Нельзя написать самому себе')
         return redirect(url_for('main.view_listing', listing_id=listing_id))
     
+    if listing.status != 'active':
+        flash('Объявление снято с продажи')
+        return redirect(url_for('main.view_listing', listing_id=listing_id))
+    
     existing_chat = db.session.execute(
         db.select(Chat).where(
             Chat.listing_id == listing_id,
@@ -629,34 +1045,7 @@ def delete_listing():
         return redirect(url_for('main.admin_panel'))
     
     listing_title = listing.title
-    
-    chats = db.session.execute(
-        db.select(Chat).where(Chat.listing_id == listing_id)
-    ).scalars().all()
-    
-    for chat in chats:
-        db.session.execute(
-            db.delete(Message).where(Message.chat_id == chat.id)
-        )
-    
-    db.session.execute(
-        db.delete(Chat).where(Chat.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(Complaint).where(Complaint.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(Favorite).where(Favorite.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(ListingImage).where(ListingImage.listing_id == listing_id)
-    )
-    
-    db.session.delete(listing)
-    db.session.commit()
+    apply_moderation(user.id, [listing_id], 'delete', reason)
     
     flash(f'Объявление "{listing_title}" удалено', 'success')
     return redirect(url_for('main.admin_panel'))
@@ -733,34 +1122,7 @@ def delete_listing_admin():
         return redirect(url_for('main.index'))
     
     listing_title = listing.title
-    
-    chats = db.session.execute(
-        db.select(Chat).where(Chat.listing_id == listing_id)
-    ).scalars().all()
-    
-    for chat in chats:
-        db.session.execute(
-            db.delete(Message).where(Message.chat_id == chat.id)
-        )
-    
-    db.session.execute(
-        db.delete(Chat).where(Chat.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(Complaint).where(Complaint.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(Favorite).where(Favorite.listing_id == listing_id)
-    )
-    
-    db.session.execute(
-        db.delete(ListingImage).where(ListingImage.listing_id == listing_id)
-    )
-    
-    db.session.delete(listing)
-    db.session.commit()
+    apply_moderation(user.id, [listing_id], 'delete', reason)
     
     flash(f'Объявление "{listing_title}" удалено', 'success')
     return redirect(url_for('main.index'))
@@ -777,24 +1139,26 @@ def support():
         return redirect(url_for('main.login'))
     
     if user.role == 'admin':
-        support_tickets = db.session.execute(
-            db.select(SupportTicket)
-            .options(db.joinedload(SupportTicket.user))
-            .order_by(SupportTicket.created_at.desc())
-        ).scalars().all()
-        return render_template('index.html', 
+        status = request.args.get('status', 'all')
+        if status not in TICKET_STATUSES:
+            status = 'all'
+        cursor = request.args.get('cursor')
+        page = ticket_page(status, cursor)
+        return render_template('support.html', 
                              title='Техподдержка', 
-                             mode='support', 
-                             support_tickets=support_tickets)
+                             support_tickets=page.tickets,
+                             next_cursor=page.next_cursor,
+                             is_first_page=not cursor,
+                             ticket_status=status,
+                             ticket_counts=ticket_counts())
     else:
         user_tickets = db.session.execute(
             db.select(SupportTicket)
             .where(SupportTicket.user_id == user.id)
             .order_by(SupportTicket.created_at.desc())
         ).scalars().all()
-        return render_template('index.html', 
+        return render_template('support.html', 
                              title='Техподдержка', 
-                             mode='support', 
                              user_tickets=user_tickets)
 
 
@@ -820,6 +1184,7 @@ def create_support_ticket():
     )
     db.session.add(ticket)
     db.session.commit()
+    reset_pending_count()
     
     flash('Обращение отправлено в техподдержку', 'success')
     return redirect(url_for('main.support'))
@@ -849,15 +1214,30 @@ def reply_support(ticket_id):
     ticket.reply = reply
     ticket.status = 'answered'
     db.session.commit()
+    reset_pending_count()
     
     flash('Ответ отправлен пользователю', 'success')
     return redirect(url_for('main.support'))
 
 
+@bp.get('/admin/support/pending-count')
+def support_pending_count():
+    
+    if 'user_id' not in session:
+        return {'error': 'unauthorized'}, 401
+    
+    user = db.session.get(User, session['user_id'])
+    if not user or user.role != 'admin':
+        return {'error': 'forbidden'}, 403
+    
+    return {'pending': pending_ticket_count()}
+
+
 @bp.get('/uploads/listings/<filename>')
 def uploaded_file(filename):
-    
-    return send_from_directory(
-        os.path.join(current_app.static_folder, 'uploads', 'listings'),
-        filename
-    )
+    return send_stored(LISTINGS_PREFIX, filename)
+
+
+@bp.get('/uploads/avatars/<filename>')
+def avatar_file(filename):
+    return send_stored(AVATARS_PREFIX, filename)
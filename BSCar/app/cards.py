@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+from itertools import chain
+from typing import Iterable
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Category, Listing, ListingCard, ListingImage, User
+
+
+# На один символ длиннее видимого анонса: по длине шаблон понимает, нужно ли многоточие
+SUMMARY_LENGTH = 101
+REFRESH_CHUNK = 500
+
+CARD_FIELDS = (
+	ListingCard.listing_id.label('id'),
+	ListingCard.title,
+	ListingCard.price,
+	ListingCard.status,
+	ListingCard.summary,
+	ListingCard.category_id,
+	ListingCard.category_name,
+	ListingCard.thumbnail,
+	ListingCard.owner_id,
+	ListingCard.owner_name,
+	ListingCard.city,
+	ListingCard.created_at,
+	ListingCard.updated_at,
+)
+
+
+def card_query():
+	"""Карточки для списков: одна узкая строка на объявление, без ORM-объектов и joinedload."""
+	return db.select(*CARD_FIELDS)
+
+
+def _card_source():
+	thumbnail = (
+		db.select(ListingImage.filename)
+		.where(ListingImage.listing_id == Listing.id)
+		.order_by(ListingImage.is_primary.desc(), ListingImage.id)
+		.limit(1)
+		.scalar_subquery()
+	)
+	return (
+		db.select(
+			Listing.id,
+			Listing.title,
+			Listing.price,
+			Listing.status,
+			db.func.substr(Listing.description, 1, SUMMARY_LENGTH),
+			Listing.category_id,
+			Category.name,
+			thumbnail,
+			Listing.owner_id,
+			db.func.coalesce(User.name, User.email),
+			Listing.city,
+			Listing.created_at,
+			Listing.updated_at,
+		)
+		.join(User, User.id == Listing.owner_id)
+		.join(Category, Category.id == Listing.category_id, isouter=True)
+	)
+
+
+_CARD_COLUMNS = [
+	'listing_id', 'title', 'price', 'status', 'summary', 'category_id', 'category_name', 'thumbnail',
+	'owner_id', 'owner_name', 'city', 'created_at', 'updated_at',
+]
+
+
+def refresh_cards(listing_ids: Iterable[int], session: Session | None = None) -> None:
+	"""Пересобирает карточки объявлений; карточки удалённых объявлений исчезают."""
+	session = session or db.session
+	ids = sorted({listing_id for listing_id in listing_ids if listing_id is not None})
+	for start in range(0, len(ids), REFRESH_CHUNK):
+		chunk = ids[start:start + REFRESH_CHUNK]
+		session.execute(db.delete(ListingCard).where(ListingCard.listing_id.in_(chunk)))
+		session.execute(
+			db.insert(ListingCard).from_select(_CARD_COLUMNS, _card_source().where(Listing.id.in_(chunk)))
+		)
+
+
+def rebuild_cards(start_id: int, end_id: int) -> int:
+	"""Карточки объявлений для списков (listing_cards)."""
+	ids = db.session.execute(
+		db.select(Listing.id).where(Listing.id > start_id, Listing.id <= end_id)
+	).scalars().all()
+	refresh_cards(ids)
+	return len(ids)
+
+
+def mark_cards_dirty(listing_ids: Iterable[int], session: Session | None = None) -> None:
+	"""Для изменений в обход ORM (массовые UPDATE/INSERT): карточки пересоберутся перед commit."""
+	(session or db.session).info.setdefault('cards_dirty', set()).update(listing_ids)
+
+
+def _changed(obj, attribute: str) -> bool:
+	return inspect(obj).attrs[attribute].history.has_changes()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_card_changes(session, flush_context):
+	dirty = session.info.setdefault('cards_dirty', set())
+	for obj in chain(session.new, session.dirty, session.deleted):
+		if isinstance(obj, Listing):
+			dirty.add(obj.id)
+		elif isinstance(obj, ListingImage):
+			dirty.add(obj.listing_id)
+		elif isinstance(obj, User) and obj not in session.new and (_changed(obj, 'name') or _changed(obj, 'email')):
+			session.info.setdefault('card_owners', set()).add(obj.id)
+		elif isinstance(obj, Category) and obj not in session.new and _changed(obj, 'name'):
+			session.info.setdefault('card_categories', set()).add(obj.id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _refresh_dirty_cards(session):
+	session.flush()
+	dirty = session.info.pop('cards_dirty', set())
+	owners = session.info.pop('card_owners', set())
+	categories = session.info.pop('card_categories', set())
+	if owners:
+		dirty.update(session.execute(db.select(Listing.id).where(Listing.owner_id.in_(owners))).scalars())
+	if categories:
+		dirty.update(session.execute(db.select(Listing.id).where(Listing.category_id.in_(categories))).scalars())
+	if dirty:
+		refresh_cards(dirty, session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_card_changes(session):
+	for key in ('cards_dirty', 'card_owners', 'card_categories'):
+		session.info.pop(key, None)
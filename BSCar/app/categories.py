@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from typing import NamedTuple
+
+from sqlalchemy import event, inspect, literal
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import db
+from .models import Category, Listing
+from .refcache import bump_version, invalidate, reference, register_reference
+
+
+NEW_CATEGORY_NAME = 'Новые'
+USED_CATEGORY_NAME = 'Б/У'
+FILTER_ALIASES = {'new': NEW_CATEGORY_NAME, 'used': USED_CATEGORY_NAME}
+
+
+class CategoryNode(NamedTuple):
+	id: int
+	name: str
+	parent_id: int | None
+	path: str
+
+	@property
+	def depth(self) -> int:
+		return self.path.count('/') - 2
+
+
+class CategoryTree:
+	"""Неизменяемый снимок дерева категорий (марка → модель → поколение)."""
+
+	def __init__(self, nodes: list[CategoryNode]):
+		self.nodes = {node.id: node for node in nodes}
+		self.by_name = {node.name: node for node in nodes}
+		self.children: dict[int | None, list[CategoryNode]] = {}
+		for node in sorted(nodes, key=lambda n: n.name):
+			self.children.setdefault(node.parent_id, []).append(node)
+
+	def get(self, category_id: int | None) -> CategoryNode | None:
+		return self.nodes.get(category_id)
+
+	def find(self, name: str) -> CategoryNode | None:
+		return self.by_name.get(name)
+
+	def roots(self) -> list[CategoryNode]:
+		return self.children.get(None, [])
+
+	def resolve_filter(self, value: str | None) -> CategoryNode | None:
+		if not value or value == 'all':
+			return None
+		if value in FILTER_ALIASES:
+			return self.find(FILTER_ALIASES[value])
+		if value.isdigit():
+			return self.get(int(value))
+		return None
+
+	def walk(self, parent_id: int | None = None) -> list[CategoryNode]:
+		result = []
+		stack = list(reversed(self.children.get(parent_id, [])))
+		while stack:
+			node = stack.pop()
+			result.append(node)
+			stack.extend(reversed(self.children.get(node.id, [])))
+		return result
+
+	def subtree_ids(self, category_id: int) -> list[int]:
+		if category_id not in self.nodes:
+			return []
+		return [category_id] + [node.id for node in self.walk(category_id)]
+
+	def ancestors(self, category_id: int) -> list[CategoryNode]:
+		node = self.get(category_id)
+		if node is None:
+			return []
+		ids = [int(part) for part in node.path.strip('/').split('/') if part]
+		return [self.nodes[i] for i in ids if i in self.nodes]
+
+	def count_under(self, node: CategoryNode | None, counts: dict[int | None, int]) -> int:
+		if node is None:
+			return 0
+		return sum(counts.get(category_id, 0) for category_id in self.subtree_ids(node.id))
+
+
+def subtree_condition(node: CategoryNode, tree: CategoryTree, column=Listing.category_id):
+	return column.in_(tree.subtree_ids(node.id))
+
+
+def load_category_tree() -> CategoryTree:
+	rows = db.session.execute(
+		db.select(Category.id, Category.name, Category.parent_id, Category.path)
+	).all()
+	nodes = [
+		CategoryNode(row.id, row.name, row.parent_id, row.path or f'/{row.id}/')
+		for row in rows
+	]
+	return CategoryTree(nodes)
+
+
+register_reference('categories', load_category_tree, models=(Category,))
+
+
+def get_category_tree() -> CategoryTree:
+	return reference('categories')
+
+
+def invalidate_category_tree() -> None:
+	invalidate('categories')
+
+
+def _parent_path(connection, parent_id: int | None) -> str:
+	if parent_id is None:
+		return '/'
+	table = Category.__table__
+	path = connection.execute(
+		db.select(table.c.path).where(table.c.id == parent_id)
+	).scalar()
+	return path or f'/{parent_id}/'
+
+
+@event.listens_for(Category, 'after_insert')
+def _assign_category_path(mapper, connection, target):
+	table = Category.__table__
+	path = f'{_parent_path(connection, target.parent_id)}{target.id}/'
+	connection.execute(db.update(table).where(table.c.id == target.id).values(path=path))
+	set_committed_value(target, 'path', path)
+
+
+@event.listens_for(Category, 'after_update')
+def _move_category_subtree(mapper, connection, target):
+	history = inspect(target).attrs.parent_id.history
+	if not history.has_changes():
+		return
+	table = Category.__table__
+	old_path = target.path or f'/{target.id}/'
+	new_path = f'{_parent_path(connection, target.parent_id)}{target.id}/'
+	if new_path.startswith(old_path) and new_path != old_path:
+		raise ValueError('Category cannot be moved under its own descendant')
+	connection.execute(
+		db.update(table)
+		.where(table.c.path.like(f'{old_path}%'))
+		.values(path=literal(new_path) + db.func.substr(table.c.path, len(old_path) + 1))
+	)
+	set_committed_value(target, 'path', new_path)
+
+
+def rebuild_category_paths() -> int:
+	rows = db.session.execute(db.select(Category.id, Category.parent_id)).all()
+	children: dict[int | None, list[int]] = {}
+	for row in rows:
+		children.setdefault(row.parent_id, []).append(row.id)
+	paths = {}
+	stack = [(category_id, '/') for category_id in children.get(None, [])]
+	while stack:
+		category_id, prefix = stack.pop()
+		paths[category_id] = f'{prefix}{category_id}/'
+		stack.extend((child, paths[category_id]) for child in children.get(category_id, []))
+	if paths:
+		db.session.execute(
+			db.update(Category),
+			[{'id': category_id, 'path': path} for category_id, path in paths.items()],
+		)
+		bump_version('categories')
+	db.session.commit()
+	return len(paths)
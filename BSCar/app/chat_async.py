@@ -0,0 +1,448 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import re
+from collections import Counter
+from datetime import datetime
+from http.cookies import SimpleCookie
+from typing import Awaitable, Callable
+from urllib.parse import parse_qs
+
+from flask import Flask
+from itsdangerous import BadSignature
+from sqlalchemy import make_url
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+
+from . import db
+from .models import Chat, Listing, Message, MessageBlock, User
+from .ratelimit import limit_rules
+from .transcripts import CHAT_PAGE_SIZE, unpack_block
+
+
+DEFAULT_PREFIX = '/async'
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_KEEPALIVE = 25.0
+# Тот же лимит, что у синхронной отправки: счётчики общие
+SEND_MESSAGE_ENDPOINT = 'main.send_message'
+MAX_MESSAGE_BODY = 16 * 1024
+ASYNC_DRIVERS = {'mysql': 'aiomysql', 'sqlite': 'aiosqlite'}
+
+Scope = dict
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+
+class HTTPError(Exception):
+	def __init__(self, status: int, message: str, headers: list[tuple[bytes, bytes]] | None = None):
+		super().__init__(message)
+		self.status = status
+		self.message = message
+		self.headers = headers or []
+
+
+def async_database_url(url: str) -> str:
+	"""URL того же сервера БД с асинхронным драйвером: mysql+pymysql -> mysql+aiomysql."""
+	parsed = make_url(url)
+	backend = parsed.get_backend_name()
+	if backend not in ASYNC_DRIVERS:
+		raise ValueError(f'No async driver configured for {backend}')
+	return parsed.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}').render_as_string(hide_password=False)
+
+
+class ChatHub:
+	"""Пробуждает ожидающие SSE-подключения: одна задача опрашивает messages для всех чатов процесса.
+
+	События хранятся только для чатов, на которые кто-то подписан.
+	"""
+
+	def __init__(self, poll_interval: float, logger):
+		self.poll_interval = poll_interval
+		self.logger = logger
+		self._events: dict[int, asyncio.Event] = {}
+		self._listeners: Counter[int] = Counter()
+		self._last_id = 0
+
+	def subscribe(self, chat_id: int) -> None:
+		self._listeners[chat_id] += 1
+
+	def unsubscribe(self, chat_id: int) -> None:
+		self._listeners[chat_id] -= 1
+		if self._listeners[chat_id] <= 0:
+			del self._listeners[chat_id]
+			self._events.pop(chat_id, None)
+
+	def event(self, chat_id: int) -> asyncio.Event:
+		return self._events.setdefault(chat_id, asyncio.Event())
+
+	def notify(self, chat_id: int) -> None:
+		event = self._events.pop(chat_id, None)
+		if event is not None:
+			event.set()
+
+	async def poll(self, engine: AsyncEngine) -> None:
+		"""Без подписчиков база не опрашивается. После простоя опрос начинается с текущего максимума id,
+		а подписанные чаты будятся один раз: пропущенное они перечитают сами, начиная со своего after.
+		"""
+		idle = True
+		while True:
+			await asyncio.sleep(self.poll_interval)
+			if not self._listeners:
+				idle = True
+				continue
+			try:
+				async with engine.connect() as conn:
+					if idle:
+						self._last_id = (await conn.execute(db.select(db.func.max(Message.id)))).scalar() or 0
+						rows = [(chat_id, self._last_id) for chat_id in list(self._listeners)]
+					else:
+						rows = (await conn.execute(
+							db.select(Message.chat_id, db.func.max(Message.id))
+							.where(Message.id > self._last_id)
+							.group_by(Message.chat_id)
+						)).all()
+			except Exception:
+				self.logger.exception('Failed to poll new chat messages')
+				continue
+			idle = False
+			for chat_id, last_id in rows:
+				self._last_id = max(self._last_id, last_id)
+				self.notify(chat_id)
+
+
+class ChatASGI:
+	"""ASGI-приложение для чатов: список, история, отправка и поток новых сообщений (SSE).
+
+	Пользователь определяется по сессионной cookie Flask-приложения, база — та же, но через
+	асинхронный движок SQLAlchemy. Остальные пути передаются в fallback (обычно Flask через WsgiToAsgi).
+	"""
+
+	def __init__(self, flask_app: Flask, fallback=None):
+		config = flask_app.config
+		self.flask_app = flask_app
+		self.fallback = fallback
+		self.prefix = config.get('CHAT_ASYNC_PREFIX', DEFAULT_PREFIX).rstrip('/')
+		self.keepalive = config.get('CHAT_SSE_KEEPALIVE', DEFAULT_KEEPALIVE)
+		self.database_url = config.get('CHAT_ASYNC_DATABASE_URL') or async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+		self.hub = ChatHub(config.get('CHAT_POLL_INTERVAL', DEFAULT_POLL_INTERVAL), flask_app.logger)
+		self.engine: AsyncEngine | None = None
+		self._poller: asyncio.Task | None = None
+		self._routes = [
+			('GET', re.compile(r'/chats'), self.list_chats),
+			('GET', re.compile(r'/chats/(\d+)/messages'), self.chat_messages),
+			('POST', re.compile(r'/chats/(\d+)/messages'), self.send_message),
+			('GET', re.compile(r'/chats/(\d+)/events'), self.chat_events),
+		]
+
+	async def startup(self) -> None:
+		if self.engine is None:
+			self.engine = create_async_engine(self.database_url, pool_pre_ping=True)
+			self._poller = asyncio.create_task(self.hub.poll(self.engine))
+
+	async def shutdown(self) -> None:
+		if self._poller is not None:
+			self._poller.cancel()
+			self._poller = None
+		if self.engine is not None:
+			await self.engine.dispose()
+			self.engine = None
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+		if scope['type'] == 'lifespan':
+			await self._lifespan(receive, send)
+			return
+		path = scope.get('path', '')
+		if scope['type'] != 'http' or not path.startswith(self.prefix + '/'):
+			if self.fallback is None:
+				await _send_json(send, {'error': 'not found'}, 404)
+			else:
+				await self.fallback(scope, receive, send)
+			return
+
+		await self.startup()
+		route_path = path[len(self.prefix):]
+		try:
+			for method, pattern, handler in self._routes:
+				match = pattern.fullmatch(route_path)
+				if match and scope['method'] == method:
+					user_id = self._session_user(scope)
+					await handler(scope, receive, send, user_id, *map(int, match.groups()))
+					return
+			raise HTTPError(404, 'not found')
+		except HTTPError as error:
+			await _send_json(send, {'error': error.message}, error.status, error.headers)
+
+	async def _lifespan(self, receive: Receive, send: Send) -> None:
+		while True:
+			message = await receive()
+			if message['type'] == 'lifespan.startup':
+				await self.startup()
+				await send({'type': 'lifespan.startup.complete'})
+			elif message['type'] == 'lifespan.shutdown':
+				await self.shutdown()
+				await send({'type': 'lifespan.shutdown.complete'})
+				return
+
+	def _session_user(self, scope: Scope) -> int:
+		cookies = SimpleCookie()
+		for name, value in scope.get('headers', ()):
+			if name == b'cookie':
+				cookies.load(value.decode('latin-1'))
+		morsel = cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+		serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+		if morsel is None or serializer is None:
+			raise HTTPError(401, 'unauthorized')
+		max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+		try:
+			data = serializer.loads(morsel.value, max_age=max_age)
+		except BadSignature:
+			raise HTTPError(401, 'unauthorized') from None
+		if not data.get('user_id'):
+			raise HTTPError(401, 'unauthorized')
+		return data['user_id']
+
+	async def _check_rate_limit(self, scope: Scope, user_id: int) -> None:
+		"""Правила RateLimiter для main.send_message на том же бэкенде, что и у Flask-приложения."""
+		if not self.flask_app.config['RATELIMIT_ENABLED']:
+			return
+		state = self.flask_app.extensions['ratelimit']
+		ip = _client_ip(scope, self.flask_app.config.get('TRUSTED_PROXIES', 0))
+		rules = limit_rules(state, SEND_MESSAGE_ENDPOINT, user_id, ip)
+		if not rules:
+			return
+		# Общий бэкенд (Redis) ходит в сеть, поэтому не в цикле событий
+		retry_after = await asyncio.to_thread(state.backend.hit_many, rules)
+		if retry_after > 0:
+			raise HTTPError(
+				429, 'Слишком много запросов. Попробуйте позже.',
+				[(b'retry-after', str(math.ceil(retry_after)).encode())],
+			)
+
+	async def _member_chat(self, conn: AsyncConnection, chat_id: int, user_id: int):
+		chat = (await conn.execute(db.select(Chat.__table__).where(Chat.id == chat_id))).first()
+		if chat is None:
+			raise HTTPError(404, 'chat not found')
+		if user_id not in (chat.buyer_id, chat.seller_id):
+			raise HTTPError(403, 'forbidden')
+		return chat
+
+	async def list_chats(self, scope: Scope, receive: Receive, send: Send, user_id: int) -> None:
+		buyer = db.aliased(User)
+		seller = db.aliased(User)
+		async with self.engine.connect() as conn:
+			rows = (await conn.execute(
+				db.select(
+					Chat.id, Chat.listing_id, Chat.buyer_id, Chat.updated_at, Listing.title,
+					buyer.name, buyer.email, seller.name, seller.email,
+				)
+				.join(Listing, Listing.id == Chat.listing_id, isouter=True)
+				.join(buyer, buyer.id == Chat.buyer_id)
+				.join(seller, seller.id == Chat.seller_id)
+				.where((Chat.buyer_id == user_id) | (Chat.seller_id == user_id))
+				.order_by(Chat.updated_at.desc())
+			)).all()
+		chats = []
+		for chat_id, listing_id, buyer_id, updated_at, title, buyer_name, buyer_email, seller_name, seller_email in rows:
+			other = (seller_name or seller_email) if buyer_id == user_id else (buyer_name or buyer_email)
+			chats.append({
+				'id': chat_id,
+				'listing_id': listing_id,
+				'listing_title': title,
+				'other_user': other,
+				'updated_at': updated_at.isoformat() if updated_at else None,
+			})
+		await _send_json(send, {'chats': chats})
+
+	async def chat_messages(self, scope: Scope, receive: Receive, send: Send, user_id: int, chat_id: int) -> None:
+		query = _query(scope)
+		before = _int_arg(query, 'before')
+		limit = min(_int_arg(query, 'limit') or CHAT_PAGE_SIZE, CHAT_PAGE_SIZE)
+		async with self.engine.connect() as conn:
+			await self._member_chat(conn, chat_id, user_id)
+			messages, older = await chat_history(conn, chat_id, before, limit)
+		await _send_json(send, {'messages': [_message_json(message) for message in messages], 'before': older})
+
+	async def send_message(self, scope: Scope, receive: Receive, send: Send, user_id: int, chat_id: int) -> None:
+		content = _message_content(scope, await _read_body(receive))
+		if not content:
+			raise HTTPError(400, 'Сообщение не может быть пустым')
+		await self._check_rate_limit(scope, user_id)
+		now = datetime.utcnow()
+		async with self.engine.begin() as conn:
+			await self._member_chat(conn, chat_id, user_id)
+			result = await conn.execute(db.insert(Message.__table__).values(
+				chat_id=chat_id, author_id=user_id, content=content, created_at=now, updated_at=now
+			))
+			await conn.execute(db.update(Chat.__table__).where(Chat.id == chat_id).values(updated_at=now))
+		self.hub.notify(chat_id)
+		message = {'id': result.inserted_primary_key[0], 'author_id': user_id, 'content': content, 'created_at': now}
+		await _send_json(send, _message_json(message), 201)
+
+	async def chat_events(self, scope: Scope, receive: Receive, send: Send, user_id: int, chat_id: int) -> None:
+		"""Поток text/event-stream с новыми сообщениями чата после after (или Last-Event-ID)."""
+		last_id = _int_arg(_query(scope), 'after') or _int_header(scope, b'last-event-id') or 0
+		async with self.engine.connect() as conn:
+			await self._member_chat(conn, chat_id, user_id)
+
+		await send({
+			'type': 'http.response.start',
+			'status': 200,
+			'headers': [
+				(b'content-type', b'text/event-stream; charset=utf-8'),
+				(b'cache-control', b'no-cache'),
+				(b'x-accel-buffering', b'no'),
+			],
+		})
+		disconnected = asyncio.create_task(_wait_disconnect(receive))
+		self.hub.subscribe(chat_id)
+		try:
+			# База читается при подключении и после сигнала хаба; keepalive её не трогает
+			signalled = True
+			while not disconnected.done():
+				chunk = ': keepalive\n\n'
+				if signalled:
+					event = self.hub.event(chat_id)
+					async with self.engine.connect() as conn:
+						rows = (await conn.execute(
+							db.select(Message.id, Message.author_id, Message.content, Message.created_at)
+							.where(Message.chat_id == chat_id, Message.id > last_id)
+							.order_by(Message.id)
+						)).all()
+					if rows:
+						chunk = ''.join(
+							f'id: {row.id}\ndata: {json.dumps(_message_json(row._asdict()), ensure_ascii=False)}\n\n'
+							for row in rows
+						)
+						last_id = rows[-1].id
+				await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+				woken = asyncio.ensure_future(event.wait())
+				await asyncio.wait([disconnected, woken], timeout=self.keepalive, return_when=asyncio.FIRST_COMPLETED)
+				woken.cancel()
+				signalled = event.is_set()
+		except OSError:
+			pass
+		finally:
+			disconnected.cancel()
+			self.hub.unsubscribe(chat_id)
+		try:
+			await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+		except OSError:
+			pass
+
+
+async def chat_history(
+	conn: AsyncConnection, chat_id: int, before: int | None, limit: int
+) -> tuple[list, int | None]:
+	"""Асинхронный вариант transcripts.chat_history: строки messages, затем сжатые блоки."""
+	query = db.select(Message.id, Message.chat_id, Message.author_id, Message.content, Message.created_at).where(
+		Message.chat_id == chat_id
+	)
+	if before is not None:
+		query = query.where(Message.id < before)
+	newest_first = [row._asdict() for row in await conn.execute(query.order_by(Message.id.desc()).limit(limit + 1))]
+
+	if len(newest_first) <= limit:
+		block_query = db.select(MessageBlock.__table__).where(MessageBlock.chat_id == chat_id)
+		if before is not None:
+			block_query = block_query.where(MessageBlock.first_message_id < before)
+		blocks = await conn.stream(block_query.order_by(MessageBlock.last_message_id.desc()))
+		async for block in blocks:
+			for message in reversed(unpack_block(block)):
+				if before is None or message.id < before:
+					newest_first.append(message._asdict())
+			if len(newest_first) > limit:
+				break
+		await blocks.close()
+
+	has_more = len(newest_first) > limit
+	messages = newest_first[:limit][::-1]
+	return messages, messages[0]['id'] if has_more else None
+
+
+def _message_json(message: dict) -> dict:
+	created_at = message['created_at']
+	return {
+		'id': message['id'],
+		'author_id': message['author_id'],
+		'content': message['content'],
+		'created_at': created_at.isoformat() if created_at else None,
+	}
+
+
+def _query(scope: Scope) -> dict[str, list[str]]:
+	return parse_qs(scope.get('query_string', b'').decode('latin-1'))
+
+
+def _int_arg(query: dict[str, list[str]], name: str) -> int | None:
+	value = query.get(name, [''])[0]
+	return int(value) if value.isdigit() else None
+
+
+def _int_header(scope: Scope, name: bytes) -> int | None:
+	for key, value in scope.get('headers', ()):
+		if key == name and value.isdigit():
+			return int(value)
+	return None
+
+
+def _client_ip(scope: Scope, trusted_proxies: int) -> str | None:
+	"""Адрес клиента так же, как ProxyFix(x_for=trusted_proxies) у Flask-приложения."""
+	client = scope.get('client')
+	ip = client[0] if client else None
+	if trusted_proxies:
+		header = b','.join(value for key, value in scope.get('headers', ()) if key == b'x-forwarded-for')
+		forwarded = [part.strip() for part in header.decode('latin-1').split(',') if part.strip()]
+		if len(forwarded) >= trusted_proxies:
+			ip = forwarded[-trusted_proxies]
+	return ip
+
+
+def _message_content(scope: Scope, body: bytes) -> str:
+	content_type = next((value for key, value in scope.get('headers', ()) if key == b'content-type'), b'')
+	if content_type.startswith(b'application/json'):
+		try:
+			data = json.loads(body or b'{}')
+		except ValueError:
+			raise HTTPError(400, 'invalid json') from None
+		content = data.get('content') if isinstance(data, dict) else None
+		return str(content or '').strip()
+	return parse_qs(body.decode('utf-8', 'replace')).get('content', [''])[0].strip()
+
+
+async def _read_body(receive: Receive) -> bytes:
+	body = bytearray()
+	while True:
+		message = await receive()
+		if message['type'] == 'http.disconnect':
+			raise HTTPError(400, 'client disconnected')
+		body += message.get('body', b'')
+		if len(body) > MAX_MESSAGE_BODY:
+			raise HTTPError(413, 'message too large')
+		if not message.get('more_body'):
+			return bytes(body)
+
+
+async def _wait_disconnect(receive: Receive) -> None:
+	while (await receive())['type'] != 'http.disconnect':
+		pass
+
+
+async def _send_json(send: Send, payload: dict, status: int = 200, headers: list[tuple[bytes, bytes]] | None = None) -> None:
+	body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+	await send({
+		'type': 'http.response.start',
+		'status': status,
+		'headers': [
+			(b'content-type', b'application/json; charset=utf-8'),
+			(b'content-length', str(len(body)).encode()),
+			*(headers or []),
+		],
+	})
+	await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(flask_app: Flask) -> ChatASGI:
+	"""Чаты обслуживаются асинхронно, все остальные маршруты — прежним Flask-приложением."""
+	from asgiref.wsgi import WsgiToAsgi
+	return ChatASGI(flask_app, fallback=WsgiToAsgi(flask_app))
@@ -0,0 +1,442 @@
+from __future__ import annotations
+
+import io
+import math
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from flask import Flask, current_app, has_app_context
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import DuplicateImage, ImageHashBand, Listing, ListingImage, User
+from .storage import LISTINGS_PREFIX, get_storage, storage_key
+
+
+SAMPLE_SIZE = 32
+HASH_SIZE = 8
+BANDS = 4
+BAND_BITS = 64 // BANDS
+# Хэши на расстоянии до 2 * BANDS - 1 бит совпадают хотя бы в одной полосе с точностью до одного бита
+MAX_GUARANTEED_DISTANCE = 2 * BANDS - 1
+DEFAULT_MAX_DISTANCE = 6
+HASH_BATCH_SIZE = 200
+DUPLICATE_QUEUE_SIZE = 50
+DUPLICATE_ACTIONS = ('dismiss', 'delete')
+# Захват фото истекает, если обработчик упал, не дописав хэш
+PHASH_CLAIM_TIMEOUT = timedelta(hours=1)
+PHASH_FAILED = 'failed'
+
+_MASK = (1 << 64) - 1
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+	k = np.arange(size)[:, None]
+	i = np.arange(size)[None, :]
+	matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * size)) * math.sqrt(2 / size)
+	matrix[0] /= math.sqrt(2)
+	return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(SAMPLE_SIZE)
+
+
+def load_pixels(data: bytes) -> np.ndarray | None:
+	"""Яркость фото, уменьшенного до SAMPLE_SIZE x SAMPLE_SIZE; None, если файл не читается как картинка."""
+	try:
+		with Image.open(io.BytesIO(data)) as image:
+			# JPEG декодируется сразу в уменьшенном масштабе, без полного растра
+			image.draft('L', (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+			small = image.convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.LANCZOS)
+			return np.asarray(small, dtype=np.float32)
+	except (UnidentifiedImageError, OSError, ValueError):
+		return None
+
+
+def perceptual_hashes(pixels: np.ndarray) -> list[int]:
+	"""pHash для пачки (n, 32, 32): биты — низкие частоты DCT 8x8 выше медианы (без постоянной составляющей)."""
+	coefficients = _DCT @ pixels @ _DCT.T
+	low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), HASH_SIZE * HASH_SIZE)
+	median = np.median(low[:, 1:], axis=1, keepdims=True)
+	packed = np.packbits(low > median, axis=1)
+	return [int.from_bytes(row.tobytes(), 'big') for row in packed]
+
+
+def _signed(value: int) -> int:
+	return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _bands(value: int) -> list[int]:
+	return [(value >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1) for band in range(BANDS)]
+
+
+def hamming(a: int, b: int) -> int:
+	return ((a ^ b) & _MASK).bit_count()
+
+
+class NearDuplicate(NamedTuple):
+	image_id: int
+	listing_id: int
+	distance: int
+
+
+def _max_distance() -> int:
+	return min(current_app.config.get('PHASH_MAX_DISTANCE', DEFAULT_MAX_DISTANCE), MAX_GUARANTEED_DISTANCE)
+
+
+def find_near_duplicates(value: int, owner_id: int, max_distance: int | None = None) -> list[NearDuplicate]:
+	"""Фото других продавцов с хэшем не дальше max_distance бит."""
+	return find_near_duplicates_many([value], [owner_id], max_distance)[0]
+
+
+def _probes(values: list[int]) -> list[dict[int, list[int]]]:
+	"""Для каждой полосы: значение в индексе -> позиции хэшей, полоса которых равна ему с точностью до бита."""
+	probes: list[dict[int, list[int]]] = [{} for _ in range(BANDS)]
+	for position, value in enumerate(values):
+		for band, part in enumerate(_bands(value)):
+			for probe in [part] + [part ^ (1 << bit) for bit in range(BAND_BITS)]:
+				probes[band].setdefault(probe, []).append(position)
+	return probes
+
+
+def find_near_duplicates_many(
+	values: list[int], owner_ids: list[int], max_distance: int | None = None
+) -> list[list[NearDuplicate]]:
+	"""Совпадения для пачки хэшей одним запросом к индексу.
+
+	Multi-index hashing: 64 бита делятся на BANDS полос, и по индексу image_hash_bands ищутся
+	полосы, равные полосе хэша или отличающиеся от неё одним битом. Затем расстояние считается точно.
+	"""
+	max_distance = _max_distance() if max_distance is None else min(max_distance, MAX_GUARANTEED_DISTANCE)
+	found: list[dict[int, NearDuplicate]] = [{} for _ in values]
+	for start in range(0, len(values), HASH_BATCH_SIZE):
+		chunk = values[start:start + HASH_BATCH_SIZE]
+		probes = _probes(chunk)
+		rows = db.session.execute(
+			db.select(
+				ImageHashBand.band, ImageHashBand.value,
+				ListingImage.id, ListingImage.listing_id, ListingImage.phash, Listing.owner_id,
+			)
+			.join(ListingImage, ListingImage.id == ImageHashBand.image_id)
+			.join(Listing, Listing.id == ListingImage.listing_id)
+			.where(db.or_(*[
+				db.and_(ImageHashBand.band == band, ImageHashBand.value.in_(list(probes[band])))
+				for band in range(BANDS)
+			]))
+		)
+		for band, part, image_id, listing_id, phash, owner_id in rows:
+			for position in probes[band].get(part, ()):
+				position += start
+				if owner_id != owner_ids[position] and (distance := hamming(phash, values[position])) <= max_distance:
+					found[position][image_id] = NearDuplicate(image_id, listing_id, distance)
+	return [sorted(matches.values(), key=lambda item: (item.distance, item.image_id)) for matches in found]
+
+
+def _read(filename: str) -> bytes | None:
+	try:
+		with get_storage().open(storage_key(LISTINGS_PREFIX, filename)) as stream:
+			return stream.read()
+	except (FileNotFoundError, ValueError):
+		return None
+
+
+def _hash_images(rows) -> tuple[int, int]:
+	"""Хэширует фото (id, listing_id, filename, owner_id), ищет совпадения и добавляет их в индекс.
+
+	Отсутствующие и нечитаемые файлы помечаются PHASH_FAILED и больше не скачиваются.
+	"""
+	loaded, failed = [], []
+	for row in rows:
+		data = _read(row[2])
+		pixels = None if data is None else load_pixels(data)
+		if pixels is None:
+			failed.append(row[0])
+		else:
+			loaded.append((row, pixels))
+	if failed:
+		db.session.execute(
+			db.update(ListingImage).where(ListingImage.id.in_(failed)).values(phash_claim=PHASH_FAILED),
+			execution_options={'synchronize_session': False},
+		)
+	if not loaded:
+		return 0, 0
+	hashes = perceptual_hashes(np.stack([pixels for _, pixels in loaded]))
+	images = [row for row, _ in loaded]
+	owners = [row[3] for row in images]
+	matches = find_near_duplicates_many(hashes, owners)
+
+	# Фото одной пачки сравниваются и между собой: более позднее помечается как повтор раннего
+	max_distance = _max_distance()
+	probes = _probes(hashes)
+	for position, value in enumerate(hashes):
+		earlier = {
+			other
+			for band, part in enumerate(_bands(value))
+			for other in probes[band].get(part, ())
+			if other < position
+		}
+		for other in sorted(earlier):
+			distance = hamming(hashes[other], value)
+			if owners[other] != owners[position] and distance <= max_distance:
+				matches[position].append(NearDuplicate(images[other][0], images[other][1], distance))
+
+	now = datetime.utcnow()
+	duplicates = [
+		{
+			'image_id': image_id,
+			'listing_id': listing_id,
+			'match_image_id': match.image_id,
+			'match_listing_id': match.listing_id,
+			'distance': match.distance,
+			'created_at': now,
+		}
+		for (image_id, listing_id, _, _), found in zip(images, matches)
+		for match in found
+	]
+	if duplicates:
+		db.session.execute(db.insert(DuplicateImage), duplicates)
+	db.session.execute(db.update(ListingImage), [
+		{'id': image_id, 'phash': _signed(value), 'phash_claim': None, 'phash_claimed_at': None}
+		for (image_id, _, _, _), value in zip(images, hashes)
+	])
+	db.session.execute(db.insert(ImageHashBand), [
+		{'band': band, 'value': part, 'image_id': image_id}
+		for (image_id, _, _, _), value in zip(images, hashes)
+		for band, part in enumerate(_bands(value))
+	])
+	return len(loaded), len(duplicates)
+
+
+def _unhashed(now: datetime):
+	"""Фото без хэша, которые никто не обрабатывает: не захваченные, не испорченные или с истёкшим захватом."""
+	return db.and_(ListingImage.phash.is_(None), db.or_(
+		ListingImage.phash_claim.is_(None),
+		db.and_(ListingImage.phash_claim != PHASH_FAILED, ListingImage.phash_claimed_at < now - PHASH_CLAIM_TIMEOUT),
+	))
+
+
+def _unhashed_ids(*conditions, limit: int | None = None) -> list[int]:
+	return db.session.execute(
+		db.select(ListingImage.id)
+		.where(_unhashed(datetime.utcnow()), *conditions)
+		.order_by(ListingImage.id)
+		.limit(limit)
+	).scalars().all()
+
+
+def _claim_and_hash(image_ids: list[int]) -> tuple[int, int]:
+	"""Захватывает фото своим токеном в отдельной транзакции и хэширует только захваченные.
+
+	Команда hash-images, backfill и поток загрузок могут работать одновременно: фото, которое уже
+	захватил другой обработчик, пропускается, поэтому полосы и пары не вставляются дважды.
+	"""
+	if not image_ids:
+		return 0, 0
+	token = uuid.uuid4().hex
+	now = datetime.utcnow()
+	db.session.execute(
+		db.update(ListingImage)
+		.where(ListingImage.id.in_(image_ids), _unhashed(now))
+		.values(phash_claim=token, phash_claimed_at=now),
+		execution_options={'synchronize_session': False},
+	)
+	db.session.commit()
+	rows = db.session.execute(
+		db.select(ListingImage.id, ListingImage.listing_id, ListingImage.filename, Listing.owner_id)
+		.join(Listing, Listing.id == ListingImage.listing_id)
+		.where(ListingImage.phash_claim == token)
+		.order_by(ListingImage.id)
+	).all()
+	result = _hash_images(rows)
+	db.session.commit()
+	return result
+
+
+def hash_new_images(batch_size: int = HASH_BATCH_SIZE, retry_failed: bool = False) -> tuple[int, int]:
+	"""Фоновая задача: хэширует все фото без phash пачками по batch_size. Возвращает (фото, совпадений).
+
+	Фото, помеченные PHASH_FAILED, пропускаются; retry_failed снимает отметку и пробует их снова.
+	"""
+	if retry_failed:
+		db.session.execute(
+			db.update(ListingImage)
+			.where(ListingImage.phash.is_(None), ListingImage.phash_claim == PHASH_FAILED)
+			.values(phash_claim=None, phash_claimed_at=None),
+			execution_options={'synchronize_session': False},
+		)
+		db.session.commit()
+	hashed = duplicates = 0
+	last_id = 0
+	while True:
+		image_ids = _unhashed_ids(ListingImage.id > last_id, limit=batch_size)
+		if not image_ids:
+			return hashed, duplicates
+		done, found = _claim_and_hash(image_ids)
+		hashed += done
+		duplicates += found
+		last_id = image_ids[-1]
+
+
+def hash_listing_images(listing_ids: Iterable[int]) -> tuple[int, int]:
+	"""Хэширует ещё не обработанные фото этих объявлений."""
+	listing_ids = sorted(set(listing_ids))
+	hashed = duplicates = 0
+	for start in range(0, len(listing_ids), HASH_BATCH_SIZE):
+		image_ids = _unhashed_ids(ListingImage.listing_id.in_(listing_ids[start:start + HASH_BATCH_SIZE]))
+		for offset in range(0, len(image_ids), HASH_BATCH_SIZE):
+			done, found = _claim_and_hash(image_ids[offset:offset + HASH_BATCH_SIZE])
+			hashed += done
+			duplicates += found
+	return hashed, duplicates
+
+
+class HashQueue:
+	"""Очередь объявлений с новыми фото; фоновый поток процесса хэширует их сразу после загрузки.
+
+	Команда hash-images остаётся страховкой для фото, которые не успели обработать (перезапуск воркера).
+	"""
+
+	def __init__(self, app: Flask):
+		self.app = app
+		self._queue: queue.Queue[int] = queue.Queue()
+		self._lock = threading.Lock()
+		self._pid: int | None = None
+
+	def put(self, listing_ids: Iterable[int]) -> None:
+		for listing_id in listing_ids:
+			self._queue.put(listing_id)
+		if self._pid != os.getpid():
+			self._start()
+
+	def _start(self) -> None:
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._pid = os.getpid()
+		thread = threading.Thread(target=self._run, name='image-hasher', daemon=True)
+		thread.start()
+
+	def _run(self) -> None:
+		while True:
+			listing_ids = {self._queue.get()}
+			while not self._queue.empty() and len(listing_ids) < HASH_BATCH_SIZE:
+				listing_ids.add(self._queue.get_nowait())
+			with self.app.app_context():
+				try:
+					hash_listing_images(listing_ids)
+				except Exception:
+					db.session.rollback()
+					self.app.logger.exception('Failed to hash uploaded images')
+				finally:
+					db.session.remove()
+
+
+def init_duplicates(app: Flask) -> None:
+	app.config.setdefault('PHASH_ON_UPLOAD', True)
+	app.extensions['image_hasher'] = HashQueue(app)
+
+
+def enqueue_image_hashing(listing_ids: Iterable[int]) -> None:
+	"""Ставит фото объявлений в очередь хэширования; для загрузок в обход ORM (импорт фидов)."""
+	if current_app.config['PHASH_ON_UPLOAD']:
+		current_app.extensions['image_hasher'].put(listing_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_new_images(session, flush_context):
+	for obj in session.new:
+		if isinstance(obj, ListingImage):
+			session.info.setdefault('new_image_listings', set()).add(obj.listing_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _hash_new_uploads(session):
+	listing_ids = session.info.pop('new_image_listings', None)
+	if listing_ids and has_app_context() and 'image_hasher' in current_app.extensions:
+		enqueue_image_hashing(listing_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_new_images(session):
+	session.info.pop('new_image_listings', None)
+
+
+def hash_image_range(start_id: int, end_id: int) -> int:
+	"""Перцептивный хэш старых фотографий объявлений и поиск дубликатов среди них."""
+	return _claim_and_hash(_unhashed_ids(ListingImage.id > start_id, ListingImage.id <= end_id))[0]
+
+
+class DuplicateItem(NamedTuple):
+	id: int
+	distance: int
+	created_at: datetime
+	image: str
+	listing_id: int
+	title: str | None
+	owner_name: str | None
+	match_image: str
+	match_listing_id: int
+	match_title: str | None
+	match_owner_name: str | None
+
+
+def duplicate_queue(limit: int = DUPLICATE_QUEUE_SIZE) -> tuple[list[DuplicateItem], int]:
+	"""Непросмотренные пары похожих фото (сначала новые) и их общее число."""
+	total = db.session.execute(
+		db.select(db.func.count(DuplicateImage.id)).where(DuplicateImage.status == 'pending')
+	).scalar() or 0
+	image = db.aliased(ListingImage)
+	match_image = db.aliased(ListingImage)
+	listing = db.aliased(Listing)
+	match_listing = db.aliased(Listing)
+	owner = db.aliased(User)
+	match_owner = db.aliased(User)
+	rows = db.session.execute(
+		db.select(
+			DuplicateImage.id,
+			DuplicateImage.distance,
+			DuplicateImage.created_at,
+			image.filename,
+			listing.id,
+			listing.title,
+			db.func.coalesce(owner.name, owner.email),
+			match_image.filename,
+			match_listing.id,
+			match_listing.title,
+			db.func.coalesce(match_owner.name, match_owner.email),
+		)
+		.join(image, image.id == DuplicateImage.image_id)
+		.join(listing, listing.id == DuplicateImage.listing_id)
+		.join(owner, owner.id == listing.owner_id)
+		.join(match_image, match_image.id == DuplicateImage.match_image_id)
+		.join(match_listing, match_listing.id == DuplicateImage.match_listing_id)
+		.join(match_owner, match_owner.id == match_listing.owner_id)
+		.where(DuplicateImage.status == 'pending')
+		.order_by(DuplicateImage.id.desc())
+		.limit(limit)
+	).all()
+	return [DuplicateItem(*row) for row in rows], total
+
+
+def review_duplicates(duplicate_ids: list[int], action: str) -> list[int]:
+	"""Отмечает пары просмотренными; для delete возвращает id объявлений-повторов для удаления."""
+	if action not in DUPLICATE_ACTIONS:
+		raise ValueError(f'Unknown duplicate action: {action}')
+	listing_ids = db.session.execute(
+		db.select(DuplicateImage.listing_id).where(DuplicateImage.id.in_(duplicate_ids)).distinct()
+	).scalars().all()
+	db.session.execute(
+		db.update(DuplicateImage)
+		.where(DuplicateImage.id.in_(duplicate_ids))
+		.values(status='dismissed' if action == 'dismiss' else 'confirmed'),
+		execution_options={'synchronize_session': False},
+	)
+	db.session.commit()
+	return listing_ids if action == 'delete' else []
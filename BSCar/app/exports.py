@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable, Iterator
+
+from . import db
+from .models import Category, Complaint, Listing, SupportTicket, User
+
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+YIELD_PER = 1000
+ROWS_PER_CHUNK = 500
+
+
+def _listings():
+	return db.select(
+		Listing.id, Listing.external_id, Listing.title, Listing.description, Listing.price, Listing.status,
+		Category.name.label('category'), User.email.label('owner_email'), Listing.created_at, Listing.updated_at,
+	).outerjoin(Category, Category.id == Listing.category_id).join(User, User.id == Listing.owner_id).order_by(Listing.id)
+
+
+def _complaints():
+	return db.select(
+		Complaint.id, Complaint.listing_id, User.email.label('submitter_email'), Complaint.reason, Complaint.status,
+		Complaint.created_at, Complaint.updated_at,
+	).join(User, User.id == Complaint.submitter_id).order_by(Complaint.id)
+
+
+def _tickets():
+	return db.select(
+		SupportTicket.id, User.email.label('user_email'), SupportTicket.subject, SupportTicket.message,
+		SupportTicket.reply, SupportTicket.status, SupportTicket.created_at, SupportTicket.updated_at,
+	).join(User, User.id == SupportTicket.user_id).order_by(SupportTicket.id)
+
+
+EXPORTS = {
+	'listings': _listings,
+	'complaints': _complaints,
+	'tickets': _tickets,
+}
+
+
+def _plain(value):
+	if isinstance(value, (datetime, date)):
+		return value.isoformat()
+	if isinstance(value, Decimal):
+		return str(value)
+	return value
+
+
+def iter_rows(kind: str) -> tuple[list[str], Iterator[tuple]]:
+	"""Колонки и построчный итератор по серверному курсору: в памяти не больше одной пачки."""
+	if kind not in EXPORTS:
+		raise ValueError(f'Unknown export: {kind}')
+	result = db.session.execute(
+		EXPORTS[kind](),
+		execution_options={'stream_results': True, 'yield_per': YIELD_PER},
+	)
+	return list(result.keys()), iter(result)
+
+
+def iter_csv(columns: list[str], rows: Iterable[tuple]) -> Iterator[str]:
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(columns)
+	for count, row in enumerate(rows, start=1):
+		writer.writerow([_plain(value) for value in row])
+		if count % ROWS_PER_CHUNK == 0:
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+	yield buffer.getvalue()
+
+
+def iter_jsonl(columns: list[str], rows: Iterable[tuple]) -> Iterator[str]:
+	lines = []
+	for row in rows:
+		lines.append(json.dumps({column: _plain(value) for column, value in zip(columns, row)}, ensure_ascii=False))
+		if len(lines) >= ROWS_PER_CHUNK:
+			yield '\n'.join(lines) + '\n'
+			lines = []
+	if lines:
+		yield '\n'.join(lines) + '\n'
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+	for chunk in chunks:
+		compressed = compressor.compress(chunk)
+		if compressed:
+			yield compressed
+	yield compressor.flush()
+
+
+def export_chunks(kind: str, fmt: str, gzip: bool = False) -> Iterator[bytes]:
+	if fmt not in EXPORT_FORMATS:
+		raise ValueError(f'Unknown export format: {fmt}')
+	columns, rows = iter_rows(kind)
+	encode = iter_csv if fmt == 'csv' else iter_jsonl
+	chunks = (text.encode('utf-8') for text in encode(columns, rows))
+	return gzip_chunks(chunks) if gzip else chunks
+
+
+def export_filename(kind: str, fmt: str, gzip: bool = False) -> str:
+	name = f'{kind}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}'
+	return f'{name}.gz' if gzip else name
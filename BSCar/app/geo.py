@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import math
+from typing import NamedTuple
+
+from . import db
+from .archive import live_listings
+from .models import Listing
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+MAX_SEARCH_CELLS = 12
+RADIUS_CHOICES = (10, 25, 50, 100, 250, 500)
+
+CITIES = {
+	'Москва': (55.7558, 37.6173),
+	'Санкт-Петербург': (59.9343, 30.3351),
+	'Новосибирск': (55.0084, 82.9357),
+	'Екатеринбург': (56.8389, 60.6057),
+	'Казань': (55.7961, 49.1064),
+	'Нижний Новгород': (56.2965, 43.9361),
+	'Челябинск': (55.1644, 61.4368),
+	'Самара': (53.1959, 50.1002),
+	'Омск': (54.9885, 73.3242),
+	'Ростов-на-Дону': (47.2357, 39.7015),
+	'Уфа': (54.7388, 55.9721),
+	'Красноярск': (56.0153, 92.8932),
+	'Воронеж': (51.6720, 39.1843),
+	'Пермь': (58.0105, 56.2502),
+	'Волгоград': (48.7080, 44.5133),
+	'Краснодар': (45.0355, 38.9753),
+	'Саратов': (51.5336, 46.0343),
+	'Тюмень': (57.1522, 65.5272),
+	'Иркутск': (52.2870, 104.3050),
+	'Хабаровск': (48.4802, 135.0719),
+	'Владивосток': (43.1155, 131.8855),
+	'Ярославль': (57.6261, 39.8845),
+	'Тула': (54.1961, 37.6182),
+	'Калининград': (54.7104, 20.4522),
+	'Сочи': (43.5855, 39.7231),
+}
+_CITY_LOOKUP = {name.casefold(): name for name in CITIES}
+
+
+class Location(NamedTuple):
+	city: str | None
+	latitude: float
+	longitude: float
+
+	def column_values(self) -> dict:
+		return {
+			'city': self.city,
+			'latitude': self.latitude,
+			'longitude': self.longitude,
+			'geohash': encode_geohash(self.latitude, self.longitude),
+		}
+
+
+class RadiusFilter(NamedTuple):
+	"""Круг поиска, целиком выраженный в SQL: префиксы geohash, рамка по координатам и точное расстояние."""
+
+	center: Location
+	radius_km: float
+	cells: list[str]
+	box: tuple[float, float, float, float]
+
+	def _haversine(self):
+		# Квадрат синуса половины центрального угла: монотонен по расстоянию, поэтому сравнивается без asin
+		lat1 = math.radians(self.center.latitude)
+		lat2 = Listing.latitude * (math.pi / 180)
+		dlat = (Listing.latitude - self.center.latitude) * (math.pi / 360)
+		dlon = (Listing.longitude - self.center.longitude) * (math.pi / 360)
+		return db.func.pow(db.func.sin(dlat), 2) + math.cos(lat1) * db.func.cos(lat2) * db.func.pow(db.func.sin(dlon), 2)
+
+	def distance(self):
+		"""Расстояние от центра в км для строк listings."""
+		return 2 * EARTH_RADIUS_KM * db.func.asin(db.func.sqrt(self._haversine()))
+
+	def condition(self, column=None):
+		"""Условие на listings; для другой таблицы (карточки) — полусоединение по column через подзапрос."""
+		south, north, west, east = self.box
+		where = db.and_(
+			db.or_(*[_prefix_condition(prefix) for prefix in self.cells]),
+			Listing.latitude.between(south, north),
+			_longitude_condition(west, east),
+			self._haversine() <= math.sin(self.radius_km / (2 * EARTH_RADIUS_KM)) ** 2,
+		)
+		if column is None:
+			return where
+		return column.in_(live_listings(db.select(Listing.id)).where(where))
+
+
+def locate(city: str | None) -> Location | None:
+	name = _CITY_LOOKUP.get((city or '').strip().casefold())
+	if name is None:
+		return None
+	return Location(name, *CITIES[name])
+
+
+def parse_location(city: str | None, latitude=None, longitude=None) -> Location | None:
+	"""Координаты, если они заданы и корректны, иначе центр известного города."""
+	try:
+		latitude, longitude = float(latitude), float(longitude)
+	except (TypeError, ValueError):
+		return locate(city)
+	if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+		return locate(city)
+	known = locate(city)
+	return Location(known.city if known else (city or '').strip()[:120] or None, latitude, longitude)
+
+
+def set_listing_location(listing: Listing, location: Location | None) -> None:
+	values = location.column_values() if location else dict.fromkeys(('city', 'latitude', 'longitude', 'geohash'))
+	for name, value in values.items():
+		setattr(listing, name, value)
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+	lat_range = [-90.0, 90.0]
+	lon_range = [-180.0, 180.0]
+	chars = []
+	bits = 0
+	value = 0
+	even = True
+	while len(chars) < precision:
+		interval, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+		middle = (interval[0] + interval[1]) / 2
+		value <<= 1
+		if coordinate >= middle:
+			value |= 1
+			interval[0] = middle
+		else:
+			interval[1] = middle
+		even = not even
+		bits += 1
+		if bits == 5:
+			chars.append(GEOHASH_ALPHABET[value])
+			bits = value = 0
+	return ''.join(chars)
+
+
+def _cell_size(precision: int) -> tuple[float, float]:
+	lon_bits = (5 * precision + 1) // 2
+	lat_bits = 5 * precision // 2
+	return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> tuple[float, float, float, float]:
+	"""Юг, север, запад, восток рамки вокруг круга; долготы могут выходить за ±180 у линии перемены дат."""
+	dlat = radius_km / KM_PER_DEGREE
+	south, north = max(latitude - dlat, -90.0), min(latitude + dlat, 90.0)
+	dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(max(abs(south), abs(north)))), 0.01))
+	west, east = longitude - dlon, longitude + dlon
+	if east - west >= 360.0:
+		west, east = -180.0, 180.0
+	return south, north, west, east
+
+
+def _longitude_condition(west: float, east: float):
+	if west < -180.0:
+		return db.or_(Listing.longitude >= west + 360.0, Listing.longitude <= east)
+	if east > 180.0:
+		return db.or_(Listing.longitude >= west, Listing.longitude <= east - 360.0)
+	return Listing.longitude.between(west, east)
+
+
+def covering_cells(latitude: float, longitude: float, radius_km: float) -> list[str]:
+	"""Префиксы geohash самой мелкой точности, которыми круг покрывается не более чем MAX_SEARCH_CELLS ячейками."""
+	south, north, west, east = bounding_box(latitude, longitude, radius_km)
+
+	cells: set[str] = {''}
+	for precision in range(1, GEOHASH_PRECISION + 1):
+		cell_lat, cell_lon = _cell_size(precision)
+		rows = math.floor(north / cell_lat) - math.floor(south / cell_lat) + 1
+		columns = math.floor(east / cell_lon) - math.floor(west / cell_lon) + 1
+		if rows * columns > MAX_SEARCH_CELLS:
+			break
+		latitudes = [min(south + row * cell_lat, north) for row in range(rows)] + [north]
+		longitudes = [min(west + column * cell_lon, east) for column in range(columns)] + [east]
+		found = {
+			encode_geohash(lat, (lon + 180.0) % 360.0 - 180.0, precision)
+			for lat in latitudes
+			for lon in longitudes
+		}
+		cells = found
+	return sorted(cells)
+
+
+def _prefix_condition(prefix: str):
+	if not prefix:
+		return Listing.geohash.is_not(None)
+	# '{' идёт в ASCII сразу за 'z', так что условие — диапазон по индексу ix_listings_geohash
+	return db.and_(Listing.geohash >= prefix, Listing.geohash < prefix + '{')
+
+
+def within_radius(center: Location, radius_km: float) -> RadiusFilter:
+	"""Условие «не дальше radius_km от center»: диапазоны по индексу geohash, затем точное расстояние в SQL."""
+	return RadiusFilter(
+		center,
+		radius_km,
+		covering_cells(center.latitude, center.longitude, radius_km),
+		bounding_box(center.latitude, center.longitude, radius_km),
+	)
@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import codecs
+import csv
+import json
+import os
+import zipfile
+from decimal import Decimal, InvalidOperation
+from typing import IO, Callable, Iterator, NamedTuple
+
+from werkzeug.datastructures import FileStorage
+
+from . import db
+from .cards import mark_cards_dirty
+from .categories import get_category_tree
+from .duplicates import enqueue_image_hashing
+from .geo import Location, parse_location
+from .models import Listing, ListingImage
+from .searches import match_listings
+from .uploads import MAX_FILE_SIZE, allowed_file, save_uploaded_file
+
+
+BATCH_SIZE = 200
+MAX_REPORTED_ERRORS = 100
+FEED_FORMATS = ('csv', 'jsonl')
+PHOTO_SEPARATORS = (';', '|', ',')
+
+
+class FeedRow(NamedTuple):
+	line: int
+	external_id: str
+	title: str
+	description: str | None
+	price: Decimal
+	category_id: int | None
+	location: Location | None
+	photos: list[str]
+
+
+class ImportReport:
+	def __init__(self):
+		self.rows = 0
+		self.created = 0
+		self.updated = 0
+		self.photos = 0
+		self.error_count = 0
+		self.errors: list[tuple[int, str]] = []
+
+	def error(self, line: int, message: str) -> None:
+		self.error_count += 1
+		if len(self.errors) < MAX_REPORTED_ERRORS:
+			self.errors.append((line, message))
+
+	def summary(self) -> str:
+		return (
+			f'Строк: {self.rows}, создано: {self.created}, обновлено: {self.updated}, '
+			f'фото: {self.photos}, ошибок: {self.error_count}'
+		)
+
+
+class PhotoSource:
+	"""Фотографии из папки или zip-архива; файлы открываются по одному при прикреплении."""
+
+	def __init__(self, path_or_file):
+		self._zip = None
+		self._root = None
+		self._names: dict[str, str] = {}
+		if isinstance(path_or_file, (str, os.PathLike)) and os.path.isdir(path_or_file):
+			self._root = os.fspath(path_or_file)
+		else:
+			self._zip = zipfile.ZipFile(path_or_file)
+			for info in self._zip.infolist():
+				if not info.is_dir():
+					self._names.setdefault(info.filename, info.filename)
+					self._names.setdefault(os.path.basename(info.filename), info.filename)
+
+	def size(self, name: str) -> int | None:
+		if self._zip is not None:
+			member = self._names.get(name)
+			return self._zip.getinfo(member).file_size if member else None
+		path = self._path(name)
+		return os.path.getsize(path) if path and os.path.isfile(path) else None
+
+	def open(self, name: str) -> IO[bytes]:
+		if self._zip is not None:
+			return self._zip.open(self._names[name])
+		return open(self._path(name), 'rb')
+
+	def close(self) -> None:
+		if self._zip is not None:
+			self._zip.close()
+
+	def _path(self, name: str) -> str | None:
+		path = os.path.normpath(os.path.join(self._root, name))
+		if not path.startswith(os.path.normpath(self._root) + os.sep):
+			return None
+		return path
+
+
+def iter_records(stream: IO[bytes], fmt: str) -> Iterator[tuple[int, dict]]:
+	text = codecs.getreader('utf-8-sig')(stream)
+	if fmt == 'csv':
+		reader = csv.DictReader(text)
+		for record in reader:
+			yield reader.line_num, record
+	elif fmt == 'jsonl':
+		for line, raw in enumerate(text, start=1):
+			if not raw.strip():
+				continue
+			try:
+				yield line, json.loads(raw)
+			except ValueError:
+				yield line, None
+	else:
+		raise ValueError(f'Unknown feed format: {fmt}')
+
+
+def parse_record(line: int, record: dict | None, tree) -> FeedRow:
+	if not isinstance(record, dict):
+		raise ValueError('строка не является объектом')
+	external_id = str(record.get('external_id') or record.get('id') or '').strip()
+	title = str(record.get('title') or '').strip()
+	if not external_id:
+		raise ValueError('нет external_id')
+	if len(external_id) > 64:
+		raise ValueError('external_id длиннее 64 символов')
+	if not title:
+		raise ValueError('нет названия')
+	try:
+		price = Decimal(str(record.get('price')).replace(' ', '').replace(',', '.'))
+	except InvalidOperation:
+		raise ValueError(f'неверная цена: {record.get("price")!r}') from None
+	if price <= 0:
+		raise ValueError('цена должна быть положительной')
+
+	category_id = None
+	category_name = str(record.get('category') or '').strip()
+	if category_name:
+		node = tree.find(category_name)
+		if node is None:
+			raise ValueError(f'неизвестная категория: {category_name}')
+		category_id = node.id
+
+	photos = record.get('photos') or []
+	if isinstance(photos, str):
+		for separator in PHOTO_SEPARATORS:
+			if separator in photos:
+				photos = photos.split(separator)
+				break
+		else:
+			photos = [photos]
+	photos = [str(name).strip() for name in photos if str(name).strip()]
+
+	city = str(record.get('city') or '').strip()
+	location = parse_location(city, record.get('latitude'), record.get('longitude'))
+	if city and location is None:
+		raise ValueError(f'неизвестный город: {city}')
+
+	description = record.get('description')
+	return FeedRow(
+		line, external_id, title[:200], str(description) if description else None, price, category_id, location, photos
+	)
+
+
+def _location_values(row: FeedRow) -> dict:
+	if row.location is None:
+		return dict.fromkeys(('city', 'latitude', 'longitude', 'geohash'))
+	return row.location.column_values()
+
+
+def _upsert_batch(dealer_id: int, rows: list[FeedRow]) -> tuple[dict[str, int], list[int], int]:
+	by_external = {row.external_id: row for row in rows}
+	existing = dict(db.session.execute(
+		db.select(Listing.external_id, Listing.id)
+		.where(Listing.owner_id == dealer_id, Listing.external_id.in_(by_external))
+	).all())
+
+	updates = [
+		{
+			'id': existing[row.external_id],
+			'title': row.title,
+			'description': row.description,
+			'price': row.price,
+			'category_id': row.category_id,
+			**_location_values(row),
+		}
+		for row in by_external.values()
+		if row.external_id in existing
+	]
+	inserts = [
+		{
+			'external_id': row.external_id,
+			'owner_id': dealer_id,
+			'title': row.title,
+			'description': row.description,
+			'price': row.price,
+			'category_id': row.category_id,
+			'status': 'active',
+			**_location_values(row),
+		}
+		for row in by_external.values()
+		if row.external_id not in existing
+	]
+	if updates:
+		db.session.execute(db.update(Listing), updates)
+	if inserts:
+		db.session.execute(db.insert(Listing), inserts)
+		existing.update(db.session.execute(
+			db.select(Listing.external_id, Listing.id)
+			.where(Listing.owner_id == dealer_id, Listing.external_id.in_([row['external_id'] for row in inserts]))
+		).all())
+	mark_cards_dirty(existing.values())
+	return existing, [existing[row['external_id']] for row in inserts], len(updates)
+
+
+def _attach_photos(rows: list[FeedRow], listing_ids: dict[str, int], photos: PhotoSource, report: ImportReport) -> int:
+	wanted = {listing_ids[row.external_id]: row for row in rows if row.photos}
+	if not wanted:
+		return 0
+	attached: dict[int, set[str]] = {}
+	for listing_id, original_filename in db.session.execute(
+		db.select(ListingImage.listing_id, ListingImage.original_filename)
+		.where(ListingImage.listing_id.in_(wanted))
+	):
+		attached.setdefault(listing_id, set()).add(original_filename)
+
+	images = []
+	for listing_id, row in wanted.items():
+		has_images = bool(attached.get(listing_id))
+		for name in row.photos:
+			if name in attached.get(listing_id, ()):
+				continue
+			size = photos.size(name)
+			if size is None:
+				report.error(row.line, f'фото не найдено: {name}')
+				continue
+			if size > MAX_FILE_SIZE or not allowed_file(name):
+				report.error(row.line, f'фото пропущено (размер или формат): {name}')
+				continue
+			with photos.open(name) as stream:
+				filename = save_uploaded_file(FileStorage(stream=stream, filename=os.path.basename(name)), listing_id)
+			images.append({
+				'listing_id': listing_id,
+				'filename': filename,
+				'original_filename': name,
+				'file_size': size,
+				'is_primary': not has_images,
+			})
+			has_images = True
+			attached.setdefault(listing_id, set()).add(name)
+	if images:
+		db.session.execute(db.insert(ListingImage), images)
+	return len(images)
+
+
+def import_feed(
+	stream: IO[bytes],
+	fmt: str,
+	dealer_id: int,
+	photos: PhotoSource | None = None,
+	progress: Callable[[ImportReport], None] | None = None,
+) -> ImportReport:
+	report = ImportReport()
+	tree = get_category_tree()
+	batch: list[FeedRow] = []
+
+	def flush() -> None:
+		created = []
+		attached = 0
+		try:
+			listing_ids, created, updated = _upsert_batch(dealer_id, batch)
+			attached = _attach_photos(batch, listing_ids, photos, report) if photos is not None else 0
+			db.session.commit()
+			report.created += len(created)
+			report.updated += updated
+			report.photos += attached
+		except Exception as exc:
+			db.session.rollback()
+			created, attached = [], 0
+			for row in batch:
+				report.error(row.line, f'пакет не сохранён: {exc}')
+		if attached:
+			enqueue_image_hashing(listing_ids[row.external_id] for row in batch if row.photos)
+		batch.clear()
+		if created:
+			match_listings(created)
+		if progress is not None:
+			progress(report)
+
+	try:
+		for line, record in iter_records(stream, fmt):
+			report.rows += 1
+			try:
+				batch.append(parse_record(line, record, tree))
+			except ValueError as exc:
+				report.error(line, str(exc))
+				continue
+			if len(batch) >= BATCH_SIZE:
+				flush()
+	except (ValueError, UnicodeDecodeError, csv.Error) as exc:
+		report.error(report.rows + 1, f'не удалось прочитать файл: {exc}')
+	if batch:
+		flush()
+	return report
+
+
+def feed_format(filename: str | None, default: str = 'csv') -> str:
+	ext = (filename or '').rsplit('.', 1)[-1].lower()
+	if ext in ('jsonl', 'ndjson'):
+		return 'jsonl'
+	if ext == 'csv':
+		return 'csv'
+	return default
+
+
+def open_photo_source(upload: FileStorage | None) -> PhotoSource | None:
+	if upload is None or not upload.filename:
+		return None
+	return PhotoSource(upload.stream)
+
@@ -30,7 +30,9 @@ class Category(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(120), unique=True, nullable=False)
 	parent_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
-	parent = db.relationship('Category', remote_side=[id])
+	path = db.Column(db.String(255), index=True)
+	parent = db.relationship('Category', remote_side=[id], back_populates='children')
+	children = db.relationship('Category', back_populates='parent')
 
 	listings = db.relationship('Listing', back_populates='category')
 
@@ -46,6 +48,11 @@ class Listing(db.Model, TimestampMixin):
 
 	owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 	category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
+	external_id = db.Column(db.String(64))
+	city = db.Column(db.String(120))
+	latitude = db.Column(db.Float)
+	longitude = db.Column(db.Float)
+	geohash = db.Column(db.String(12))
 
 	owner = db.relationship('User', back_populates='listings')
 	category = db.relationship('Category', back_populates='listings')
@@ -53,6 +60,33 @@ class Listing(db.Model, TimestampMixin):
 	complaints = db.relationship('Complaint', back_populates='listing', cascade='all, delete-orphan')
 	images = db.relationship('ListingImage', back_populates='listing', cascade='all, delete-orphan')
 
+	__table_args__ = (
+		db.UniqueConstraint('owner_id', 'external_id', name='uq_listings_owner_external'),
+		db.Index('ix_listings_status_created', 'status', 'created_at'),
+		db.Index('ix_listings_geohash', 'geohash'),
+		db.Index('ix_listings_updated', 'updated_at'),
+	)
+
+
+class ListingCard(db.Model):
+	__tablename__ = 'listing_cards'
+
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), primary_key=True)
+	title = db.Column(db.String(200), nullable=False)
+	price = db.Column(db.Numeric(12, 2))
+	status = db.Column(db.String(32), nullable=False)
+	summary = db.Column(db.String(101))
+	category_id = db.Column(db.Integer)
+	category_name = db.Column(db.String(120))
+	thumbnail = db.Column(db.String(255))
+	owner_id = db.Column(db.Integer, nullable=False, index=True)
+	owner_name = db.Column(db.String(255))
+	city = db.Column(db.String(120))
+	created_at = db.Column(db.DateTime, nullable=False)
+	updated_at = db.Column(db.DateTime, nullable=False)
+
+	__table_args__ = (db.Index('ix_listing_cards_status_created', 'status', 'created_at'),)
+
 
 class Favorite(db.Model, TimestampMixin):
 	__tablename__ = 'favorites'
@@ -95,6 +129,64 @@ class Message(db.Model, TimestampMixin):
 	author = db.relationship('User', back_populates='messages')
 
 
+class MessageBlock(db.Model):
+	__tablename__ = 'message_blocks'
+
+	id = db.Column(db.Integer, primary_key=True)
+	chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'), nullable=False)
+	first_message_id = db.Column(db.Integer, nullable=False)
+	last_message_id = db.Column(db.Integer, nullable=False)
+	message_count = db.Column(db.Integer, nullable=False)
+	first_at = db.Column(db.DateTime, nullable=False)
+	last_at = db.Column(db.DateTime, nullable=False)
+	codec = db.Column(db.String(16), default='zlib', nullable=False)
+	offsets = db.Column(db.LargeBinary, nullable=False)
+	data = db.Column(db.LargeBinary(length=2 ** 24), nullable=False)
+
+	__table_args__ = (db.Index('ix_message_blocks_chat_last', 'chat_id', 'last_message_id'),)
+
+
+class SavedSearch(db.Model, TimestampMixin):
+	__tablename__ = 'saved_searches'
+
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+	query = db.Column(db.String(200), nullable=False, default='')
+	category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
+	min_price = db.Column(db.Numeric(12, 2))
+	max_price = db.Column(db.Numeric(12, 2))
+	term_count = db.Column(db.Integer, nullable=False)
+
+	category = db.relationship('Category')
+	terms = db.relationship('SavedSearchTerm', cascade='all, delete-orphan')
+
+
+class SavedSearchTerm(db.Model):
+	__tablename__ = 'saved_search_terms'
+
+	term = db.Column(db.String(64), primary_key=True)
+	saved_search_id = db.Column(db.Integer, db.ForeignKey('saved_searches.id'), primary_key=True)
+
+
+class SearchMatch(db.Model):
+	__tablename__ = 'search_matches'
+
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+	saved_search_id = db.Column(db.Integer, db.ForeignKey('saved_searches.id'), nullable=False)
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False)
+	created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+	seen_at = db.Column(db.DateTime)
+
+	saved_search = db.relationship('SavedSearch')
+	listing = db.relationship('Listing')
+
+	__table_args__ = (
+		db.UniqueConstraint('saved_search_id', 'listing_id', name='uq_search_matches_search_listing'),
+		db.Index('ix_search_matches_user_id', 'user_id', 'id'),
+	)
+
+
 class Complaint(db.Model, TimestampMixin):
 	__tablename__ = 'complaints'
 
@@ -107,6 +199,8 @@ class Complaint(db.Model, TimestampMixin):
 	listing = db.relationship('Listing', back_populates='complaints')
 	submitter = db.relationship('User')
 
+	__table_args__ = (db.Index('ix_complaints_status_listing', 'status', 'listing_id'),)
+
 
 class ModerationAction(db.Model, TimestampMixin):
 	__tablename__ = 'moderation_actions'
@@ -130,10 +224,165 @@ class ListingImage(db.Model, TimestampMixin):
 	original_filename = db.Column(db.String(255), nullable=False)
 	file_size = db.Column(db.Integer)
 	is_primary = db.Column(db.Boolean, default=False, nullable=False)
+	phash = db.Column(db.BigInteger)
+	phash_claim = db.Column(db.String(32))
+	phash_claimed_at = db.Column(db.DateTime)
 
 	listing = db.relationship('Listing', back_populates='images')
 
 
+class ImageHashBand(db.Model):
+	__tablename__ = 'image_hash_bands'
+
+	band = db.Column(db.SmallInteger, primary_key=True)
+	value = db.Column(db.Integer, primary_key=True)
+	image_id = db.Column(db.Integer, db.ForeignKey('listing_images.id'), primary_key=True)
+
+
+class DuplicateImage(db.Model):
+	__tablename__ = 'duplicate_images'
+
+	id = db.Column(db.Integer, primary_key=True)
+	image_id = db.Column(db.Integer, db.ForeignKey('listing_images.id'), nullable=False)
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False)
+	match_image_id = db.Column(db.Integer, db.ForeignKey('listing_images.id'), nullable=False)
+	match_listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False)
+	distance = db.Column(db.SmallInteger, nullable=False)
+	status = db.Column(db.String(16), default='pending', nullable=False)
+	created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+	__table_args__ = (
+		db.UniqueConstraint('image_id', 'match_image_id', name='uq_duplicate_images_pair'),
+		db.Index('ix_duplicate_images_status_id', 'status', 'id'),
+	)
+
+
+class ListingViewCount(db.Model):
+	__tablename__ = 'listing_view_counts'
+
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), primary_key=True)
+	day = db.Column(db.Date, primary_key=True)
+	views = db.Column(db.Integer, default=0, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False, index=True)
+
+
+class ListingRanking(db.Model):
+	__tablename__ = 'listing_rankings'
+
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), primary_key=True)
+	score = db.Column(db.Float, nullable=False, index=True)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class JobWatermark(db.Model):
+	__tablename__ = 'job_watermarks'
+
+	name = db.Column(db.String(64), primary_key=True)
+	value = db.Column(db.DateTime, nullable=False)
+
+
+class DailyStat(db.Model):
+	__tablename__ = 'daily_stats'
+
+	day = db.Column(db.Date, primary_key=True)
+	metric = db.Column(db.String(32), primary_key=True)
+	value = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RollupWatermark(db.Model):
+	__tablename__ = 'rollup_watermarks'
+
+	metric = db.Column(db.String(32), primary_key=True)
+	last_id = db.Column(db.Integer, default=0, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class RequestProfile(db.Model):
+	__tablename__ = 'request_profiles'
+
+	id = db.Column(db.Integer, primary_key=True)
+	endpoint = db.Column(db.String(120), nullable=False)
+	method = db.Column(db.String(8), nullable=False)
+	path = db.Column(db.String(255), nullable=False)
+	status = db.Column(db.Integer, nullable=False)
+	duration_ms = db.Column(db.Float, nullable=False)
+	kind = db.Column(db.String(16), nullable=False)
+	created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+	data = db.Column(db.LargeBinary(length=2 ** 24), nullable=False)
+
+	__table_args__ = (db.Index('ix_request_profiles_endpoint_id', 'endpoint', 'id'),)
+
+
+class CacheVersion(db.Model):
+	__tablename__ = 'cache_versions'
+
+	name = db.Column(db.String(64), primary_key=True)
+	version = db.Column(db.Integer, default=1, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class SiteSetting(db.Model):
+	__tablename__ = 'site_settings'
+
+	key = db.Column(db.String(64), primary_key=True)
+	value = db.Column(db.Text, nullable=False)
+
+
+class BackfillCheckpoint(db.Model):
+	__tablename__ = 'backfill_checkpoints'
+
+	name = db.Column(db.String(64), primary_key=True)
+	last_id = db.Column(db.Integer, default=0, nullable=False)
+	max_id = db.Column(db.Integer, default=0, nullable=False)
+	rows_done = db.Column(db.Integer, default=0, nullable=False)
+	status = db.Column(db.String(16), default='running', nullable=False)
+	started_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class ListingVector(db.Model):
+	__tablename__ = 'listing_vectors'
+
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), primary_key=True)
+	vector = db.Column(db.LargeBinary, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class SimilarListing(db.Model):
+	__tablename__ = 'similar_listings'
+
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), primary_key=True)
+	rank = db.Column(db.Integer, primary_key=True)
+	similar_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False, index=True)
+	score = db.Column(db.Float, nullable=False)
+
+
+class UploadSession(db.Model, TimestampMixin):
+	__tablename__ = 'upload_sessions'
+
+	id = db.Column(db.String(32), primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+	listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False, index=True)
+	filename = db.Column(db.String(255), nullable=False)
+	total_size = db.Column(db.Integer, nullable=False)
+	received = db.Column(db.Integer, default=0, nullable=False)
+	status = db.Column(db.String(16), default='pending', nullable=False)
+	image_id = db.Column(db.Integer, db.ForeignKey('listing_images.id'))
+
+
+class PriceStat(db.Model):
+	__tablename__ = 'price_stats'
+
+	group_key = db.Column(db.String(191), primary_key=True)
+	listing_count = db.Column(db.Integer, nullable=False)
+	p10 = db.Column(db.Float, nullable=False)
+	p25 = db.Column(db.Float, nullable=False)
+	median = db.Column(db.Float, nullable=False)
+	p75 = db.Column(db.Float, nullable=False)
+	p90 = db.Column(db.Float, nullable=False)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
 class SupportTicket(db.Model, TimestampMixin):
 	__tablename__ = 'support_tickets'
 
@@ -146,4 +395,32 @@ class SupportTicket(db.Model, TimestampMixin):
 
 	user = db.relationship('User')
 
+	__table_args__ = (db.Index('ix_support_tickets_status_created', 'status', 'created_at'),)
+
+
+ARCHIVE_INDEXED_COLUMNS = {'owner_id', 'listing_id', 'chat_id', 'buyer_id', 'seller_id'}
+
+
+def _archive_table(model):
+	source = model.__table__
+	return db.Table(
+		f'archived_{source.name}',
+		*[
+			db.Column(
+				column.name, column.type,
+				primary_key=column.primary_key,
+				autoincrement=False,
+				nullable=column.nullable,
+				index=column.name in ARCHIVE_INDEXED_COLUMNS,
+			)
+			for column in source.columns
+		],
+		db.Column('archived_at', db.DateTime, nullable=False, index=True),
+	)
+
 
+archived_listings = _archive_table(Listing)
+archived_listing_images = _archive_table(ListingImage)
+archived_chats = _archive_table(Chat)
+archived_messages = _archive_table(Message)
+archived_complaints = _archive_table(Complaint)
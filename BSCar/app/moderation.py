@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import NamedTuple
+
+from . import db
+from .models import (
+	Chat, Complaint, DuplicateImage, Favorite, ImageHashBand, Listing, ListingCard, ListingImage, ListingRanking,
+	ListingVector, ListingViewCount, Message, MessageBlock, ModerationAction, SearchMatch, SimilarListing, UploadSession,
+	User,
+)
+
+
+QUEUE_PAGE_SIZE = 20
+MODERATION_ACTIONS = {
+	'resolve': 'resolved',
+	'dismiss': 'dismissed',
+	'delete': 'resolved',
+}
+
+
+class QueueItem(NamedTuple):
+	listing_id: int
+	title: str | None
+	owner_name: str | None
+	complaints: int
+	last_complaint_at: datetime
+
+
+class QueuePage(NamedTuple):
+	items: list[QueueItem]
+	page: int
+	pages: int
+	total: int
+
+
+def moderation_queue(page: int = 1, per_page: int = QUEUE_PAGE_SIZE) -> QueuePage:
+	page = max(page, 1)
+	total = db.session.execute(
+		db.select(db.func.count(db.distinct(Complaint.listing_id))).where(Complaint.status == 'pending')
+	).scalar() or 0
+
+	complaints = db.func.count(Complaint.id).label('complaints')
+	last_complaint_at = db.func.max(Complaint.created_at).label('last_complaint_at')
+	grouped = (
+		db.select(Complaint.listing_id, complaints, last_complaint_at)
+		.where(Complaint.status == 'pending')
+		.group_by(Complaint.listing_id)
+		.subquery()
+	)
+	rows = db.session.execute(
+		db.select(
+			grouped.c.listing_id,
+			Listing.title,
+			db.func.coalesce(User.name, User.email),
+			grouped.c.complaints,
+			grouped.c.last_complaint_at,
+		)
+		.join(Listing, Listing.id == grouped.c.listing_id)
+		.join(User, User.id == Listing.owner_id)
+		.order_by(grouped.c.complaints.desc(), grouped.c.last_complaint_at.desc(), grouped.c.listing_id)
+		.limit(per_page)
+		.offset((page - 1) * per_page)
+	).all()
+
+	pages = max((total + per_page - 1) // per_page, 1)
+	return QueuePage([QueueItem(*row) for row in rows], page, pages, total)
+
+
+def delete_listings(listing_ids: list[int]) -> None:
+	chat_ids = db.select(Chat.id).where(Chat.listing_id.in_(listing_ids))
+	db.session.execute(db.delete(Message).where(Message.chat_id.in_(chat_ids)))
+	db.session.execute(db.delete(MessageBlock).where(MessageBlock.chat_id.in_(chat_ids)))
+	db.session.execute(db.delete(Chat).where(Chat.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(Complaint).where(Complaint.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(Favorite).where(Favorite.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(SearchMatch).where(SearchMatch.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(UploadSession).where(UploadSession.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(DuplicateImage).where(db.or_(
+		DuplicateImage.listing_id.in_(listing_ids),
+		DuplicateImage.match_listing_id.in_(listing_ids),
+	)))
+	db.session.execute(db.delete(ImageHashBand).where(ImageHashBand.image_id.in_(
+		db.select(ListingImage.id).where(ListingImage.listing_id.in_(listing_ids))
+	)))
+	db.session.execute(db.delete(ListingImage).where(ListingImage.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(ListingCard).where(ListingCard.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(ListingViewCount).where(ListingViewCount.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(ListingRanking).where(ListingRanking.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(ListingVector).where(ListingVector.listing_id.in_(listing_ids)))
+	db.session.execute(db.delete(SimilarListing).where(db.or_(
+		SimilarListing.listing_id.in_(listing_ids),
+		SimilarListing.similar_id.in_(listing_ids),
+	)))
+	db.session.execute(
+		db.update(ModerationAction)
+		.where(ModerationAction.listing_id.in_(listing_ids))
+		.values(listing_id=None)
+	)
+	db.session.execute(
+		db.delete(Listing).where(Listing.id.in_(listing_ids)),
+		execution_options={'synchronize_session': False},
+	)
+
+
+def apply_moderation(moderator_id: int, listing_ids: list[int], action: str, reason: str | None = None) -> int:
+	if action not in MODERATION_ACTIONS:
+		raise ValueError(f'Unknown moderation action: {action}')
+	listings = db.session.execute(
+		db.select(Listing.id, Listing.title).where(Listing.id.in_(listing_ids))
+	).all()
+	if not listings:
+		return 0
+	found_ids = [row.id for row in listings]
+
+	records = [
+		{
+			'listing_id': None if action == 'delete' else row.id,
+			'moderator_id': moderator_id,
+			'action': action,
+			'details': f'#{row.id} «{row.title}»: {reason}' if reason else f'#{row.id} «{row.title}»',
+		}
+		for row in listings
+	]
+
+	if action == 'delete':
+		delete_listings(found_ids)
+	else:
+		db.session.execute(
+			db.update(Complaint)
+			.where(Complaint.listing_id.in_(found_ids), Complaint.status == 'pending')
+			.values(status=MODERATION_ACTIONS[action], updated_at=datetime.utcnow()),
+			execution_options={'synchronize_session': False},
+		)
+
+	db.session.execute(db.insert(ModerationAction), records)
+	db.session.commit()
+	return len(found_ids)
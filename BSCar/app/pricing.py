@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import re
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from flask import current_app
+
+from . import db
+from .models import Listing, PriceStat
+
+
+PERCENTILES = (10, 25, 50, 75, 90)
+DEFAULT_MIN_GROUP_SIZE = 5
+BATCH_SIZE = 1000
+FAMILY_TOKENS = 2
+TOKEN_RE = re.compile(r'[^\W\d_]+', re.UNICODE)
+BADGE_LABELS = {
+	'low': 'Ниже рынка',
+	'fair': 'Рыночная цена',
+	'high': 'Выше рынка',
+}
+
+
+class PriceBadge(NamedTuple):
+	kind: str
+	label: str
+	median: float
+	listing_count: int
+
+
+def model_family(title: str | None) -> str:
+	"""Марка и модель из названия: первые слова без годов, пробега и прочих чисел."""
+	return ' '.join(TOKEN_RE.findall((title or '').lower())[:FAMILY_TOKENS])
+
+
+def group_key(title: str | None, category_id: int | None) -> str:
+	return f'{category_id or 0}:{model_family(title)}'[:191]
+
+
+def group_percentiles(codes: np.ndarray, prices: np.ndarray, percentiles=PERCENTILES) -> tuple[np.ndarray, np.ndarray]:
+	"""Перцентили цен по группам без цикла по группам: сортировка по (группа, цена) и линейная интерполяция."""
+	order = np.lexsort((prices, codes))
+	codes, prices = codes[order], prices[order]
+	starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+	counts = np.diff(np.r_[starts, len(codes)])
+	positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles, dtype=float)[None, :] / 100)
+	lower = np.floor(positions).astype(np.int64)
+	upper = np.ceil(positions).astype(np.int64)
+	fraction = positions - lower
+	values = prices[lower] * (1 - fraction) + prices[upper] * fraction
+	return codes[starts], counts, values
+
+
+def refresh_price_stats(now: datetime | None = None) -> int:
+	now = now or datetime.utcnow()
+	min_size = current_app.config.get('PRICE_STATS_MIN_GROUP_SIZE', DEFAULT_MIN_GROUP_SIZE)
+
+	keys: list[str] = []
+	prices: list[float] = []
+	for title, category_id, price in db.session.execute(
+		db.select(Listing.title, Listing.category_id, Listing.price)
+		.where(Listing.status == 'active', Listing.price > 0)
+		.execution_options(yield_per=BATCH_SIZE)
+	):
+		keys.append(group_key(title, category_id))
+		prices.append(float(price))
+
+	db.session.execute(db.delete(PriceStat))
+	if not keys:
+		db.session.commit()
+		return 0
+
+	names, codes = np.unique(np.asarray(keys, dtype=object), return_inverse=True)
+	groups, counts, values = group_percentiles(codes, np.asarray(prices, dtype=np.float64))
+	keep = counts >= min_size
+	rows = [
+		{
+			'group_key': names[code],
+			'listing_count': int(count),
+			'p10': p10, 'p25': p25, 'median': median, 'p75': p75, 'p90': p90,
+			'updated_at': now,
+		}
+		for code, count, (p10, p25, median, p75, p90) in zip(
+			groups[keep].tolist(), counts[keep].tolist(), values[keep].tolist()
+		)
+	]
+	for start in range(0, len(rows), BATCH_SIZE):
+		db.session.execute(db.insert(PriceStat), rows[start:start + BATCH_SIZE])
+	db.session.commit()
+	return len(rows)
+
+
+def badge_for(price, stat: PriceStat | None) -> PriceBadge | None:
+	if stat is None or not price:
+		return None
+	price = float(price)
+	if price < stat.p25:
+		kind = 'low'
+	elif price > stat.p75:
+		kind = 'high'
+	else:
+		kind = 'fair'
+	return PriceBadge(kind, BADGE_LABELS[kind], stat.median, stat.listing_count)
+
+
+def price_badges(listings) -> dict[int, PriceBadge]:
+	listings = [listing for listing in listings if listing.price]
+	keys = {listing.id: group_key(listing.title, listing.category_id) for listing in listings}
+	if not keys:
+		return {}
+	stats = {
+		stat.group_key: stat
+		for stat in db.session.execute(
+			db.select(PriceStat).where(PriceStat.group_key.in_(set(keys.values())))
+		).scalars()
+	}
+	badges = {}
+	for listing in listings:
+		badge = badge_for(listing.price, stats.get(keys[listing.id]))
+		if badge:
+			badges[listing.id] = badge
+	return badges
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import cProfile
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import NamedTuple
+
+from flask import Flask, current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from . import db
+from .models import RequestProfile
+from .refcache import get_setting
+
+
+PROFILE_HEADER = 'X-Profile-Token'
+DEFAULT_RETENTION = 20
+DEFAULT_TOKEN_MAX_AGE = 3600
+DEFAULT_SAMPLE_INTERVAL = 0.005
+PROFILE_MODES = {
+	'cprofile': 'cProfile (pstats)',
+	'stack': 'Сэмплер стеков (collapsed)',
+}
+PROFILE_FILES = {
+	'pstats': ('prof', 'application/octet-stream'),
+	'collapsed': ('folded', 'text/plain'),
+}
+
+
+class ProfilingSettings(NamedTuple):
+	sample_rate: float
+	mode: str
+	endpoints: frozenset[str]
+
+
+def profiling_settings() -> ProfilingSettings:
+	try:
+		rate = min(max(float(get_setting('profiling.sample_rate') or 0), 0.0), 1.0)
+	except ValueError:
+		rate = 0.0
+	mode = get_setting('profiling.mode', 'cprofile')
+	endpoints = get_setting('profiling.endpoints') or ''
+	return ProfilingSettings(
+		rate,
+		mode if mode in PROFILE_MODES else 'cprofile',
+		frozenset(name.strip() for name in endpoints.split(',') if name.strip()),
+	)
+
+
+def _serializer() -> URLSafeTimedSerializer:
+	return URLSafeTimedSerializer(current_app.secret_key, salt='request-profile')
+
+
+def profile_token(user_id: int) -> str:
+	"""Токен для заголовка X-Profile-Token: запрос с ним профилируется независимо от доли выборки."""
+	return _serializer().dumps({'by': user_id})
+
+
+def _valid_token(token: str) -> bool:
+	max_age = current_app.config.get('PROFILE_TOKEN_MAX_AGE', DEFAULT_TOKEN_MAX_AGE)
+	try:
+		_serializer().loads(token, max_age=max_age)
+	except BadSignature:
+		return False
+	return True
+
+
+class _CProfiler:
+	kind = 'pstats'
+
+	def __init__(self):
+		self._profile = cProfile.Profile()
+		self._profile.enable()
+
+	def stop(self) -> bytes:
+		self._profile.disable()
+		self._profile.create_stats()
+		# Тот же формат, что у Profile.dump_stats: файл открывается pstats.Stats и snakeviz
+		return marshal.dumps(self._profile.stats)
+
+
+class _StackSampler:
+	"""Снимает стек потока запроса раз в interval секунд и считает одинаковые стеки."""
+
+	kind = 'collapsed'
+
+	def __init__(self, interval: float):
+		self.interval = interval
+		self._thread_id = threading.get_ident()
+		self._stacks: Counter[str] = Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+		self._thread.start()
+
+	def _run(self) -> None:
+		while not self._stop.wait(self.interval):
+			frame = sys._current_frames().get(self._thread_id)
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+				frame = frame.f_back
+			if stack:
+				self._stacks[';'.join(reversed(stack))] += 1
+
+	def stop(self) -> bytes:
+		self._stop.set()
+		self._thread.join()
+		return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common()).encode()
+
+
+def _start_profile():
+	token = request.headers.get(PROFILE_HEADER)
+	rate = get_setting('profiling.sample_rate')
+	if not token and not rate:
+		return None
+	settings = profiling_settings()
+	if token:
+		if not _valid_token(token):
+			return None
+	elif settings.endpoints and request.endpoint not in settings.endpoints:
+		return None
+	elif random.random() >= settings.sample_rate:
+		return None
+
+	if settings.mode == 'stack':
+		interval = current_app.config.get('PROFILE_SAMPLE_INTERVAL', DEFAULT_SAMPLE_INTERVAL)
+		g.request_profiler = _StackSampler(interval)
+	else:
+		try:
+			g.request_profiler = _CProfiler()
+		except ValueError:
+			# Другой профилировщик уже активен в этом потоке
+			return None
+	g.request_profile_started = time.perf_counter()
+	return None
+
+
+def _finish_profile(response):
+	profiler = g.pop('request_profiler', None)
+	if profiler is None:
+		return response
+	data = profiler.stop()
+	duration_ms = (time.perf_counter() - g.pop('request_profile_started')) * 1000
+	try:
+		store_profile(
+			request.endpoint or 'unknown', request.method, request.path, response.status_code,
+			duration_ms, profiler.kind, data,
+		)
+	except Exception:
+		current_app.logger.exception('Failed to store request profile')
+	return response
+
+
+def _discard_profile(error=None):
+	profiler = g.pop('request_profiler', None)
+	if profiler is not None:
+		profiler.stop()
+
+
+def store_profile(endpoint: str, method: str, path: str, status: int, duration_ms: float, kind: str, data: bytes) -> None:
+	"""Сохраняет профиль отдельной транзакцией и оставляет по PROFILE_RETENTION последних на endpoint."""
+	retention = current_app.config.get('PROFILE_RETENTION', DEFAULT_RETENTION)
+	with db.engine.begin() as connection:
+		connection.execute(db.insert(RequestProfile).values(
+			endpoint=endpoint[:120],
+			method=method[:8],
+			path=path[:255],
+			status=status,
+			duration_ms=duration_ms,
+			kind=kind,
+			data=zlib.compress(data),
+		))
+		cutoff = connection.execute(
+			db.select(RequestProfile.id)
+			.where(RequestProfile.endpoint == endpoint[:120])
+			.order_by(RequestProfile.id.desc())
+			.offset(retention)
+			.limit(1)
+		).scalar()
+		if cutoff is not None:
+			connection.execute(
+				db.delete(RequestProfile).where(RequestProfile.endpoint == endpoint[:120], RequestProfile.id <= cutoff)
+			)
+
+
+def recent_profiles(limit: int = 200) -> list:
+	return db.session.execute(
+		db.select(
+			RequestProfile.id, RequestProfile.endpoint, RequestProfile.method, RequestProfile.path,
+			RequestProfile.status, RequestProfile.duration_ms, RequestProfile.kind, RequestProfile.created_at,
+		)
+		.order_by(RequestProfile.endpoint, RequestProfile.id.desc())
+		.limit(limit)
+	).all()
+
+
+def profile_file(profile_id: int) -> tuple[str, str, bytes] | None:
+	"""Имя файла, MIME-тип и содержимое профиля для скачивания."""
+	profile = db.session.get(RequestProfile, profile_id)
+	if profile is None:
+		return None
+	extension, mimetype = PROFILE_FILES[profile.kind]
+	return f'{profile.endpoint}-{profile.id}.{extension}', mimetype, zlib.decompress(profile.data)
+
+
+def clear_profiles() -> int:
+	count = db.session.execute(db.delete(RequestProfile)).rowcount
+	db.session.commit()
+	return count
+
+
+def init_profiling(app: Flask) -> None:
+	app.before_request(_start_profile)
+	app.after_request(_finish_profile)
+	app.teardown_request(_discard_profile)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import math
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from flask import current_app
+
+from . import db
+from .models import Chat, Favorite, JobWatermark, Listing, ListingRanking, ListingViewCount
+
+
+WATERMARK_NAME = 'listing_rankings'
+EPOCH = datetime(2024, 1, 1)
+DEFAULT_HALF_LIFE_HOURS = 72
+DEFAULT_LOOKBACK_DAYS = 30
+DEFAULT_WEIGHTS = {'favorite': 3.0, 'chat': 5.0, 'view': 0.2}
+BATCH_SIZE = 500
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+
+def event_exponent(moment: datetime, half_life_hours: float) -> float:
+	tau = half_life_hours / math.log(2)
+	return (moment - EPOCH).total_seconds() / 3600 / tau
+
+
+def decayed_score(events: list[tuple[float, datetime]], half_life_hours: float) -> float:
+	"""Логарифм суммы w·exp((t - EPOCH)/τ).
+
+	Все объявления затухают с одинаковой скоростью, поэтому порядок по такой оценке
+	совпадает с порядком по затухшей к текущему моменту, и объявления без новой
+	активности пересчитывать не нужно.
+	"""
+	terms = [math.log(weight) + event_exponent(moment, half_life_hours) for weight, moment in events if weight > 0]
+	if not terms:
+		return float('-inf')
+	peak = max(terms)
+	return peak + math.log(sum(math.exp(term - peak) for term in terms))
+
+
+def _settings() -> tuple[dict[str, float], float, int]:
+	config = current_app.config
+	weights = {**DEFAULT_WEIGHTS, **config.get('RANKING_WEIGHTS', {})}
+	return (
+		weights,
+		config.get('RANKING_HALF_LIFE_HOURS', DEFAULT_HALF_LIFE_HOURS),
+		config.get('RANKING_LOOKBACK_DAYS', DEFAULT_LOOKBACK_DAYS),
+	)
+
+
+def _active_listing_ids(since: datetime) -> set[int]:
+	ids = set(db.session.execute(db.select(Favorite.listing_id).where(Favorite.created_at > since)).scalars())
+	ids.update(db.session.execute(db.select(Chat.listing_id).where(Chat.created_at > since)).scalars())
+	ids.update(db.session.execute(
+		db.select(ListingViewCount.listing_id).where(ListingViewCount.updated_at > since)
+	).scalars())
+	return ids
+
+
+def _score_batch(listing_ids: list[int], cutoff: datetime, weights, half_life_hours) -> dict[int, float]:
+	events: dict[int, list[tuple[float, datetime]]] = defaultdict(list)
+	for listing_id, created_at in db.session.execute(
+		db.select(Favorite.listing_id, Favorite.created_at)
+		.where(Favorite.listing_id.in_(listing_ids), Favorite.created_at >= cutoff)
+	):
+		events[listing_id].append((weights['favorite'], created_at))
+	for listing_id, created_at in db.session.execute(
+		db.select(Chat.listing_id, Chat.created_at)
+		.where(Chat.listing_id.in_(listing_ids), Chat.created_at >= cutoff)
+	):
+		events[listing_id].append((weights['chat'], created_at))
+	for listing_id, day, views in db.session.execute(
+		db.select(ListingViewCount.listing_id, ListingViewCount.day, ListingViewCount.views)
+		.where(ListingViewCount.listing_id.in_(listing_ids), ListingViewCount.day >= cutoff.date())
+	):
+		events[listing_id].append((weights['view'] * views, datetime.combine(day, time(12))))
+	return {listing_id: decayed_score(items, half_life_hours) for listing_id, items in events.items()}
+
+
+def refresh_rankings(full: bool = False, now: datetime | None = None) -> int:
+	now = now or datetime.utcnow()
+	weights, half_life_hours, lookback_days = _settings()
+	cutoff = now - timedelta(days=lookback_days)
+
+	watermark = db.session.get(JobWatermark, WATERMARK_NAME)
+	since = cutoff if full or watermark is None else watermark.value - WATERMARK_OVERLAP
+	ordered = sorted(_active_listing_ids(since))
+	for start in range(0, len(ordered), BATCH_SIZE):
+		batch = ordered[start:start + BATCH_SIZE]
+		scores = _score_batch(batch, cutoff, weights, half_life_hours)
+		db.session.execute(db.delete(ListingRanking).where(ListingRanking.listing_id.in_(batch)))
+		rows = [
+			{'listing_id': listing_id, 'score': score, 'updated_at': now}
+			for listing_id, score in scores.items()
+			if score != float('-inf')
+		]
+		if rows:
+			db.session.execute(db.insert(ListingRanking), rows)
+		db.session.commit()
+
+	if full:
+		db.session.execute(db.delete(ListingRanking).where(ListingRanking.updated_at < now))
+
+	if watermark is None:
+		db.session.add(JobWatermark(name=WATERMARK_NAME, value=now))
+	else:
+		watermark.value = now
+	db.session.commit()
+	return len(ordered)
+
+
+def order_by_popularity(query, listing_id=Listing.id):
+	"""Объявления без строки рейтинга (новые, до следующего refresh-rankings) идут с нулевым счётом."""
+	return query.outerjoin(ListingRanking, ListingRanking.listing_id == listing_id).order_by(
+		db.func.coalesce(ListingRanking.score, 0).desc(), listing_id.desc()
+	)
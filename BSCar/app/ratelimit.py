@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import math
+import re
+import threading
+import time
+from typing import NamedTuple
+
+from flask import Flask, Response, current_app, request, session
+
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+DEFAULT_LIMITS = {
+	'main.login_post': {'ip': '10/minute'},
+	'main.register_post': {'ip': '5/hour'},
+	'main.send_message': {'user': '30/minute', 'ip': '60/minute'},
+	'main.create_listing': {'user': '10/hour', 'ip': '20/hour'},
+	'main.report_listing': {'user': '20/hour'},
+	'main.create_support_ticket': {'user': '5/hour'},
+}
+
+
+class Limit(NamedTuple):
+	amount: int
+	period: int
+
+	@classmethod
+	def parse(cls, value: str) -> Limit:
+		match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*', value)
+		if not match:
+			raise ValueError(f'Invalid rate limit: {value!r}')
+		amount, multiplier, unit = match.groups()
+		return cls(int(amount), int(multiplier or 1) * PERIODS[unit])
+
+
+class MemoryBackend:
+	"""Token bucket на ключ в памяти процесса."""
+
+	SWEEP_INTERVAL = 60.0
+
+	def __init__(self):
+		# ключ -> (токены, время обновления, момент, когда корзина снова полная)
+		self._buckets: dict[str, tuple[float, float, float]] = {}
+		self._lock = threading.Lock()
+		self._next_sweep = 0.0
+
+	def hit(self, key: str, limit: Limit, now: float | None = None) -> float:
+		return self.hit_many([(key, limit)], now)
+
+	def hit_many(self, rules: list[tuple[str, Limit]], now: float | None = None) -> float:
+		"""Списывает токен со всех ключей или, если хоть один отказал, ни с одного."""
+		now = time.monotonic() if now is None else now
+		with self._lock:
+			if now >= self._next_sweep:
+				self._evict(now)
+			buckets = []
+			retry_after = 0.0
+			for key, limit in rules:
+				rate = limit.amount / limit.period
+				tokens, updated, _ = self._buckets.get(key, (float(limit.amount), now, now))
+				tokens = min(float(limit.amount), tokens + (now - updated) * rate)
+				if tokens < 1:
+					retry_after = max(retry_after, (1 - tokens) / rate)
+				buckets.append((key, limit, rate, tokens))
+			if retry_after > 0:
+				return retry_after
+			for key, limit, rate, tokens in buckets:
+				tokens -= 1
+				self._buckets[key] = (tokens, now, now + (limit.amount - tokens) / rate)
+			return 0.0
+
+	def _evict(self, now: float) -> None:
+		# Снова полная корзина ничем не отличается от отсутствующей
+		stale = [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]
+		for key in stale:
+			del self._buckets[key]
+		self._next_sweep = now + self.SWEEP_INTERVAL
+
+
+class LocalStore:
+	"""Стенд-ин для общего хранилища (подмножество команд Redis) для тестов и одного процесса."""
+
+	def __init__(self):
+		self._data: dict[str, tuple[int, float]] = {}
+		self._lock = threading.Lock()
+
+	def incr(self, key: str, ttl: int) -> int:
+		now = time.time()
+		with self._lock:
+			value, expires = self._data.get(key, (0, 0.0))
+			if expires <= now:
+				value, expires = 0, now + ttl
+			value += 1
+			self._data[key] = (value, expires)
+			return value
+
+	def decr(self, key: str) -> int:
+		with self._lock:
+			value, expires = self._data.get(key, (0, 0.0))
+			self._data[key] = (value - 1, expires)
+			return value - 1
+
+	def get(self, key: str) -> int:
+		value, expires = self._data.get(key, (0, 0.0))
+		return value if expires > time.time() else 0
+
+
+class RedisStore:
+	def __init__(self, url: str):
+		import redis
+
+		self._client = redis.Redis.from_url(url)
+
+	def incr(self, key: str, ttl: int) -> int:
+		# MULTI/EXEC: увеличение и срок жизни ключа атомарны
+		pipe = self._client.pipeline(transaction=True)
+		pipe.incr(key)
+		pipe.expire(key, ttl, nx=True)
+		value, _ = pipe.execute()
+		return int(value)
+
+	def decr(self, key: str) -> int:
+		return int(self._client.decr(key))
+
+	def get(self, key: str) -> int:
+		return int(self._client.get(key) or 0)
+
+
+class SharedStoreBackend:
+	"""Скользящее окно поверх общего хранилища: лимиты общие для всех воркеров.
+
+	Счётчик текущего окна сначала атомарно увеличивается, решение принимается по возвращённому
+	значению; при отказе увеличения откатываются, так что одновременные запросы не проходят сверх лимита.
+	"""
+
+	def __init__(self, store, prefix: str = 'rl'):
+		self.store = store
+		self.prefix = prefix
+
+	def hit(self, key: str, limit: Limit, now: float | None = None) -> float:
+		return self.hit_many([(key, limit)], now)
+
+	def hit_many(self, rules: list[tuple[str, Limit]], now: float | None = None) -> float:
+		"""Учитывает запрос во всех ключах или, если хоть один отказал, ни в одном."""
+		now = time.time() if now is None else now
+		counted = []
+		retry_after = 0.0
+		for key, limit in rules:
+			window = int(now // limit.period)
+			elapsed = (now % limit.period) / limit.period
+			current_key = f'{self.prefix}:{key}:{window}'
+			current = self.store.incr(current_key, limit.period * 2)
+			counted.append(current_key)
+			previous = self.store.get(f'{self.prefix}:{key}:{window - 1}')
+			if previous * (1 - elapsed) + current > limit.amount:
+				if current > limit.amount:
+					wait = (1 - elapsed) * limit.period
+				else:
+					needed = (previous * (1 - elapsed) + current - limit.amount) / max(previous, 1)
+					wait = max(needed * limit.period, 1.0)
+				retry_after = max(retry_after, wait)
+		if retry_after > 0:
+			for current_key in counted:
+				self.store.decr(current_key)
+		return retry_after
+
+
+class LimiterState(NamedTuple):
+	backend: object
+	limits: dict[str, dict[str, Limit]]
+
+
+class RateLimiter:
+	def __init__(self, app: Flask | None = None):
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app: Flask) -> None:
+		app.config.setdefault('RATELIMIT_ENABLED', True)
+		app.config.setdefault('RATELIMIT_BACKEND', 'memory')
+		app.config.setdefault('RATELIMIT_STORAGE_URL', None)
+		app.config.setdefault('RATELIMIT_LIMITS', {})
+
+		backend = app.config['RATELIMIT_BACKEND']
+		if backend == 'memory':
+			backend = MemoryBackend()
+		elif backend == 'local':
+			backend = SharedStoreBackend(LocalStore())
+		elif backend == 'redis':
+			backend = SharedStoreBackend(RedisStore(app.config['RATELIMIT_STORAGE_URL']))
+		else:
+			raise ValueError(f'Unknown rate limit backend: {backend}')
+
+		limits = {endpoint: dict(rules) for endpoint, rules in DEFAULT_LIMITS.items()}
+		for endpoint, rules in app.config['RATELIMIT_LIMITS'].items():
+			limits[endpoint] = dict(rules or {})
+		parsed = {
+			endpoint: {scope: Limit.parse(value) for scope, value in rules.items()}
+			for endpoint, rules in limits.items()
+		}
+		app.extensions['ratelimit'] = LimiterState(backend, parsed)
+		app.before_request(self._check)
+
+	def _check(self):
+		retry_after = check_limits(request.endpoint, session.get('user_id'), request.remote_addr)
+		if retry_after > 0:
+			response = Response('Слишком много запросов. Попробуйте позже.', status=429, mimetype='text/plain')
+			response.headers['Retry-After'] = str(math.ceil(retry_after))
+			return response
+		return None
+
+
+def limit_rules(state: LimiterState, endpoint: str | None, user_id: int | None, ip: str | None) -> list[tuple[str, Limit]]:
+	"""Ключи и лимиты endpoint'а для пользователя и IP; области без идентификатора пропускаются."""
+	rules = []
+	for scope, limit in state.limits.get(endpoint, {}).items():
+		identity = user_id if scope == 'user' else ip
+		if identity is not None:
+			rules.append((f'{endpoint}:{scope}:{identity}', limit))
+	return rules
+
+
+def check_limits(endpoint: str | None, user_id: int | None, ip: str | None) -> float:
+	"""Учитывает запрос к endpoint'у; возвращает через сколько секунд повторить (0 — запрос разрешён)."""
+	if not current_app.config['RATELIMIT_ENABLED']:
+		return 0.0
+	state = current_app.extensions['ratelimit']
+	rules = limit_rules(state, endpoint, user_id, ip)
+	if not rules:
+		return 0.0
+	return state.backend.hit_many(rules)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime
+from types import MappingProxyType
+from typing import Callable, Mapping, NamedTuple
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import CacheVersion, SiteSetting
+
+
+DEFAULT_CHECK_INTERVAL = 5.0
+
+
+class Reference(NamedTuple):
+	loader: Callable[[], object]
+	models: tuple[type, ...]
+
+
+_references: dict[str, Reference] = {}
+_snapshots: dict[str, tuple[int, object]] = {}
+_versions: dict[str, int] = {}
+_checked_at = float('-inf')
+_lock = threading.Lock()
+
+
+def register_reference(name: str, loader: Callable[[], object], models=()) -> None:
+	"""Регистрирует справочник: loader возвращает неизменяемый снимок, изменения models сбрасывают его во всех воркерах."""
+	_references[name] = Reference(loader, tuple(models))
+
+
+def _check_versions() -> None:
+	global _checked_at, _versions
+	interval = current_app.config.get('REFERENCE_CACHE_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+	if time.monotonic() - _checked_at < interval:
+		return
+	with _lock:
+		if time.monotonic() - _checked_at < interval:
+			return
+		versions = dict(db.session.execute(db.select(CacheVersion.name, CacheVersion.version)).all())
+		for name, (version, _) in list(_snapshots.items()):
+			if versions.get(name, 0) != version:
+				del _snapshots[name]
+		_versions = versions
+		_checked_at = time.monotonic()
+
+
+def reference(name: str):
+	_check_versions()
+	snapshot = _snapshots.get(name)
+	if snapshot is not None:
+		return snapshot[1]
+	with _lock:
+		snapshot = _snapshots.get(name)
+		if snapshot is None:
+			snapshot = (_versions.get(name, 0), _references[name].loader())
+			_snapshots[name] = snapshot
+		return snapshot[1]
+
+
+def invalidate(name: str | None = None) -> None:
+	global _checked_at
+	with _lock:
+		if name is None:
+			_snapshots.clear()
+			_checked_at = float('-inf')
+		else:
+			_snapshots.pop(name, None)
+
+
+def _bump(connection, name: str) -> None:
+	"""Увеличивает версию одним upsert: первые изменения справочника в двух транзакциях не конфликтуют по ключу."""
+	table = CacheVersion.__table__
+	now = datetime.utcnow()
+	dialect = connection.dialect.name
+	if dialect == 'mysql':
+		from sqlalchemy.dialects.mysql import insert
+		stmt = insert(table).values(name=name, version=1, updated_at=now)
+		stmt = stmt.on_duplicate_key_update(version=table.c.version + 1, updated_at=stmt.inserted.updated_at)
+	elif dialect in ('sqlite', 'postgresql'):
+		if dialect == 'sqlite':
+			from sqlalchemy.dialects.sqlite import insert
+		else:
+			from sqlalchemy.dialects.postgresql import insert
+		stmt = insert(table).values(name=name, version=1, updated_at=now)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[table.c.name],
+			set_={'version': table.c.version + 1, 'updated_at': stmt.excluded.updated_at},
+		)
+	else:
+		raise RuntimeError(f'Reference cache version upsert is not supported for {dialect}')
+	connection.execute(stmt)
+
+
+def bump_version(name: str) -> None:
+	"""Для массовых UPDATE в обход ORM: версия меняется в текущей транзакции, снимок сбрасывается после commit."""
+	_bump(db.session.connection(), name)
+	db.session.info.setdefault('references_changed', set()).add(name)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_changed_references(session, flush_context):
+	changed = session.new | session.dirty | session.deleted
+	if not changed:
+		return
+	bumped = session.info.setdefault('references_changed', set())
+	for name, ref in _references.items():
+		if name not in bumped and ref.models and any(isinstance(obj, ref.models) for obj in changed):
+			_bump(session.connection(), name)
+			bumped.add(name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+	for name in session.info.pop('references_changed', ()):
+		invalidate(name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_reference_changes(session):
+	session.info.pop('references_changed', None)
+
+
+def load_settings() -> Mapping[str, str]:
+	return MappingProxyType(dict(db.session.execute(db.select(SiteSetting.key, SiteSetting.value)).all()))
+
+
+register_reference('settings', load_settings, models=(SiteSetting,))
+
+
+def get_setting(key: str, default: str | None = None) -> str | None:
+	return reference('settings').get(key, default)
+
+
+def set_setting(key: str, value: str | None) -> None:
+	"""Записывает настройку (None — удаляет); остальные воркеры увидят её после проверки версий."""
+	setting = db.session.get(SiteSetting, key)
+	if value is None:
+		if setting is not None:
+			db.session.delete(setting)
+	elif setting is None:
+		db.session.add(SiteSetting(key=key, value=value))
+	else:
+		setting.value = value
+	db.session.commit()
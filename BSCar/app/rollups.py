@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+from flask import current_app
+
+from . import db
+from .models import Complaint, DailyStat, Listing, Message, RollupWatermark, SupportTicket, User
+
+
+ROLLUP_BATCH_SIZE = 50000
+DEFAULT_ROLLUP_LAG_SECONDS = 60
+DASHBOARD_DAYS = 30
+
+METRICS = {
+	'users': ('Новые пользователи', User),
+	'listings': ('Новые объявления', Listing),
+	'messages': ('Сообщения', Message),
+	'complaints': ('Жалобы', Complaint),
+	'tickets': ('Обращения в поддержку', SupportTicket),
+}
+# Черновики из загрузки по частям не считаются: опубликованный черновик учитывает record_published_draft.
+METRIC_FILTERS = {
+	'listings': (Listing.status != 'draft',),
+}
+
+
+class MetricSeries(NamedTuple):
+	metric: str
+	label: str
+	values: list[int]
+	period_total: int
+	total: int
+
+	@property
+	def peak(self) -> int:
+		return max(self.values, default=0)
+
+
+class Dashboard(NamedTuple):
+	days: list[date]
+	series: list[MetricSeries]
+	updated_at: datetime | None
+
+
+def _as_date(value) -> date:
+	return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _add_counts(metric: str, counts: dict[date, int]) -> None:
+	existing = {
+		row.day: row
+		for row in db.session.execute(
+			db.select(DailyStat).where(DailyStat.metric == metric, DailyStat.day.in_(counts))
+		).scalars()
+	}
+	for day, count in counts.items():
+		if day in existing:
+			existing[day].value += count
+		else:
+			db.session.add(DailyStat(day=day, metric=metric, value=count))
+
+
+def refresh_metric(metric: str, now: datetime | None = None, batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+	"""Досчитывает дневные итоги по строкам с id выше водяного знака, пачками по batch_size id.
+
+	Строки моложе ROLLUP_LAG_SECONDS не берутся: транзакция с меньшим id могла ещё не закоммититься.
+	Водяной знак читается с блокировкой на каждую пачку, чтобы не разминуться с record_published_draft.
+	"""
+	model = METRICS[metric][1]
+	filters = METRIC_FILTERS.get(metric, ())
+	lag = current_app.config.get('ROLLUP_LAG_SECONDS', DEFAULT_ROLLUP_LAG_SECONDS)
+	settled = (now or datetime.utcnow()) - timedelta(seconds=lag)
+
+	watermark = db.session.get(RollupWatermark, metric, with_for_update=True)
+	if watermark is None:
+		watermark = RollupWatermark(metric=metric, last_id=0)
+		db.session.add(watermark)
+		db.session.flush()
+	upper = db.session.execute(
+		db.select(db.func.max(model.id)).where(model.id > watermark.last_id, model.created_at <= settled)
+	).scalar()
+	if upper is None:
+		db.session.commit()
+		return 0
+
+	processed = 0
+	while True:
+		watermark = db.session.get(RollupWatermark, metric, with_for_update=True, populate_existing=True)
+		if watermark.last_id >= upper:
+			db.session.commit()
+			break
+		end_id = min(watermark.last_id + batch_size, upper)
+		rows = db.session.execute(
+			db.select(db.func.date(model.created_at), db.func.count(model.id))
+			.where(model.id > watermark.last_id, model.id <= end_id, *filters)
+			.group_by(db.func.date(model.created_at))
+		).all()
+		_add_counts(metric, {_as_date(day): count for day, count in rows})
+		watermark.last_id = end_id
+		watermark.updated_at = datetime.utcnow()
+		db.session.commit()
+		processed += sum(count for _, count in rows)
+	return processed
+
+
+def refresh_rollups(now: datetime | None = None, batch_size: int = ROLLUP_BATCH_SIZE) -> dict[str, int]:
+	return {metric: refresh_metric(metric, now, batch_size) for metric in METRICS}
+
+
+def record_published_draft(listing: Listing) -> None:
+	"""Учитывает публикацию черновика в той же транзакции, если водяной знак уже прошёл его id.
+
+	Черновик с id выше водяного знака досчитает refresh_metric: он к тому времени уже не черновик.
+	"""
+	watermark = db.session.get(RollupWatermark, 'listings', with_for_update=True, populate_existing=True)
+	if watermark is not None and listing.id <= watermark.last_id:
+		_add_counts('listings', {(listing.created_at or datetime.utcnow()).date(): 1})
+
+
+def dashboard(days: int = DASHBOARD_DAYS, today: date | None = None) -> Dashboard:
+	"""Ряды по дням за последние days дней: читает не больше days * len(METRICS) строк daily_stats."""
+	today = today or datetime.utcnow().date()
+	start = today - timedelta(days=days - 1)
+	day_list = [start + timedelta(days=offset) for offset in range(days)]
+
+	values: dict[str, dict[date, int]] = {metric: {} for metric in METRICS}
+	for day, metric, value in db.session.execute(
+		db.select(DailyStat.day, DailyStat.metric, DailyStat.value).where(DailyStat.day >= start, DailyStat.day <= today)
+	):
+		if metric in values:
+			values[metric][day] = value
+	totals = dict(db.session.execute(
+		db.select(DailyStat.metric, db.func.sum(DailyStat.value)).group_by(DailyStat.metric)
+	).all())
+	updated_at = db.session.execute(db.select(db.func.max(RollupWatermark.updated_at))).scalar()
+
+	series = []
+	for metric, (label, _) in METRICS.items():
+		daily = [values[metric].get(day, 0) for day in day_list]
+		series.append(MetricSeries(metric, label, daily, sum(daily), int(totals.get(metric) or 0)))
+	return Dashboard(day_list, series, updated_at)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from typing import Callable, NamedTuple
+
+from sqlalchemy import inspect, text
+
+from . import db
+from .backfill import backfill, run_pending_backfills
+from .cards import rebuild_cards
+from .categories import rebuild_category_paths
+from .duplicates import hash_image_range
+from .models import Listing, ListingImage, SavedSearch
+from .searches import rebuild_search_terms
+from .storage import LISTINGS_PREFIX, get_storage, storage_key
+
+
+class AddColumn(NamedTuple):
+	table: str
+	column: str
+	ddl: str
+
+	def pending(self, inspector) -> bool:
+		return self.column not in {column['name'] for column in inspector.get_columns(self.table)}
+
+	def apply(self) -> None:
+		db.session.execute(text(f'ALTER TABLE {self.table} ADD COLUMN {self.column} {self.ddl}'))
+
+	def __str__(self) -> str:
+		return f'column {self.table}.{self.column}'
+
+
+class AddIndex(NamedTuple):
+	table: str
+	name: str
+	columns: str
+	unique: bool = False
+
+	def pending(self, inspector) -> bool:
+		existing = {index['name'] for index in inspector.get_indexes(self.table)}
+		existing.update(constraint['name'] for constraint in inspector.get_unique_constraints(self.table))
+		return self.name not in existing
+
+	def apply(self) -> None:
+		unique = 'UNIQUE ' if self.unique else ''
+		db.session.execute(text(f'CREATE {unique}INDEX {self.name} ON {self.table} ({self.columns})'))
+
+	def __str__(self) -> str:
+		return f'index {self.name}'
+
+
+SCHEMA_STEPS = [
+	AddColumn('users', 'avatar_filename', 'VARCHAR(255) NULL'),
+	AddColumn('categories', 'path', 'VARCHAR(255) NULL'),
+	AddIndex('categories', 'ix_categories_path', 'path'),
+	AddIndex('complaints', 'ix_complaints_status_listing', 'status, listing_id'),
+	AddIndex('support_tickets', 'ix_support_tickets_status_created', 'status, created_at'),
+	AddColumn('listings', 'external_id', 'VARCHAR(64) NULL'),
+	AddIndex('listings', 'uq_listings_owner_external', 'owner_id, external_id', unique=True),
+	AddIndex('listings', 'ix_listings_status_created', 'status, created_at'),
+	AddColumn('listings', 'city', 'VARCHAR(120) NULL'),
+	AddColumn('listings', 'latitude', 'FLOAT NULL'),
+	AddColumn('listings', 'longitude', 'FLOAT NULL'),
+	AddColumn('listings', 'geohash', 'VARCHAR(12) NULL'),
+	AddIndex('listings', 'ix_listings_geohash', 'geohash'),
+	AddColumn('archived_listings', 'city', 'VARCHAR(120) NULL'),
+	AddColumn('archived_listings', 'latitude', 'FLOAT NULL'),
+	AddColumn('archived_listings', 'longitude', 'FLOAT NULL'),
+	AddColumn('archived_listings', 'geohash', 'VARCHAR(12) NULL'),
+	AddColumn('listing_images', 'phash', 'BIGINT NULL'),
+	AddColumn('archived_listing_images', 'phash', 'BIGINT NULL'),
+	AddIndex('listings', 'ix_listings_updated', 'updated_at'),
+	AddColumn('listing_images', 'phash_claim', 'VARCHAR(32) NULL'),
+	AddColumn('listing_images', 'phash_claimed_at', 'DATETIME NULL'),
+	AddColumn('archived_listing_images', 'phash_claim', 'VARCHAR(32) NULL'),
+	AddColumn('archived_listing_images', 'phash_claimed_at', 'DATETIME NULL'),
+]
+
+
+def upgrade_schema(log: Callable[[str], None] = print, **backfill_options) -> None:
+	"""Создаёт недостающие таблицы, колонки и индексы, затем выполняет незавершённые backfill-задачи."""
+	db.create_all()
+	inspector = inspect(db.engine)
+	for step in SCHEMA_STEPS:
+		if step.pending(inspector):
+			log(f'Adding {step} ...')
+			step.apply()
+			db.session.commit()
+
+	log(f'Category paths rebuilt: {rebuild_category_paths()}')
+
+	for result in run_pending_backfills(progress=lambda state: log(str(state)), **backfill_options):
+		log(f'Backfill {result.name}: {result.rows_done} rows, {"done" if result.done else "paused"}')
+
+
+backfill('listing_cards', Listing.id, batch_size=500)(rebuild_cards)
+backfill('listing_image_phash', ListingImage.id, batch_size=200)(hash_image_range)
+backfill('saved_search_terms', SavedSearch.id, batch_size=500)(rebuild_search_terms)
+
+
+@backfill('listing_image_sizes', ListingImage.id)
+def fill_listing_image_sizes(start_id: int, end_id: int) -> int:
+	"""Размер файла для старых фотографий объявлений без file_size."""
+	storage = get_storage()
+	rows = db.session.execute(
+		db.select(ListingImage.id, ListingImage.filename).where(
+			ListingImage.id > start_id, ListingImage.id <= end_id, ListingImage.file_size.is_(None)
+		)
+	).all()
+	updates = [
+		{'id': image_id, 'file_size': size}
+		for image_id, filename in rows
+		if (size := storage.size(storage_key(LISTINGS_PREFIX, filename))) is not None
+	]
+	if updates:
+		db.session.execute(db.update(ListingImage), updates)
+	return len(updates)
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import re
+from datetime import datetime
+from decimal import Decimal
+
+from . import db
+from .categories import get_category_tree
+from .models import Listing, SavedSearch, SavedSearchTerm, SearchMatch
+
+
+MAX_TERM_LENGTH = 64
+# Слова запроса индексируются триграммами: ключей у объявления не больше трёх на символ названия
+NGRAM = 3
+MAX_SAVED_SEARCHES = 20
+INBOX_SIZE = 50
+# Терм поиска без слов и категории: такой поиск совпадает с любым объявлением по цене
+MATCH_ALL_TERM = ''
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def search_terms(text: str | None) -> list[str]:
+	return list(dict.fromkeys(word[:MAX_TERM_LENGTH] for word in _WORD_RE.findall((text or '').casefold())))
+
+
+def _category_term(category_id: int) -> str:
+	return f'cat:{category_id}'
+
+
+def _word_grams(word: str) -> set[str]:
+	"""Триграммы слова запроса; короткое слово — целиком."""
+	if len(word) <= NGRAM:
+		return {word}
+	return {word[i:i + NGRAM] for i in range(len(word) - NGRAM + 1)}
+
+
+def _search_terms(query: str | None, category_id: int | None) -> list[str]:
+	terms = sorted({gram for word in search_terms(query) for gram in _word_grams(word)})
+	if category_id is not None:
+		terms.append(_category_term(category_id))
+	return terms or [MATCH_ALL_TERM]
+
+
+def _listing_keys(title: str, category_id: int | None) -> set[str]:
+	"""Все термы, под которыми объявление может совпасть: подстроки слов названия длиной до NGRAM и категории-предки.
+
+	Поиск на сайте ищет запрос подстрокой в названии, поэтому все триграммы слова запроса есть
+	в каком-то слове названия; точное совпадение проверяет matches_query.
+	"""
+	keys = {MATCH_ALL_TERM}
+	for word in search_terms(title):
+		keys.update(
+			word[start:start + size]
+			for size in range(1, NGRAM + 1)
+			for start in range(len(word) - size + 1)
+		)
+	if category_id is not None:
+		keys.update(_category_term(node.id) for node in get_category_tree().ancestors(category_id))
+	return keys
+
+
+def save_search(
+	user_id: int,
+	query: str,
+	category_id: int | None = None,
+	min_price: Decimal | None = None,
+	max_price: Decimal | None = None,
+) -> SavedSearch:
+	"""Сохраняет поиск и его термы; совпадение — как у поиска на главной (запрос — подстрока названия)."""
+	count = db.session.execute(
+		db.select(db.func.count(SavedSearch.id)).where(SavedSearch.user_id == user_id)
+	).scalar()
+	if count >= MAX_SAVED_SEARCHES:
+		raise ValueError(f'Можно сохранить не больше {MAX_SAVED_SEARCHES} поисков')
+
+	terms = _search_terms(query, category_id)
+	search = SavedSearch(
+		user_id=user_id,
+		query=(query or '').strip()[:200],
+		category_id=category_id,
+		min_price=min_price,
+		max_price=max_price,
+		term_count=len(terms),
+		terms=[SavedSearchTerm(term=term) for term in terms],
+	)
+	db.session.add(search)
+	db.session.commit()
+	return search
+
+
+def rebuild_search_terms(start_id: int, end_id: int) -> int:
+	"""Термы сохранённых поисков в формате триграмм."""
+	searches = db.session.execute(
+		db.select(SavedSearch.id, SavedSearch.query, SavedSearch.category_id)
+		.where(SavedSearch.id > start_id, SavedSearch.id <= end_id)
+	).all()
+	if not searches:
+		return 0
+	ids = [search_id for search_id, _, _ in searches]
+	db.session.execute(db.delete(SavedSearchTerm).where(SavedSearchTerm.saved_search_id.in_(ids)))
+	terms = {search_id: _search_terms(query, category_id) for search_id, query, category_id in searches}
+	db.session.execute(db.insert(SavedSearchTerm), [
+		{'term': term, 'saved_search_id': search_id} for search_id, items in terms.items() for term in items
+	])
+	db.session.execute(db.update(SavedSearch), [
+		{'id': search_id, 'term_count': len(items)} for search_id, items in terms.items()
+	])
+	return len(searches)
+
+
+def delete_search(user_id: int, search_id: int) -> bool:
+	search = db.session.get(SavedSearch, search_id)
+	if search is None or search.user_id != user_id:
+		return False
+	db.session.execute(db.delete(SearchMatch).where(SearchMatch.saved_search_id == search_id))
+	db.session.delete(search)
+	db.session.commit()
+	return True
+
+
+def matches_query(query: str | None, title: str | None) -> bool:
+	"""То же условие, что title ILIKE '%query%' в списке объявлений."""
+	return not query or query.lower() in (title or '').lower()
+
+
+def match_listing(listing: Listing) -> int:
+	return match_listings([listing.id])
+
+
+def match_listings(listing_ids: list[int]) -> int:
+	"""Находит сохранённые поиски, под которые попадают новые объявления, и пишет совпадения во входящие.
+
+	Кандидаты на объявление — один GROUP BY по индексу saved_search_terms: поиск подходит,
+	если все его термы есть среди ключей объявления. Затем запрос проверяется точно, как на сайте.
+	"""
+	listings = db.session.execute(
+		db.select(Listing.id, Listing.title, Listing.category_id, Listing.price, Listing.owner_id)
+		.where(Listing.id.in_(listing_ids), Listing.status == 'active')
+	).all()
+	now = datetime.utcnow()
+	rows = []
+	for listing in listings:
+		matched_terms = db.func.count(SavedSearchTerm.term)
+		query = (
+			db.select(SavedSearch.id, SavedSearch.user_id, SavedSearch.query)
+			.join(SavedSearchTerm, SavedSearchTerm.saved_search_id == SavedSearch.id)
+			.where(
+				SavedSearchTerm.term.in_(_listing_keys(listing.title, listing.category_id)),
+				SavedSearch.user_id != listing.owner_id,
+			)
+			.group_by(SavedSearch.id, SavedSearch.user_id, SavedSearch.query, SavedSearch.term_count)
+			.having(matched_terms == SavedSearch.term_count)
+		)
+		if listing.price is not None:
+			query = query.where(
+				db.or_(SavedSearch.min_price.is_(None), SavedSearch.min_price <= listing.price),
+				db.or_(SavedSearch.max_price.is_(None), SavedSearch.max_price >= listing.price),
+			)
+		else:
+			query = query.where(SavedSearch.min_price.is_(None), SavedSearch.max_price.is_(None))
+		rows.extend(
+			{'user_id': user_id, 'saved_search_id': search_id, 'listing_id': listing.id, 'created_at': now}
+			for search_id, user_id, search_query in db.session.execute(query)
+			if matches_query(search_query, listing.title)
+		)
+	if rows:
+		db.session.execute(db.insert(SearchMatch), rows)
+		db.session.commit()
+	return len(rows)
+
+
+def saved_searches_for(user_id: int) -> list[SavedSearch]:
+	return db.session.execute(
+		db.select(SavedSearch).where(SavedSearch.user_id == user_id).order_by(SavedSearch.created_at.desc())
+	).scalars().all()
+
+
+def inbox(user_id: int, limit: int = INBOX_SIZE) -> list[SearchMatch]:
+	return db.session.execute(
+		db.select(SearchMatch)
+		.options(db.joinedload(SearchMatch.listing).joinedload(Listing.images), db.joinedload(SearchMatch.saved_search))
+		.join(Listing, Listing.id == SearchMatch.listing_id)
+		.where(SearchMatch.user_id == user_id, Listing.status == 'active')
+		.order_by(SearchMatch.id.desc())
+		.limit(limit)
+	).scalars().unique().all()
+
+
+def unseen_match_count(user_id: int) -> int:
+	return db.session.execute(
+		db.select(db.func.count(SearchMatch.id)).where(SearchMatch.user_id == user_id, SearchMatch.seen_at.is_(None))
+	).scalar()
+
+
+def mark_matches_seen(user_id: int) -> None:
+	db.session.execute(
+		db.update(SearchMatch)
+		.where(SearchMatch.user_id == user_id, SearchMatch.seen_at.is_(None))
+		.values(seen_at=datetime.utcnow())
+	)
+	db.session.commit()
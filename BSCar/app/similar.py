@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import math
+import re
+import zlib
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from . import db
+from .models import Category, Listing, ListingVector, SimilarListing
+
+
+TEXT_DIM = 256
+PRICE_BINS = np.linspace(10.0, 17.5, 16)
+PRICE_SIGMA = 0.35
+CATEGORY_DIM = 16
+DIM = TEXT_DIM + len(PRICE_BINS) + CATEGORY_DIM
+WEIGHTS = {'text': 1.0, 'price': 0.6, 'category': 0.5}
+TOP_K = 8
+BATCH_SIZE = 1000
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _bucket(feature: str, dim: int) -> tuple[int, float]:
+	digest = zlib.crc32(feature.encode('utf-8'))
+	return digest % dim, 1.0 if digest & 0x80000000 else -1.0
+
+
+def text_features(title: str | None, description: str | None) -> Counter[str]:
+	features: Counter[str] = Counter()
+	for word in TOKEN_RE.findall((title or '').lower()):
+		features[f'w:{word}'] += 2
+		padded = f'^{word}$'
+		for i in range(len(padded) - 2):
+			features[f'g:{padded[i:i + 3]}'] += 1
+	for word in TOKEN_RE.findall((description or '').lower()):
+		features[f'w:{word}'] += 1
+	return features
+
+
+def vectorize(rows) -> tuple[list[int], np.ndarray]:
+	"""Строит нормированные векторы для строк (id, title, description, price, category_id, parent_id)."""
+	rows = list(rows)
+	ids = [row[0] for row in rows]
+	text = np.zeros((len(rows), TEXT_DIM), dtype=np.float32)
+	category = np.zeros((len(rows), CATEGORY_DIM), dtype=np.float32)
+	log_price = np.full(len(rows), np.nan, dtype=np.float32)
+
+	for i, (_, title, description, price, category_id, parent_id) in enumerate(rows):
+		for feature, count in text_features(title, description).items():
+			index, sign = _bucket(feature, TEXT_DIM)
+			text[i, index] += sign * (1.0 + math.log(count))
+		if category_id is not None:
+			category[i, _bucket(f'c:{category_id}', CATEGORY_DIM)[0]] += 1.0
+		if parent_id is not None:
+			category[i, _bucket(f'c:{parent_id}', CATEGORY_DIM)[0]] += 0.5
+		if price:
+			log_price[i] = math.log1p(float(price))
+
+	price = np.exp(-((log_price[:, None] - PRICE_BINS[None, :]) ** 2) / (2 * PRICE_SIGMA ** 2))
+	price = np.nan_to_num(price).astype(np.float32)
+
+	parts = []
+	for name, block in (('text', text), ('price', price), ('category', category)):
+		norms = np.linalg.norm(block, axis=1, keepdims=True)
+		parts.append(WEIGHTS[name] * block / np.where(norms > 0, norms, 1.0))
+	matrix = np.hstack(parts).astype(np.float32)
+	norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+	return ids, matrix / np.where(norms > 0, norms, 1.0)
+
+
+def _listing_rows(query):
+	parent = db.aliased(Category)
+	return db.session.execute(
+		query.with_only_columns(
+			Listing.id, Listing.title, Listing.description, Listing.price, Listing.category_id, parent.id
+		)
+		.outerjoin(Category, Category.id == Listing.category_id)
+		.outerjoin(parent, parent.id == Category.parent_id)
+		.order_by(Listing.id)
+	).all()
+
+
+def _store_vectors(ids: list[int], matrix: np.ndarray, now: datetime) -> None:
+	db.session.execute(db.delete(ListingVector).where(ListingVector.listing_id.in_(ids)))
+	db.session.execute(db.insert(ListingVector), [
+		{'listing_id': listing_id, 'vector': matrix[i].astype(np.float16).tobytes(), 'updated_at': now}
+		for i, listing_id in enumerate(ids)
+	])
+
+
+def load_vectors() -> tuple[np.ndarray, np.ndarray]:
+	ids, vectors = [], []
+	for listing_id, blob in db.session.execute(
+		db.select(ListingVector.listing_id, ListingVector.vector)
+		.order_by(ListingVector.listing_id)
+		.execution_options(yield_per=BATCH_SIZE)
+	):
+		ids.append(listing_id)
+		vectors.append(np.frombuffer(blob, dtype=np.float16))
+	if not ids:
+		return np.zeros(0, dtype=np.int64), np.zeros((0, DIM), dtype=np.float32)
+	return np.asarray(ids, dtype=np.int64), np.vstack(vectors).astype(np.float32)
+
+
+def top_k(scores: np.ndarray, own_positions: np.ndarray, k: int = TOP_K) -> tuple[np.ndarray, np.ndarray]:
+	scores = scores.copy()
+	scores[np.arange(len(own_positions)), own_positions] = -np.inf
+	k = min(k, scores.shape[1] - 1)
+	if k <= 0:
+		empty = np.zeros((scores.shape[0], 0))
+		return empty.astype(np.int64), empty
+	candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+	picked = np.take_along_axis(scores, candidates, axis=1)
+	order = np.argsort(-picked, axis=1)
+	return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(picked, order, axis=1)
+
+
+def _store_neighbours(positions: np.ndarray, ids: np.ndarray, matrix: np.ndarray) -> None:
+	for start in range(0, len(positions), BATCH_SIZE):
+		chunk = positions[start:start + BATCH_SIZE]
+		neighbours, scores = top_k(matrix[chunk] @ matrix.T, chunk)
+		listing_ids = [int(ids[p]) for p in chunk]
+		db.session.execute(db.delete(SimilarListing).where(SimilarListing.listing_id.in_(listing_ids)))
+		rows = [
+			{'listing_id': listing_ids[i], 'rank': rank, 'similar_id': int(ids[neighbour]), 'score': float(score)}
+			for i in range(len(chunk))
+			for rank, (neighbour, score) in enumerate(zip(neighbours[i], scores[i]))
+			if score > 0
+		]
+		if rows:
+			db.session.execute(db.insert(SimilarListing), rows)
+		db.session.commit()
+
+
+def _chunks(ids: list[int]):
+	for start in range(0, len(ids), BATCH_SIZE):
+		yield ids[start:start + BATCH_SIZE]
+
+
+def _remove_inactive() -> list[int]:
+	"""Убирает векторы и соседей объявлений, которые больше не активны или удалены; возвращает их id."""
+	inactive = db.or_(Listing.id.is_(None), Listing.status != 'active')
+	removed = set(db.session.execute(
+		db.select(ListingVector.listing_id)
+		.outerjoin(Listing, Listing.id == ListingVector.listing_id)
+		.where(inactive)
+	).scalars())
+	for column in (SimilarListing.listing_id, SimilarListing.similar_id):
+		removed.update(db.session.execute(
+			db.select(column).outerjoin(Listing, Listing.id == column).where(inactive).distinct()
+		).scalars())
+	removed = sorted(removed)
+	for chunk in _chunks(removed):
+		db.session.execute(db.delete(ListingVector).where(ListingVector.listing_id.in_(chunk)))
+		db.session.execute(db.delete(SimilarListing).where(SimilarListing.listing_id.in_(chunk)))
+	return removed
+
+
+def _holders(listing_ids: list[int]) -> set[int]:
+	"""Объявления, у которых среди сохранённых соседей есть listing_ids."""
+	holders: set[int] = set()
+	for chunk in _chunks(listing_ids):
+		holders.update(db.session.execute(
+			db.select(SimilarListing.listing_id).where(SimilarListing.similar_id.in_(chunk)).distinct()
+		).scalars())
+	return holders
+
+
+def refresh_similar(full: bool = False) -> int:
+	"""Векторы и соседей считает только для активных объявлений.
+
+	Инкрементально пересчитываются изменённые объявления, те, у кого среди соседей есть изменённое
+	или снятое с публикации, те, у кого соседей меньше TOP_K, и те, в чей top-k входит новый вектор.
+	"""
+	now = datetime.utcnow()
+	query = db.select(Listing.id).where(Listing.status == 'active')
+	if not full:
+		query = query.outerjoin(ListingVector, ListingVector.listing_id == Listing.id).where(db.or_(
+			ListingVector.listing_id.is_(None),
+			ListingVector.updated_at < Listing.updated_at,
+		))
+	# Сначала читаем все id целиком: запись векторов на том же соединении оборвала бы
+	# незавершённый серверный курсор, а инкрементальный запрос читает ту же ListingVector.
+	pending = db.session.execute(query.order_by(Listing.id)).scalars().all()
+
+	changed: list[int] = []
+	for chunk in _chunks(pending):
+		rows = _listing_rows(db.select(Listing).where(Listing.id.in_(chunk)))
+		changed.extend(_vectorize_and_store([tuple(row) for row in rows], now))
+
+	removed = _remove_inactive()
+	holders = set() if full else _holders(sorted(set(changed) | set(removed)))
+	for chunk in _chunks(removed):
+		db.session.execute(db.delete(SimilarListing).where(SimilarListing.similar_id.in_(chunk)))
+	db.session.commit()
+
+	ids, matrix = load_vectors()
+	if not len(ids):
+		return 0
+	if full:
+		_store_neighbours(np.arange(len(ids)), ids, matrix)
+		return len(ids)
+
+	position = {int(listing_id): i for i, listing_id in enumerate(ids)}
+	dirty = np.asarray(sorted(position[i] for i in changed if i in position), dtype=np.int64)
+	affected = set(dirty.tolist())
+	affected.update(position[i] for i in holders if i in position)
+
+	kth = np.full(len(ids), -np.inf, dtype=np.float32)
+	counts = np.zeros(len(ids), dtype=np.int64)
+	for listing_id, lowest, count in db.session.execute(
+		db.select(SimilarListing.listing_id, db.func.min(SimilarListing.score), db.func.count())
+		.group_by(SimilarListing.listing_id)
+	):
+		if listing_id in position:
+			kth[position[listing_id]] = lowest
+			counts[position[listing_id]] = count
+	wanted = min(TOP_K, len(ids) - 1)
+	affected.update(np.flatnonzero(counts < wanted).tolist())
+	if len(dirty):
+		for start in range(0, len(dirty), BATCH_SIZE):
+			scores = matrix[dirty[start:start + BATCH_SIZE]] @ matrix.T
+			affected.update(np.flatnonzero((scores > kth[None, :]).any(axis=0)).tolist())
+
+	_store_neighbours(np.asarray(sorted(affected), dtype=np.int64), ids, matrix)
+	return len(affected)
+
+
+def _vectorize_and_store(rows, now: datetime) -> list[int]:
+	ids, matrix = vectorize(rows)
+	_store_vectors(ids, matrix, now)
+	return ids
+
+
+def similar_listings(listing_id: int, limit: int = TOP_K) -> list[Listing]:
+	return db.session.execute(
+		db.select(Listing)
+		.options(db.selectinload(Listing.images))
+		.join(SimilarListing, SimilarListing.similar_id == Listing.id)
+		.where(SimilarListing.listing_id == listing_id, Listing.status == 'active')
+		.order_by(SimilarListing.rank)
+		.limit(limit)
+	).scalars().all()
@@ -19,12 +19,27 @@ document.addEventListener('DOMContentLoaded', () => {
   
   if (fileInput && previewContainer) {
     fileInput.addEventListener('change', handleFileSelect);
+    const form = fileInput.form;
+    if (form && form.dataset.uploadUrl && window.fetch) {
+      form.addEventListener('submit', (event) => {
+        if (Number(form.dataset.uploading || 0) > 0) {
+          event.preventDefault();
+          alert('Дождитесь окончания загрузки фотографий');
+        }
+      });
+    }
   }
 });
 
 function handleFileSelect(event) {
   const files = event.target.files;
   const previewContainer = document.getElementById('image-preview');
+  const form = event.target.form;
+  
+  if (form && form.dataset.uploadUrl && window.fetch) {
+    handleChunkedUpload(form, event.target, previewContainer);
+    return;
+  }
   
   previewContainer.innerHTML = '';
   
@@ -71,6 +86,82 @@ function removePreview(index) {
   fileInput.files = dt.files;
 }
 
+const UPLOAD_RETRY_DELAY = 2000;
+const UPLOAD_MAX_RETRIES = 10;
+let uploadQueue = Promise.resolve();
+
+function handleChunkedUpload(form, fileInput, previewContainer) {
+  Array.from(fileInput.files).forEach((file) => {
+    if (!file.type.startsWith('image/')) {
+      alert(`Файл ${file.name} не является изображением`);
+      return;
+    }
+    if (file.size > 5 * 1024 * 1024) {
+      alert(`Файл ${file.name} слишком большой (максимум 5MB)`);
+      return;
+    }
+    const previewItem = document.createElement('div');
+    previewItem.className = 'preview-item is-uploading';
+    previewItem.innerHTML = `<img src="${URL.createObjectURL(file)}" alt="Preview"><span class="upload-progress">0%</span>`;
+    previewContainer.appendChild(previewItem);
+    const progress = previewItem.querySelector('.upload-progress');
+
+    form.dataset.uploading = Number(form.dataset.uploading || 0) + 1;
+    uploadQueue = uploadQueue
+      .then(() => uploadInChunks(form, file, progress))
+      .then(() => {
+        previewItem.classList.remove('is-uploading');
+        progress.remove();
+      })
+      .catch((error) => {
+        previewItem.classList.add('is-failed');
+        progress.textContent = error.message || 'Ошибка';
+      })
+      .finally(() => {
+        form.dataset.uploading = Number(form.dataset.uploading) - 1;
+      });
+  });
+  fileInput.value = '';
+}
+
+function uploadJSON(response) {
+  return response.json().then((data) => {
+    if (!response.ok && response.status !== 409) throw new Error(data.error || 'Ошибка загрузки');
+    return data;
+  });
+}
+
+function uploadInChunks(form, file, progress) {
+  const draftInput = document.getElementById('draft_id');
+  const body = new FormData();
+  body.append('filename', file.name);
+  body.append('size', file.size);
+  if (draftInput && draftInput.value) body.append('draft_id', draftInput.value);
+
+  return fetch(form.dataset.uploadUrl, { method: 'POST', body, credentials: 'same-origin' })
+    .then(uploadJSON)
+    .then((state) => {
+      if (draftInput) draftInput.value = state.draft_id;
+      return sendChunks(`${form.dataset.uploadUrl}/${state.upload_id}`, file, state, progress, 0);
+    });
+}
+
+function sendChunks(url, file, state, progress, retries) {
+  if (state.status !== 'pending' || state.offset >= file.size) return Promise.resolve(state);
+  progress.textContent = `${Math.floor((state.offset / file.size) * 100)}%`;
+  const chunk = file.slice(state.offset, state.offset + state.chunk_size);
+  return fetch(`${url}?offset=${state.offset}`, { method: 'PUT', body: chunk, credentials: 'same-origin' })
+    .then(uploadJSON)
+    .then((next) => sendChunks(url, file, { ...state, ...next }, progress, 0))
+    .catch((error) => {
+      if (retries >= UPLOAD_MAX_RETRIES) throw error;
+      return new Promise((resolve) => setTimeout(resolve, UPLOAD_RETRY_DELAY))
+        .then(() => fetch(url, { credentials: 'same-origin' }))
+        .then(uploadJSON)
+        .then((current) => sendChunks(url, file, { ...state, ...current }, progress, retries + 1));
+    });
+}
+
 function changeMainImage(thumbnail) {
   const mainImage = document.getElementById('main-image');
   if (mainImage && thumbnail) {
@@ -111,6 +202,53 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 });
 
+function appendChatMessage(container, message) {
+  const empty = container.querySelector('.no-messages');
+  if (empty) empty.remove();
+  const own = String(message.author_id) === container.dataset.userId;
+  const item = document.createElement('div');
+  item.className = `message ${own ? 'message-own' : 'message-other'}`;
+  const time = message.created_at ? message.created_at.slice(11, 16) : '';
+  item.innerHTML = '<div class="message-content"><p></p><span class="message-time"></span></div>';
+  item.querySelector('p').textContent = message.content;
+  item.querySelector('.message-time').textContent = time;
+  container.appendChild(item);
+  container.scrollTop = container.scrollHeight;
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  const container = document.getElementById('chat-messages');
+  if (!container || !container.dataset.eventsUrl || !window.EventSource) return;
+  const seen = new Set();
+  const source = new EventSource(`${container.dataset.eventsUrl}?after=${container.dataset.lastId}`);
+  source.onmessage = (event) => {
+    const message = JSON.parse(event.data);
+    if (seen.has(message.id)) return;
+    seen.add(message.id);
+    appendChatMessage(container, message);
+  };
+
+  const form = document.querySelector('.message-form');
+  if (!form || !window.fetch) return;
+  form.addEventListener('submit', (event) => {
+    event.preventDefault();
+    const input = form.querySelector('.message-input');
+    const content = input.value.trim();
+    if (!content) return;
+    fetch(container.dataset.sendUrl, {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ content }),
+    })
+      .then((response) => response.json().then((data) => {
+        if (!response.ok) throw new Error(data.error || 'Ошибка отправки');
+        input.value = '';
+      }))
+      .catch((error) => alert(error.message));
+  });
+});
+
 function showAddAdminForm() {
     document.getElementById('add-admin-form').style.display = 'block';
     document.getElementById('block-user-form').style.display = 'none';
@@ -140,3 +278,77 @@ function showDeleteListingForm() {
 function hideDeleteListingForm() {
     document.getElementById('delete-listing-form').style.display = 'none';
 }
+
+const SUPPORT_POLL_INTERVAL = 60 * 1000;
+
+function refreshSupportBadge(link, badge) {
+  fetch(link.dataset.pendingUrl, { credentials: 'same-origin' })
+    .then((response) => (response.ok ? response.json() : null))
+    .then((data) => {
+      if (!data) return;
+      badge.textContent = data.pending;
+      badge.hidden = data.pending === 0;
+    })
+    .catch(() => {});
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  const link = document.querySelector('[data-pending-url]');
+  const badge = document.getElementById('support-pending-badge');
+  if (!link || !badge) return;
+  refreshSupportBadge(link, badge);
+  setInterval(() => {
+    if (!document.hidden) refreshSupportBadge(link, badge);
+  }, SUPPORT_POLL_INTERVAL);
+});
+
+const SUGGEST_DELAY = 120;
+
+function renderSuggestions(list, suggestions) {
+  list.innerHTML = '';
+  suggestions.forEach((item) => {
+    const link = document.createElement('a');
+    link.href = item.url;
+    const text = document.createElement('span');
+    text.textContent = item.kind === 'category' ? `${item.text} · категория` : item.text;
+    const count = document.createElement('span');
+    count.className = 'count';
+    count.textContent = item.count;
+    link.append(text, count);
+    const entry = document.createElement('li');
+    entry.appendChild(link);
+    list.appendChild(entry);
+  });
+  list.hidden = suggestions.length === 0;
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  const input = document.querySelector('[data-suggest-url]');
+  const list = input && input.form.querySelector('.suggestions');
+  if (!input || !list || !window.fetch) return;
+  let timer = null;
+  let latest = '';
+  input.addEventListener('input', () => {
+    clearTimeout(timer);
+    const query = input.value.trim();
+    latest = query;
+    if (!query) {
+      renderSuggestions(list, []);
+      return;
+    }
+    timer = setTimeout(() => {
+      fetch(`${input.dataset.suggestUrl}?q=${encodeURIComponent(query)}`, { credentials: 'same-origin' })
+        .then((response) => (response.ok ? response.json() : { suggestions: [] }))
+        .then((data) => {
+          if (query === latest) renderSuggestions(list, data.suggestions);
+        })
+        .catch(() => {});
+    }, SUGGEST_DELAY);
+  });
+  input.addEventListener('keydown', (event) => {
+    if (event.key === 'Escape') list.hidden = true;
+  });
+  document.addEventListener('click', (event) => {
+    if (!input.form.contains(event.target)) list.hidden = true;
+  });
+});
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import tempfile
+import uuid
+from typing import IO
+
+from flask import Flask, abort, current_app, redirect, send_file
+
+
+READ_BLOCK = 64 * 1024
+DEFAULT_URL_EXPIRES = 300
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+LISTINGS_PREFIX = 'listings'
+AVATARS_PREFIX = 'avatars'
+
+
+def _copy(source: IO[bytes], target: IO[bytes]) -> int:
+	size = 0
+	while block := source.read(READ_BLOCK):
+		target.write(block)
+		size += len(block)
+	return size
+
+
+def _write_atomic(path: str, stream: IO[bytes]) -> int:
+	folder = os.path.dirname(path)
+	os.makedirs(folder, exist_ok=True)
+	fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as target:
+			size = _copy(stream, target)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+	return size
+
+
+class LocalStorage:
+	"""Файлы в каталоге на диске: один узел или общий для узлов том."""
+
+	def __init__(self, root: str):
+		self.root = os.path.abspath(root)
+
+	def _path(self, key: str) -> str:
+		path = os.path.normpath(os.path.join(self.root, key))
+		if not path.startswith(self.root + os.sep):
+			raise ValueError(f'Invalid storage key: {key}')
+		return path
+
+	def put(self, key: str, stream: IO[bytes]) -> int:
+		return _write_atomic(self._path(key), stream)
+
+	def open(self, key: str) -> IO[bytes]:
+		return open(self._path(key), 'rb')
+
+	def size(self, key: str) -> int | None:
+		path = self._path(key)
+		return os.path.getsize(path) if os.path.isfile(path) else None
+
+	def delete(self, key: str) -> None:
+		try:
+			os.remove(self._path(key))
+		except FileNotFoundError:
+			pass
+
+	def url(self, key: str, expires: int = DEFAULT_URL_EXPIRES) -> str | None:
+		return None
+
+	def local_path(self, key: str) -> str | None:
+		path = self._path(key)
+		return path if os.path.isfile(path) else None
+
+
+class ReadThroughCache:
+	"""Локальные копии объектов, самые давно не читавшиеся вытесняются сверх max_bytes.
+
+	Имена загруженных файлов уникальны и не перезаписываются, поэтому копии не устаревают.
+	"""
+
+	def __init__(self, folder: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+		self.folder = folder
+		self.max_bytes = max_bytes
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest())
+
+	def get(self, key: str, fetch) -> str | None:
+		path = self._path(key)
+		if os.path.isfile(path):
+			os.utime(path)
+			return path
+		stream = fetch(key)
+		if stream is None:
+			return None
+		with stream:
+			_write_atomic(path, stream)
+		self._trim()
+		return path
+
+	def discard(self, key: str) -> None:
+		try:
+			os.remove(self._path(key))
+		except FileNotFoundError:
+			pass
+
+	def _trim(self) -> None:
+		entries = []
+		with os.scandir(self.folder) as scan:
+			for entry in scan:
+				if entry.is_file() and not entry.name.endswith('.tmp'):
+					stat = entry.stat()
+					entries.append((stat.st_mtime, stat.st_size, entry.path))
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+
+class _CountingReader:
+	def __init__(self, stream: IO[bytes]):
+		self._stream = stream
+		self.size = 0
+
+	def read(self, size: int = -1) -> bytes:
+		block = self._stream.read(size)
+		self.size += len(block)
+		return block
+
+
+class LocalS3Client:
+	"""Стенд-ин для клиента boto3 (подмножество методов S3) в памяти процесса: для проверок без бакета."""
+
+	def __init__(self):
+		self._objects: dict[tuple[str, str], bytes] = {}
+
+	def _missing(self, operation: str, key: str):
+		from botocore.exceptions import ClientError
+
+		return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, operation)
+
+	def upload_fileobj(self, fileobj: IO[bytes], bucket: str, key: str) -> None:
+		target = io.BytesIO()
+		_copy(fileobj, target)
+		self._objects[bucket, key] = target.getvalue()
+
+	def get_object(self, Bucket: str, Key: str) -> dict:
+		if (Bucket, Key) not in self._objects:
+			raise self._missing('GetObject', Key)
+		return {'Body': io.BytesIO(self._objects[Bucket, Key])}
+
+	def head_object(self, Bucket: str, Key: str) -> dict:
+		if (Bucket, Key) not in self._objects:
+			raise self._missing('HeadObject', Key)
+		return {'ContentLength': len(self._objects[Bucket, Key])}
+
+	def delete_object(self, Bucket: str, Key: str) -> None:
+		self._objects.pop((Bucket, Key), None)
+
+	def generate_presigned_url(self, operation: str, Params: dict, ExpiresIn: int) -> str:
+		return f'memory://{Params["Bucket"]}/{Params["Key"]}'
+
+
+class S3Storage:
+	"""S3-совместимое хранилище (AWS S3, MinIO): файлы доступны всем узлам."""
+
+	def __init__(
+		self,
+		bucket: str,
+		endpoint_url: str | None = None,
+		region: str | None = None,
+		access_key: str | None = None,
+		secret_key: str | None = None,
+		cache: ReadThroughCache | None = None,
+		presign: bool = True,
+		client=None,
+	):
+		self.bucket = bucket
+		self.cache = cache
+		self.presign = presign
+		if client is not None:
+			self._client = client
+			return
+
+		import boto3
+		from botocore.config import Config
+
+		self._client = boto3.client(
+			's3',
+			endpoint_url=endpoint_url,
+			region_name=region,
+			aws_access_key_id=access_key,
+			aws_secret_access_key=secret_key,
+			config=Config(signature_version='s3v4', s3={'addressing_style': 'path' if endpoint_url else 'auto'}),
+		)
+
+	def _missing(self, error) -> bool:
+		return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+	def put(self, key: str, stream: IO[bytes]) -> int:
+		# upload_fileobj читает поток частями и сам переходит на multipart для больших файлов
+		reader = _CountingReader(stream)
+		self._client.upload_fileobj(reader, self.bucket, key)
+		if self.cache:
+			self.cache.discard(key)
+		return reader.size
+
+	def open(self, key: str) -> IO[bytes]:
+		from botocore.exceptions import ClientError
+
+		try:
+			return self._client.get_object(Bucket=self.bucket, Key=key)['Body']
+		except ClientError as error:
+			if self._missing(error):
+				raise FileNotFoundError(key) from error
+			raise
+
+	def size(self, key: str) -> int | None:
+		from botocore.exceptions import ClientError
+
+		try:
+			return self._client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+		except ClientError as error:
+			if self._missing(error):
+				return None
+			raise
+
+	def delete(self, key: str) -> None:
+		self._client.delete_object(Bucket=self.bucket, Key=key)
+		if self.cache:
+			self.cache.discard(key)
+
+	def url(self, key: str, expires: int = DEFAULT_URL_EXPIRES) -> str | None:
+		if not self.presign:
+			return None
+		return self._client.generate_presigned_url(
+			'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=expires
+		)
+
+	def local_path(self, key: str) -> str | None:
+		if self.cache is None:
+			return None
+
+		def fetch(missing_key):
+			try:
+				return self.open(missing_key)
+			except FileNotFoundError:
+				return None
+
+		return self.cache.get(key, fetch)
+
+
+def init_storage(app: Flask) -> None:
+	app.config.setdefault('STORAGE_BACKEND', 'local')
+	app.config.setdefault('STORAGE_LOCAL_ROOT', None)
+	app.config.setdefault('STORAGE_URL_EXPIRES', DEFAULT_URL_EXPIRES)
+	app.config.setdefault('STORAGE_CACHE_DIR', None)
+	app.config.setdefault('STORAGE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+
+	backend = app.config['STORAGE_BACKEND']
+	cache_dir = app.config['STORAGE_CACHE_DIR'] or os.path.join(app.instance_path, 'storage_cache')
+	if backend == 'local':
+		storage = LocalStorage(app.config['STORAGE_LOCAL_ROOT'] or os.path.join(app.static_folder, 'uploads'))
+	elif backend == 's3-local':
+		storage = S3Storage(
+			app.config.get('STORAGE_S3_BUCKET') or 'bscar',
+			cache=ReadThroughCache(cache_dir, app.config['STORAGE_CACHE_MAX_BYTES']),
+			presign=False,
+			client=LocalS3Client(),
+		)
+	elif backend == 's3':
+		storage = S3Storage(
+			app.config['STORAGE_S3_BUCKET'],
+			endpoint_url=app.config.get('STORAGE_S3_ENDPOINT_URL'),
+			region=app.config.get('STORAGE_S3_REGION'),
+			access_key=app.config.get('STORAGE_S3_ACCESS_KEY'),
+			secret_key=app.config.get('STORAGE_S3_SECRET_KEY'),
+			cache=ReadThroughCache(cache_dir, app.config['STORAGE_CACHE_MAX_BYTES']),
+			presign=app.config.get('STORAGE_S3_PRESIGNED_URLS', True),
+		)
+	else:
+		raise ValueError(f'Unknown storage backend: {backend}')
+	app.extensions['storage'] = storage
+
+
+def get_storage():
+	return current_app.extensions['storage']
+
+
+def check_storage(storage) -> list[str]:
+	"""Проверка бэкенда на пробном объекте: put, size, open, local_path, delete. При расхождении — RuntimeError."""
+	key = f'checks/{uuid.uuid4().hex}.bin'
+	data = os.urandom(READ_BLOCK + 1)
+	report = []
+
+	def expect(condition: bool, step: str) -> None:
+		if not condition:
+			raise RuntimeError(f'{type(storage).__name__}: {step} failed for {key}')
+		report.append(f'{step}: ok')
+
+	try:
+		expect(storage.put(key, io.BytesIO(data)) == len(data), 'put')
+		expect(storage.size(key) == len(data), 'size')
+		with storage.open(key) as stream:
+			expect(stream.read() == data, 'open')
+		path = storage.local_path(key)
+		if path is None:
+			report.append('local_path: not available')
+		else:
+			with open(path, 'rb') as stream:
+				expect(stream.read() == data, 'local_path')
+	finally:
+		storage.delete(key)
+	expect(storage.size(key) is None, 'delete')
+	try:
+		storage.open(key).close()
+	except FileNotFoundError:
+		report.append('open after delete: FileNotFoundError')
+	else:
+		raise RuntimeError(f'{type(storage).__name__}: open after delete did not raise for {key}')
+	return report
+
+
+def storage_key(prefix: str, filename: str) -> str:
+	if not filename or '/' in filename or '\\' in filename or filename.startswith('.'):
+		raise ValueError(f'Invalid filename: {filename}')
+	return f'{prefix}/{filename}'
+
+
+def send_stored(prefix: str, filename: str):
+	"""Ответ с файлом: редирект на подписанную ссылку хранилища или отдача локальной (кэшированной) копии."""
+	try:
+		key = storage_key(prefix, filename)
+	except ValueError:
+		abort(404)
+	storage = get_storage()
+	url = storage.url(key, current_app.config['STORAGE_URL_EXPIRES'])
+	if url:
+		return redirect(url)
+	path = storage.local_path(key)
+	if path is None:
+		abort(404)
+	return send_file(path, download_name=filename, conditional=True)
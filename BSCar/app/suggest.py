@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import heapq
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import NamedTuple
+
+from flask import Flask, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .categories import CategoryTree, get_category_tree
+from .models import Listing
+
+
+MAX_SUGGESTIONS = 10
+MAX_PHRASE_WORDS = 3
+MAX_QUERY_LENGTH = 64
+# Диапазоны ключей длиннее этого не перебираются на каждый запрос: их лучшие варианты кэшируются
+SCAN_LIMIT = 256
+DEFAULT_SYNC_INTERVAL = 5.0
+# Перекрытие окна синхронизации: транзакция могла закоммититься позже своего updated_at
+SYNC_OVERLAP = timedelta(seconds=60)
+SYNC_CHUNK = 500
+CATEGORY_MARK = '\x00'
+
+_WORD_RE = re.compile(r'\w+')
+
+
+class Suggestion(NamedTuple):
+	text: str
+	count: int
+	category_id: int | None = None
+
+
+def normalize(text: str | None) -> str:
+	return ' '.join(_WORD_RE.findall((text or '').casefold()))
+
+
+def title_phrases(title: str | None) -> dict[str, str]:
+	"""Ключи объявления с подписями: первые 1..MAX_PHRASE_WORDS слов названия (марка, модель) и каждое слово."""
+	words = _WORD_RE.findall(title or '')
+	phrases = {normalize(word): word for word in words}
+	for end in range(1, min(len(words), MAX_PHRASE_WORDS) + 1):
+		label = ' '.join(words[:end])
+		phrases[normalize(label)] = label
+	return phrases
+
+
+def _category_key(name: str, category_id: int) -> str:
+	# Разные категории с одинаковым именем остаются разными ключами, а префикс по имени работает
+	return f'{normalize(name)}{CATEGORY_MARK}{category_id}'
+
+
+class SuggestIndex:
+	"""Отсортированный массив ключей с числом активных объявлений; поиск по префиксу — bisect.
+
+	Изменения идут под _lock. Запросы читают без блокировки, а посчитанный список лучших кладут
+	в кэш под ней и только если индекс за это время не менялся (_version).
+	"""
+
+	def __init__(self, tree: CategoryTree):
+		self.tree = tree
+		self.keys: list[str] = []
+		self.counts: dict[str, int] = {}
+		self.labels: dict[str, str] = {}
+		self.listings: dict[int, tuple[tuple[str, ...], int | None]] = {}
+		self._top: dict[str, list[tuple[int, str]]] = {}
+		self._lock = threading.Lock()
+		self._version = 0
+		for node in tree.walk():
+			key = _category_key(node.name, node.id)
+			self.labels[key] = node.name
+			self._change(key, 0)
+
+	@property
+	def active_count(self) -> int:
+		return len(self.listings)
+
+	def _category_keys(self, category_id: int | None) -> list[str]:
+		if category_id is None:
+			return []
+		return [_category_key(node.name, node.id) for node in self.tree.ancestors(category_id)]
+
+	def _change(self, key: str, delta: int) -> None:
+		count = self.counts.get(key)
+		if count is None:
+			insort(self.keys, key)
+			count = 0
+		count += delta
+		self._version += 1
+		self.counts[key] = count
+		if count <= 0 and CATEGORY_MARK not in key:
+			del self.counts[key]
+			del self.keys[bisect_left(self.keys, key)]
+			self.labels.pop(key, None)
+		if delta:
+			self._update_top(key, count, delta)
+
+	def _update_top(self, key: str, count: int, delta: int) -> None:
+		for end in range(1, len(key) + 1):
+			prefix = key[:end]
+			top = self._top.get(prefix)
+			if top is None:
+				continue
+			listed = any(item_key == key for _, item_key in top)
+			if listed and delta < 0:
+				# Ключ из списка лучших уменьшился: его мог обогнать ключ не из списка, пересчитаем при запросе
+				del self._top[prefix]
+			elif delta > 0 and (listed or len(top) < MAX_SUGGESTIONS or count >= top[-1][0]):
+				entries = [entry for entry in top if entry[1] != key] + [(count, key)]
+				entries.sort(key=lambda entry: (-entry[0], entry[1]))
+				self._top[prefix] = entries[:MAX_SUGGESTIONS]
+
+	def set_listing(self, listing_id: int, title: str | None, status: str | None, category_id: int | None) -> None:
+		"""Добавляет, обновляет или убирает объявление (status=None — удалено); повтор ничего не меняет."""
+		labels = title_phrases(title) if status == 'active' else None
+		with self._lock:
+			self._remove(listing_id)
+			if labels is not None:
+				self._add(listing_id, labels, category_id)
+
+	def remove_listing(self, listing_id: int) -> None:
+		with self._lock:
+			self._remove(listing_id)
+
+	def _remove(self, listing_id: int) -> None:
+		old = self.listings.pop(listing_id, None)
+		if old is not None:
+			phrases, old_category = old
+			for key in (*phrases, *self._category_keys(old_category)):
+				self._change(key, -1)
+
+	def _add(self, listing_id: int, labels: dict[str, str], category_id: int | None) -> None:
+		for phrase, label in labels.items():
+			self.labels.setdefault(phrase, label)
+		phrases = tuple(labels)
+		for key in (*phrases, *self._category_keys(category_id)):
+			self._change(key, 1)
+		self.listings[listing_id] = (phrases, category_id)
+
+	def with_tree(self, tree: CategoryTree) -> SuggestIndex:
+		"""Копия индекса с новым деревом категорий; объявления переносятся из памяти, без запросов к базе."""
+		index = SuggestIndex(tree)
+		for listing_id, (phrases, category_id) in self.listings.items():
+			index._add(listing_id, {phrase: self.labels.get(phrase, phrase) for phrase in phrases}, category_id)
+		return index
+
+	def _range(self, prefix: str) -> tuple[int, int]:
+		return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + '\uffff')
+
+	def _best(self, prefix: str) -> list[tuple[int, str]]:
+		top = self._top.get(prefix)
+		if top is not None:
+			return top
+		version = self._version
+		lo, hi = self._range(prefix)
+		best = heapq.nsmallest(
+			MAX_SUGGESTIONS,
+			((-count, key) for key in self.keys[lo:hi] if (count := self.counts.get(key, 0)) > 0),
+		)
+		best = [(-negative, key) for negative, key in best]
+		if hi - lo > SCAN_LIMIT:
+			with self._lock:
+				if self._version == version:
+					self._top[prefix] = best
+		return best
+
+	def suggest(self, query: str, limit: int = MAX_SUGGESTIONS) -> list[Suggestion]:
+		prefix = normalize(query)[:MAX_QUERY_LENGTH]
+		if not prefix:
+			return []
+		suggestions = []
+		for count, key in self._best(prefix)[:limit]:
+			name, _, category_id = key.partition(CATEGORY_MARK)
+			suggestions.append(Suggestion(self.labels.get(key, name), count, int(category_id) if category_id else None))
+		return suggestions
+
+
+def build_index() -> tuple[SuggestIndex, datetime]:
+	started = datetime.utcnow()
+	index = SuggestIndex(get_category_tree())
+	for listing_id, title, status, category_id in db.session.execute(
+		db.select(Listing.id, Listing.title, Listing.status, Listing.category_id).where(Listing.status == 'active')
+	):
+		index.set_listing(listing_id, title, status, category_id)
+	return index, started
+
+
+def sync_index(index: SuggestIndex, synced_at: datetime) -> tuple[SuggestIndex, datetime]:
+	"""Догоняет изменения объявлений инкрементально.
+
+	Правки и смена статуса — по updated_at. Если число активных объявлений разошлось с индексом
+	(удаления, массовые UPDATE), сверяются id активных объявлений: лишние убираются, недостающие
+	дочитываются. Новое дерево категорий переносится на индекс в памяти.
+	"""
+	started = datetime.utcnow()
+	tree = get_category_tree()
+	if index.tree is not tree:
+		index = index.with_tree(tree)
+	for row in db.session.execute(
+		db.select(Listing.id, Listing.title, Listing.status, Listing.category_id)
+		.where(Listing.updated_at > synced_at - SYNC_OVERLAP)
+	):
+		index.set_listing(*row)
+	active = db.session.execute(
+		db.select(db.func.count(Listing.id)).where(Listing.status == 'active')
+	).scalar()
+	if active != index.active_count:
+		active_ids = set(db.session.execute(db.select(Listing.id).where(Listing.status == 'active')).scalars())
+		for listing_id in set(index.listings) - active_ids:
+			index.remove_listing(listing_id)
+		missing = sorted(active_ids - set(index.listings))
+		for start in range(0, len(missing), SYNC_CHUNK):
+			for row in db.session.execute(
+				db.select(Listing.id, Listing.title, Listing.status, Listing.category_id)
+				.where(Listing.id.in_(missing[start:start + SYNC_CHUNK]))
+			):
+				index.set_listing(*row)
+	return index, started
+
+
+class SuggestRefresher:
+	"""Индекс подсказок процесса и фоновый поток, который раз в interval секунд сверяет его с базой.
+
+	Запрос подсказок только читает готовый индекс; пока первый индекс строится, подсказок нет.
+	Изменения объявлений, закоммиченные в этом же процессе, применяются сразу.
+	"""
+
+	def __init__(self, app: Flask, interval: float):
+		self.app = app
+		self.interval = interval
+		self.index: SuggestIndex | None = None
+		self._synced_at: datetime | None = None
+		self._lock = threading.Lock()
+		self._pid: int | None = None
+
+	def get(self) -> SuggestIndex | None:
+		if self._pid != os.getpid():
+			self._start()
+		return self.index
+
+	def refresh(self) -> None:
+		with self._lock:
+			if self.index is None:
+				self.index, self._synced_at = build_index()
+			else:
+				self.index, self._synced_at = sync_index(self.index, self._synced_at)
+
+	def apply(self, changes: dict[int, tuple[str | None, str | None, int | None]]) -> None:
+		# Не ждём фоновую сверку: она сама подхватит эти изменения по updated_at и id
+		if not self._lock.acquire(blocking=False):
+			return
+		try:
+			if self.index is not None:
+				for listing_id, (title, status, category_id) in changes.items():
+					self.index.set_listing(listing_id, title, status, category_id)
+		finally:
+			self._lock.release()
+
+	def _start(self) -> None:
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			# После fork индекс родителя не догоняется его потоком: строим свой
+			self._pid = os.getpid()
+			self.index = None
+		thread = threading.Thread(target=self._run, name='suggest-refresh', daemon=True)
+		thread.start()
+
+	def _run(self) -> None:
+		stop = threading.Event()
+		while True:
+			with self.app.app_context():
+				try:
+					self.refresh()
+				except Exception:
+					self.app.logger.exception('Failed to refresh suggestion index')
+				finally:
+					db.session.remove()
+			if stop.wait(self.interval):
+				return
+
+
+def init_suggest(app: Flask) -> None:
+	app.config.setdefault('SUGGEST_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)
+	app.extensions['suggest'] = SuggestRefresher(app, app.config['SUGGEST_SYNC_INTERVAL'])
+
+
+def get_index() -> SuggestIndex | None:
+	return current_app.extensions['suggest'].get()
+
+
+def suggest(query: str, limit: int = MAX_SUGGESTIONS) -> list[Suggestion]:
+	index = get_index()
+	if index is None:
+		return []
+	return index.suggest(query, min(limit, MAX_SUGGESTIONS))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_suggest_changes(session, flush_context):
+	changes = session.info.setdefault('suggest_changes', {})
+	for obj in chain(session.new, session.dirty):
+		if isinstance(obj, Listing):
+			changes[obj.id] = (obj.title, obj.status, obj.category_id)
+	for obj in session.deleted:
+		if isinstance(obj, Listing):
+			changes[obj.id] = (None, None, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_suggest_changes(session):
+	changes = session.info.pop('suggest_changes', None)
+	if changes and has_app_context() and 'suggest' in current_app.extensions:
+		current_app.extensions['suggest'].apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_suggest_changes(session):
+	session.info.pop('suggest_changes', None)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple
+
+from . import db
+from .models import SupportTicket
+
+
+TICKET_PAGE_SIZE = 20
+TICKET_STATUSES = ('pending', 'answered')
+PENDING_COUNT_TTL = 15
+
+
+class TicketPage(NamedTuple):
+	tickets: list[SupportTicket]
+	next_cursor: str | None
+
+
+def encode_cursor(ticket: SupportTicket) -> str:
+	return f'{ticket.created_at.isoformat()}_{ticket.id}'
+
+
+def decode_cursor(cursor: str | None) -> tuple[datetime, int] | None:
+	if not cursor:
+		return None
+	try:
+		created_at, ticket_id = cursor.rsplit('_', 1)
+		return datetime.fromisoformat(created_at), int(ticket_id)
+	except ValueError:
+		return None
+
+
+def ticket_page(status: str | None = None, cursor: str | None = None, per_page: int = TICKET_PAGE_SIZE) -> TicketPage:
+	query = db.select(SupportTicket).options(db.joinedload(SupportTicket.user))
+	if status in TICKET_STATUSES:
+		query = query.where(SupportTicket.status == status)
+	position = decode_cursor(cursor)
+	if position:
+		created_at, ticket_id = position
+		query = query.where(db.or_(
+			SupportTicket.created_at < created_at,
+			db.and_(SupportTicket.created_at == created_at, SupportTicket.id < ticket_id),
+		))
+	tickets = db.session.execute(
+		query.order_by(SupportTicket.created_at.desc(), SupportTicket.id.desc()).limit(per_page + 1)
+	).scalars().all()
+	next_cursor = encode_cursor(tickets[per_page - 1]) if len(tickets) > per_page else None
+	return TicketPage(tickets[:per_page], next_cursor)
+
+
+def ticket_counts() -> dict[str, int]:
+	rows = db.session.execute(
+		db.select(SupportTicket.status, db.func.count(SupportTicket.id)).group_by(SupportTicket.status)
+	).all()
+	counts = {status: 0 for status in TICKET_STATUSES}
+	counts.update({status: count for status, count in rows})
+	counts['all'] = sum(count for _, count in rows)
+	return counts
+
+
+_pending_lock = threading.Lock()
+_pending_count: tuple[float, int] | None = None
+
+
+def pending_ticket_count() -> int:
+	global _pending_count
+	cached = _pending_count
+	if cached and time.monotonic() - cached[0] < PENDING_COUNT_TTL:
+		return cached[1]
+	with _pending_lock:
+		count = db.session.execute(
+			db.select(db.func.count(SupportTicket.id)).where(SupportTicket.status == 'pending')
+		).scalar() or 0
+		_pending_count = (time.monotonic(), count)
+	return count
+
+
+def reset_pending_count() -> None:
+	global _pending_count
+	_pending_count = None
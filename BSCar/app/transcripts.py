@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import struct
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterable, NamedTuple
+
+from flask import current_app
+
+from . import db
+from .models import Message, MessageBlock
+
+
+DEFAULT_COMPACT_AFTER_DAYS = 90
+BLOCK_MESSAGES = 256
+COMPRESSION_LEVEL = 6
+CHAT_PAGE_SIZE = 50
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+# id, author_id, created_at, updated_at (микросекунды от эпохи); за заголовком — текст в UTF-8
+_HEADER = struct.Struct('<IIqq')
+
+
+class StoredMessage(NamedTuple):
+	id: int
+	chat_id: int
+	author_id: int
+	content: str
+	created_at: datetime
+	updated_at: datetime
+
+
+class ChatPage(NamedTuple):
+	messages: list
+	before: int | None
+
+
+class CompactResult(NamedTuple):
+	chats: int
+	blocks: int
+	messages: int
+
+
+def _micros(value: datetime) -> int:
+	return (value - _EPOCH) // _MICROSECOND
+
+
+def pack_messages(messages: list) -> tuple[bytes, bytes]:
+	"""Упаковывает сообщения в сжатый блок и индекс смещений записей внутри распакованных данных."""
+	offsets = []
+	payload = bytearray()
+	for message in messages:
+		offsets.append(len(payload))
+		payload += _HEADER.pack(message.id, message.author_id, _micros(message.created_at), _micros(message.updated_at))
+		payload += message.content.encode('utf-8')
+	return struct.pack(f'<{len(offsets)}I', *offsets), zlib.compress(bytes(payload), COMPRESSION_LEVEL)
+
+
+def unpack_block(block: MessageBlock) -> list[StoredMessage]:
+	if block.codec != 'zlib':
+		raise ValueError(f'Unsupported message block codec: {block.codec}')
+	payload = zlib.decompress(block.data)
+	offsets = struct.unpack(f'<{block.message_count}I', block.offsets)
+	messages = []
+	for index, start in enumerate(offsets):
+		end = offsets[index + 1] if index + 1 < len(offsets) else len(payload)
+		message_id, author_id, created_us, updated_us = _HEADER.unpack_from(payload, start)
+		messages.append(StoredMessage(
+			message_id,
+			block.chat_id,
+			author_id,
+			payload[start + _HEADER.size:end].decode('utf-8'),
+			_EPOCH + created_us * _MICROSECOND,
+			_EPOCH + updated_us * _MICROSECOND,
+		))
+	return messages
+
+
+def _new_block(chat_id: int, messages: list) -> MessageBlock:
+	offsets, data = pack_messages(messages)
+	return MessageBlock(
+		chat_id=chat_id,
+		first_message_id=messages[0].id,
+		last_message_id=messages[-1].id,
+		message_count=len(messages),
+		first_at=messages[0].created_at,
+		last_at=messages[-1].created_at,
+		codec='zlib',
+		offsets=offsets,
+		data=data,
+	)
+
+
+def _compact_chat(chat_id: int, cutoff: datetime, ceiling: int, block_size: int) -> tuple[int, int]:
+	last_id = db.session.execute(
+		db.select(db.func.max(Message.id)).where(
+			Message.chat_id == chat_id, Message.created_at < cutoff, Message.id < ceiling
+		)
+	).scalar()
+	if last_id is None:
+		return 0, 0
+	messages = db.session.execute(
+		db.select(Message).where(Message.chat_id == chat_id, Message.id <= last_id).order_by(Message.id)
+	).scalars().all()
+	moved = len(messages)
+
+	tail = db.session.execute(
+		db.select(MessageBlock)
+		.where(MessageBlock.chat_id == chat_id)
+		.order_by(MessageBlock.last_message_id.desc())
+		.limit(1)
+	).scalar()
+	if tail is not None and tail.message_count < block_size:
+		messages = unpack_block(tail) + list(messages)
+		db.session.delete(tail)
+
+	blocks = [_new_block(chat_id, messages[i:i + block_size]) for i in range(0, len(messages), block_size)]
+	db.session.add_all(blocks)
+	db.session.execute(db.delete(Message).where(Message.chat_id == chat_id, Message.id <= last_id))
+	db.session.commit()
+	return len(blocks), moved
+
+
+def compact_chats(
+	older_than_days: int | None = None,
+	block_size: int = BLOCK_MESSAGES,
+	now: datetime | None = None,
+) -> CompactResult:
+	"""Переносит сообщения старше порога в сжатые блоки по чатам, по одной транзакции на чат.
+
+	В блок уходит весь префикс переписки до последнего старого сообщения, поэтому блоки
+	всегда старше строк, оставшихся в messages. Неполный последний блок дополняется.
+	Сообщение с наибольшим id никогда не упаковывается: иначе автоинкремент (SQLite,
+	MySQL до 8.0 после рестарта) может выдать новым сообщениям id, уже занятые в блоках.
+	"""
+	if older_than_days is None:
+		older_than_days = current_app.config.get('CHAT_COMPACT_AFTER_DAYS', DEFAULT_COMPACT_AFTER_DAYS)
+	cutoff = (now or datetime.utcnow()) - timedelta(days=older_than_days)
+	ceiling = db.session.execute(db.select(db.func.max(Message.id))).scalar()
+	chat_ids = db.session.execute(
+		db.select(Message.chat_id).where(Message.created_at < cutoff, Message.id < ceiling)
+		.distinct().order_by(Message.chat_id)
+	).scalars().all() if ceiling is not None else []
+
+	blocks = messages = 0
+	for chat_id in chat_ids:
+		chat_blocks, chat_messages = _compact_chat(chat_id, cutoff, ceiling, block_size)
+		blocks += chat_blocks
+		messages += chat_messages
+	return CompactResult(len(chat_ids), blocks, messages)
+
+
+def chat_history(chat_id: int, before: int | None = None, limit: int = CHAT_PAGE_SIZE) -> ChatPage:
+	"""Последние limit сообщений чата с id < before: сначала из messages, затем из сжатых блоков."""
+	query = db.select(Message).where(Message.chat_id == chat_id)
+	if before is not None:
+		query = query.where(Message.id < before)
+	newest_first = list(db.session.execute(query.order_by(Message.id.desc()).limit(limit + 1)).scalars())
+
+	if len(newest_first) <= limit:
+		block_query = db.select(MessageBlock.id).where(MessageBlock.chat_id == chat_id)
+		if before is not None:
+			block_query = block_query.where(MessageBlock.first_message_id < before)
+		for block_id in db.session.execute(block_query.order_by(MessageBlock.last_message_id.desc())).scalars().all():
+			for message in reversed(unpack_block(db.session.get(MessageBlock, block_id))):
+				if before is None or message.id < before:
+					newest_first.append(message)
+			if len(newest_first) > limit:
+				break
+
+	has_more = len(newest_first) > limit
+	messages = newest_first[:limit][::-1]
+	return ChatPage(messages, messages[0].id if has_more else None)
+
+
+def block_messages(chat_ids: Iterable[int]) -> Iterable[StoredMessage]:
+	for block in db.session.execute(
+		db.select(MessageBlock)
+		.where(MessageBlock.chat_id.in_(chat_ids))
+		.order_by(MessageBlock.chat_id, MessageBlock.last_message_id)
+	).scalars():
+		yield from unpack_block(block)
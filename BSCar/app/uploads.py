@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+
+from . import db
+from .models import Listing, ListingImage, UploadSession
+from .moderation import delete_listings
+from .refcache import get_setting
+from .storage import AVATARS_PREFIX, LISTINGS_PREFIX, get_storage, storage_key
+
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_FILE_SIZE = 5 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+READ_BLOCK = 64 * 1024
+DEFAULT_UPLOAD_TTL_HOURS = 24
+
+
+def allowed_extensions() -> frozenset[str]:
+	value = get_setting('upload.allowed_extensions')
+	if not value:
+		return frozenset(ALLOWED_EXTENSIONS)
+	return frozenset(ext.strip().lower().lstrip('.') for ext in value.split(',') if ext.strip())
+
+
+def allowed_file(filename):
+	return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions()
+
+
+def save_uploaded_file(file, listing_id):
+	if file and allowed_file(file.filename):
+		file_ext = file.filename.rsplit('.', 1)[1].lower()
+		unique_filename = f"{listing_id}_{uuid.uuid4().hex}.{file_ext}"
+		get_storage().put(storage_key(LISTINGS_PREFIX, unique_filename), file.stream)
+
+		return unique_filename
+	return None
+
+
+def save_avatar(file, user_id=None):
+	ext = file.filename.rsplit('.', 1)[-1].lower()
+	filename = f"user_{user_id}_{uuid.uuid4().hex}.{ext}" if user_id else f"user_{uuid.uuid4().hex}.{ext}"
+	get_storage().put(storage_key(AVATARS_PREFIX, filename), file.stream)
+	return filename
+
+
+class UploadError(Exception):
+	def __init__(self, message: str, status: int = 400):
+		super().__init__(message)
+		self.status = status
+
+
+def _part_path(upload_id: str) -> str:
+	folder = current_app.config.get('UPLOAD_TMP_DIR') or os.path.join(current_app.instance_path, 'uploads')
+	os.makedirs(folder, exist_ok=True)
+	return os.path.join(folder, f'{upload_id}.part')
+
+
+def _upload_state(upload) -> dict:
+	return {
+		'upload_id': upload.id,
+		'draft_id': upload.listing_id,
+		'offset': upload.received,
+		'size': upload.total_size,
+		'status': upload.status,
+		'chunk_size': CHUNK_SIZE,
+	}
+
+
+def start_upload(user_id: int, filename: str, size: int, draft_id: int | None = None) -> dict:
+	if not filename or not allowed_file(filename):
+		raise UploadError('Недопустимый формат файла')
+	if size <= 0 or size > MAX_FILE_SIZE:
+		raise UploadError('Файл слишком большой (максимум 5MB)', 413)
+
+	if draft_id:
+		draft = db.session.get(Listing, draft_id)
+		if not draft or draft.owner_id != user_id or draft.status != 'draft':
+			raise UploadError('Черновик не найден', 404)
+	else:
+		draft = Listing(title='', owner_id=user_id, status='draft')
+		db.session.add(draft)
+		db.session.flush()
+
+	upload = UploadSession(
+		id=uuid.uuid4().hex,
+		user_id=user_id,
+		listing_id=draft.id,
+		filename=os.path.basename(filename)[:255],
+		total_size=size,
+	)
+	db.session.add(upload)
+	db.session.commit()
+	open(_part_path(upload.id), 'wb').close()
+	return _upload_state(upload)
+
+
+def get_upload(user_id: int, upload_id: str):
+	upload = db.session.get(UploadSession, upload_id)
+	if not upload or upload.user_id != user_id:
+		raise UploadError('Загрузка не найдена', 404)
+	return upload
+
+
+def upload_state(user_id: int, upload_id: str) -> dict:
+	return _upload_state(get_upload(user_id, upload_id))
+
+
+def write_chunk(user_id: int, upload_id: str, offset: int, stream, length: int | None) -> dict:
+	"""Дописывает кусок файла с заданного смещения, читая поток блоками; повтор куска безопасен."""
+	upload = get_upload(user_id, upload_id)
+	if upload.status != 'pending':
+		return _upload_state(upload)
+	if offset != upload.received:
+		raise UploadError(f'Ожидалось смещение {upload.received}', 409)
+	if length is None or length <= 0 or length > CHUNK_SIZE or offset + length > upload.total_size:
+		raise UploadError('Недопустимый размер куска', 413)
+
+	written = 0
+	with open(_part_path(upload.id), 'r+b') as part:
+		part.seek(offset)
+		while written < length:
+			block = stream.read(min(READ_BLOCK, length - written))
+			if not block:
+				break
+			part.write(block)
+			written += len(block)
+	if written != length:
+		raise UploadError('Кусок получен не полностью')
+
+	moved = db.session.execute(
+		db.update(UploadSession)
+		.where(UploadSession.id == upload.id, UploadSession.received == offset)
+		.values(received=offset + written),
+		execution_options={'synchronize_session': False},
+	).rowcount
+	db.session.commit()
+	db.session.refresh(upload)
+	if not moved:
+		raise UploadError(f'Ожидалось смещение {upload.received}', 409)
+	if upload.received == upload.total_size:
+		_complete(upload)
+	return _upload_state(upload)
+
+
+def _complete(upload) -> None:
+	path = _part_path(upload.id)
+	with open(path, 'rb') as stream:
+		filename = save_uploaded_file(FileStorage(stream=stream, filename=upload.filename), upload.listing_id)
+	os.remove(path)
+
+	has_primary = db.session.execute(
+		db.select(ListingImage.id).where(ListingImage.listing_id == upload.listing_id, ListingImage.is_primary)
+	).first() is not None
+	image = ListingImage(
+		listing_id=upload.listing_id,
+		filename=filename,
+		original_filename=upload.filename,
+		file_size=upload.total_size,
+		is_primary=not has_primary,
+	)
+	db.session.add(image)
+	db.session.flush()
+	upload.status = 'complete'
+	upload.image_id = image.id
+	db.session.commit()
+
+
+def purge_stale_uploads(now: datetime | None = None) -> int:
+	"""Удаляет незавершённые загрузки и брошенные черновики старше UPLOAD_TTL_HOURS."""
+	now = now or datetime.utcnow()
+	cutoff = now - timedelta(hours=current_app.config.get('UPLOAD_TTL_HOURS', DEFAULT_UPLOAD_TTL_HOURS))
+	stale = db.session.execute(
+		db.select(UploadSession.id).where(UploadSession.status == 'pending', UploadSession.updated_at < cutoff)
+	).scalars().all()
+	for upload_id in stale:
+		path = _part_path(upload_id)
+		if os.path.exists(path):
+			os.remove(path)
+	if stale:
+		db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(stale)))
+
+	drafts = db.session.execute(
+		db.select(Listing.id).where(
+			Listing.status == 'draft',
+			Listing.updated_at < cutoff,
+			~db.exists().where(UploadSession.listing_id == Listing.id, UploadSession.status == 'pending'),
+		)
+	).scalars().all()
+	if drafts:
+		delete_listings(drafts)
+	db.session.commit()
+	return len(stale) + len(drafts)
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import atexit
+import os
+import threading
+from collections import Counter
+from datetime import date, datetime
+
+from flask import Flask, current_app
+
+from . import db
+from .models import Listing, ListingViewCount
+
+
+DEFAULT_FLUSH_INTERVAL = 10
+
+
+def upsert_view_counts(counts: dict[tuple[int, date], int]) -> int:
+	listing_ids = {listing_id for listing_id, _ in counts}
+	existing = set(db.session.execute(
+		db.select(Listing.id).where(Listing.id.in_(listing_ids))
+	).scalars())
+	now = datetime.utcnow()
+	rows = [
+		{'listing_id': listing_id, 'day': day, 'views': views, 'updated_at': now}
+		for (listing_id, day), views in sorted(counts.items())
+		if listing_id in existing
+	]
+	if not rows:
+		return 0
+
+	table = ListingViewCount.__table__
+	dialect = db.session.get_bind().dialect.name
+	if dialect == 'mysql':
+		from sqlalchemy.dialects.mysql import insert
+		stmt = insert(table)
+		stmt = stmt.on_duplicate_key_update(
+			views=table.c.views + stmt.inserted.views,
+			updated_at=stmt.inserted.updated_at,
+		)
+	elif dialect in ('sqlite', 'postgresql'):
+		if dialect == 'sqlite':
+			from sqlalchemy.dialects.sqlite import insert
+		else:
+			from sqlalchemy.dialects.postgresql import insert
+		stmt = insert(table)
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[table.c.listing_id, table.c.day],
+			set_={'views': table.c.views + stmt.excluded.views, 'updated_at': stmt.excluded.updated_at},
+		)
+	else:
+		raise RuntimeError(f'View counter upsert is not supported for {dialect}')
+
+	db.session.execute(stmt, rows)
+	db.session.commit()
+	return len(rows)
+
+
+class ViewBuffer:
+	"""Буфер просмотров в памяти воркера, сбрасываемый в БД пачками по таймеру."""
+
+	def __init__(self, app: Flask, interval: float):
+		self.app = app
+		self.interval = interval
+		self._counts: Counter[tuple[int, date]] = Counter()
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._pid: int | None = None
+
+	def record(self, listing_id: int) -> None:
+		key = (listing_id, datetime.utcnow().date())
+		with self._lock:
+			self._counts[key] += 1
+		if self._pid != os.getpid():
+			self._start()
+
+	def pending_many(self, listing_ids) -> Counter[int]:
+		wanted = set(listing_ids)
+		result: Counter[int] = Counter()
+		with self._lock:
+			for (listing_id, _), views in self._counts.items():
+				if listing_id in wanted:
+					result[listing_id] += views
+		return result
+
+	def flush(self) -> int:
+		with self._flush_lock:
+			with self._lock:
+				counts, self._counts = self._counts, Counter()
+			if not counts:
+				return 0
+			try:
+				return upsert_view_counts(counts)
+			except Exception:
+				db.session.rollback()
+				with self._lock:
+					self._counts.update(counts)
+				raise
+
+	def _start(self) -> None:
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._pid = os.getpid()
+		thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+		thread.start()
+
+	def _run(self) -> None:
+		stop = threading.Event()
+		while not stop.wait(self.interval):
+			self._flush_in_context()
+
+	def _flush_in_context(self) -> None:
+		with self.app.app_context():
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('Failed to flush listing view counts')
+
+
+def init_view_counter(app: Flask) -> None:
+	app.config.setdefault('VIEW_COUNTER_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+	buffer = ViewBuffer(app, app.config['VIEW_COUNTER_FLUSH_INTERVAL'])
+	app.extensions['view_counter'] = buffer
+	atexit.register(buffer._flush_in_context)
+
+
+def record_view(listing_id: int) -> None:
+	current_app.extensions['view_counter'].record(listing_id)
+
+
+def view_counts(listing_ids) -> dict[int, int]:
+	listing_ids = list(listing_ids)
+	if not listing_ids:
+		return {}
+	counts: Counter[int] = Counter(dict(db.session.execute(
+		db.select(ListingViewCount.listing_id, db.func.sum(ListingViewCount.views))
+		.where(ListingViewCount.listing_id.in_(listing_ids))
+		.group_by(ListingViewCount.listing_id)
+	).all()))
+	counts.update(current_app.extensions['view_counter'].pending_many(listing_ids))
+	return {listing_id: int(counts.get(listing_id, 0)) for listing_id in listing_ids}
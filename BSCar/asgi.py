@@ -0,0 +1,9 @@
+from __future__ import annotations
+
+from app import create_app
+from app.chat_async import create_asgi_app
+
+# uvicorn asgi:application --host 0.0.0.0 --port 5001
+flask_app = create_app()
+flask_app.config['CHAT_ASYNC_ENABLED'] = True
+application = create_asgi_app(flask_app)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Время до первого ответа для свежего воркера.
+
+Каждый замер запускается в отдельном процессе: импорт приложения, create_app()
+и первый запрос к ленте. Сравниваются режимы без кэша байткода Jinja,
+с холодным кэшем и с прогретым кэшем.
+
+    python benchmarks/startup.py --runs 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ['/', '/listings/1', '/chats', '/support', '/admin']
+
+
+def seed_database(db_uri):
+	sys.path.insert(0, ROOT)
+	from app import create_app, db
+	from app.models import User, Category, Listing
+
+	app = create_app({'SQLALCHEMY_DATABASE_URI': db_uri, 'JINJA_BYTECODE_CACHE_DIR': False})
+	with app.app_context():
+		db.create_all()
+		admin = User(email='bench@example.com', password_hash='bench', name='Bench', role='admin')
+		db.session.add(admin)
+		db.session.add_all([Category(name='Новые'), Category(name='Б/У')])
+		db.session.flush()
+		for i in range(50):
+			db.session.add(Listing(title=f'Car {i}', description='Описание', price=1000000 + i, owner_id=admin.id))
+		db.session.commit()
+		return admin.id
+
+
+def run_worker(db_uri, cache_dir, user_id):
+	started = time.perf_counter()
+	sys.path.insert(0, ROOT)
+	from app import create_app
+
+	cache = False if cache_dir == 'off' else cache_dir
+	app = create_app({'SQLALCHEMY_DATABASE_URI': db_uri, 'JINJA_BYTECODE_CACHE_DIR': cache, 'TESTING': True})
+	created = time.perf_counter()
+	client = app.test_client()
+	with client.session_transaction() as sess:
+		sess['user_id'] = user_id
+	response = client.get(PAGES[0])
+	first = time.perf_counter()
+	for page in PAGES[1:]:
+		client.get(page)
+	done = time.perf_counter()
+	print(json.dumps({
+		'status': response.status_code,
+		'create_app_ms': (created - started) * 1000,
+		'first_response_ms': (first - created) * 1000,
+		'all_pages_ms': (done - created) * 1000,
+	}))
+
+
+def measure(db_uri, cache_dir, user_id):
+	output = subprocess.check_output(
+		[sys.executable, __file__, '--worker', db_uri, cache_dir, str(user_id)],
+		cwd=ROOT,
+	)
+	return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--runs', type=int, default=5)
+	parser.add_argument('--worker', nargs=3, metavar=('DB_URI', 'CACHE_DIR', 'USER_ID'), help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.worker:
+		db_uri, cache_dir, user_id = args.worker
+		run_worker(db_uri, cache_dir, int(user_id))
+		return
+
+	workdir = tempfile.mkdtemp(prefix='bscar-bench-')
+	try:
+		db_uri = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+		user_id = seed_database(db_uri)
+		cache_dir = os.path.join(workdir, 'jinja_cache')
+		results = {'no cache': [], 'cold cache': [], 'warm cache': []}
+		for _ in range(args.runs):
+			results['no cache'].append(measure(db_uri, 'off', user_id))
+			shutil.rmtree(cache_dir, ignore_errors=True)
+			results['cold cache'].append(measure(db_uri, cache_dir, user_id))
+			results['warm cache'].append(measure(db_uri, cache_dir, user_id))
+
+		print(f"{'mode':<12} {'create_app':>12} {'first resp':>12} {'all pages':>12}  (median ms, {args.runs} runs)")
+		for mode, samples in results.items():
+			row = [statistics.median(s[key] for s in samples) for key in ('create_app_ms', 'first_response_ms', 'all_pages_ms')]
+			print(f"{mode:<12} {row[0]:>12.1f} {row[1]:>12.1f} {row[2]:>12.1f}")
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,43 @@
+import pytest
+
+from app import create_app, db
+from app import similar
+from app.models import Listing, ListingVector, User
+
+
+@pytest.fixture
+def app():
+	app = create_app({
+		'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+		'TESTING': True,
+		'JINJA_BYTECODE_CACHE_DIR': False,
+		'PHASH_ON_UPLOAD': False,
+	})
+	with app.app_context():
+		db.create_all()
+		yield app
+		db.session.remove()
+		db.drop_all()
+
+
+def _seed_listings(count):
+	owner = User(email='seller@example.com', password_hash='x', name='Seller')
+	db.session.add(owner)
+	db.session.flush()
+	db.session.add_all([
+		Listing(title=f'Toyota Camry {i}', description='Седан', price=1000000 + i, owner_id=owner.id, status='active')
+		for i in range(count)
+	])
+	db.session.commit()
+
+
+@pytest.mark.parametrize('full', [True, False])
+def test_refresh_vectorizes_every_batch(app, monkeypatch, full):
+	monkeypatch.setattr(similar, 'BATCH_SIZE', 50)
+	_seed_listings(similar.BATCH_SIZE * 2 + 7)
+
+	similar.refresh_similar(full=full)
+
+	listing_ids = set(db.session.execute(db.select(Listing.id)).scalars())
+	vector_ids = set(db.session.execute(db.select(ListingVector.listing_id)).scalars())
+	assert vector_ids == listing_ids